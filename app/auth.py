@@ -4,12 +4,12 @@ from typing import Optional
 
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from redis import Redis
 
 from .config import settings  # <- correct: same package, single dot
+from .redis_pool import get_redis
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-redis_client = Redis.from_url(settings.redis_url, decode_responses=True)
+redis_client = get_redis()
 
 
 def hash_password(p: str) -> str:
@@ -1,31 +1,195 @@
-import json
-from typing import Optional
-from redis import Redis
-from redis.exceptions import RedisError
-from fastapi.encoders import jsonable_encoder  
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+import orjson
+from cachetools import TTLCache
+from redis.exceptions import RedisError, WatchError
+from . import invalidation, metrics
 from .config import settings
+from .redis_pool import get_async_redis
 
-redis_client = Redis.from_url(settings.redis_url, decode_responses=True)
+async_redis_client = get_async_redis()
+# The chatroom list is kept as JSON bytes and sent as-is; no str round trip
+async_redis_bytes = get_async_redis(decode_responses=False)
 
 def _key(user_id: int) -> str:
     return f"chatrooms:{user_id}"
 
-def get_cached_chatrooms(user_id: int) -> Optional[list]:
-    try:
-        raw = redis_client.get(_key(user_id))
-        return json.loads(raw) if raw else None
-    except (RedisError, json.JSONDecodeError):
-        return None  
+def _generation_key(user_id: int) -> str:
+    return f"chatrooms:{user_id}:gen"
 
-def set_cached_chatrooms(user_id: int, data: list, ttl_seconds: int = 600):
+async def adelete_cached_chatrooms(user_id: int):
     try:
-        safe = jsonable_encoder(data)                
-        redis_client.setex(_key(user_id), ttl_seconds, json.dumps(safe))
+        await async_redis_client.delete(_key(user_id))
     except RedisError:
         pass
 
-def delete_cached_chatrooms(user_id: int):
+
+# ---- two-tier chatroom list: L1 (per process) -> Redis -> DB ----
+
+CHATROOMS_CACHE = "chatrooms"
+WRITE_THROUGH_ATTEMPTS = 3
+
+# KEYS: list, generation. ARGV: list bytes, ttl, generation read before the
+# load ('' for none). A loader only fills an empty key, and only if no
+# write-through ran since it started: its list may predate that change.
+_FILL_LUA = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[3] then
+  return 0
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2], 'NX') then
+  return 1
+end
+return 0
+"""
+_fill = async_redis_bytes.register_script(_FILL_LUA)
+
+class CachedChatrooms:
+    """
+    A user's chatroom list as the JSON bytes stored in Redis and sent to
+    clients. The rows are only decoded when a caller needs them, once per
+    entry.
+    """
+    __slots__ = ("raw", "_rows")
+
+    def __init__(self, raw: bytes, rows: Optional[list] = None):
+        self.raw = raw
+        self._rows = rows
+
+    @property
+    def rows(self) -> list:
+        if self._rows is None:
+            self._rows = orjson.loads(self.raw)
+        return self._rows
+
+
+_local = TTLCache(maxsize=settings.chatroom_cache_local_size, ttl=settings.chatroom_cache_local_ttl)
+_local_lock = threading.Lock()
+_inflight: Dict[int, asyncio.Future] = {}
+
+
+def _drop_local(key: Optional[str]):
+    with _local_lock:
+        if key is None:
+            _local.clear()
+        else:
+            _local.pop(int(key), None)
+
+
+invalidation.register(CHATROOMS_CACHE, _drop_local)
+
+
+def _set_local(user_id: int, entry: Optional[CachedChatrooms]):
+    with _local_lock:
+        if entry is not None and invalidation.active():
+            _local[user_id] = entry
+        else:
+            _local.pop(user_id, None)
+
+
+async def aget_chatrooms(
+    user_id: int, load: Callable[[], Awaitable[bytes]]
+) -> Tuple[CachedChatrooms, bool]:
+    """
+    Chatroom list for a user as (entry, served_from_cache); `load()` returns
+    the list as JSON bytes. Concurrent misses for the same user in this
+    process share one Redis read and one `load()`. Entries are shared with
+    the cache; don't mutate their rows.
+    """
+    if invalidation.active():
+        with _local_lock:
+            entry = _local.get(user_id)
+        if entry is not None:
+            metrics.incr("chatroom_list_cache.local_hit")
+            return entry, True
+
+    pending = _inflight.get(user_id)
+    if pending is not None:
+        metrics.incr("chatroom_list_cache.coalesced")
+        try:
+            return await asyncio.shield(pending)
+        except asyncio.CancelledError:
+            if not pending.cancelled():
+                raise
+            # the request that was loading went away; load ourselves
+
+    future = asyncio.get_running_loop().create_future()
+    # nobody may be waiting; don't warn about an unretrieved exception
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+    _inflight[user_id] = future
     try:
-        redis_client.delete(_key(user_id))
-    except RedisError:
-        pass
+        try:
+            raw, generation = await async_redis_bytes.mget(_key(user_id), _generation_key(user_id))
+        except RedisError:
+            raw, generation = None, None
+            fill = False
+        else:
+            fill = True
+        if raw is not None:
+            metrics.incr("chatroom_list_cache.redis_hit")
+            result = (CachedChatrooms(raw), True)
+        else:
+            metrics.incr("chatroom_list_cache.miss")
+            raw = await load()
+            if fill:
+                try:
+                    await _fill(
+                        keys=[_key(user_id), _generation_key(user_id)],
+                        args=[raw, settings.chatroom_cache_ttl, generation or b""],
+                    )
+                except RedisError:
+                    pass
+            result = (CachedChatrooms(raw), False)
+        if _inflight.get(user_id) is future:  # no write-through happened meanwhile
+            _set_local(user_id, result[0])
+        future.set_result(result)
+        return result
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        if _inflight.get(user_id) is future:
+            del _inflight[user_id]
+
+
+async def aupdate_cached_chatrooms(user_id: int, change: Callable[[list], list]):
+    """
+    Write-through: apply `change` to the cached list (if there is one) instead
+    of dropping it, then tell the other processes to drop their L1 copy.
+    """
+    key = _key(user_id)
+    entry = None
+    _inflight.pop(user_id, None)  # a load already running must not fill L1 with the old list
+    try:
+        # ...nor Redis: loaders only store if the generation is unchanged
+        generation = _generation_key(user_id)
+        async with async_redis_bytes.pipeline(transaction=False) as pipe:
+            pipe.incr(generation)
+            pipe.expire(generation, settings.chatroom_cache_ttl)
+            await pipe.execute()
+        async with async_redis_bytes.pipeline(transaction=True) as pipe:
+            for _ in range(WRITE_THROUGH_ATTEMPTS):
+                try:
+                    await pipe.watch(key)
+                    raw = await pipe.get(key)
+                    if raw is None:
+                        break  # nothing cached; the next read loads it
+                    rows = change(orjson.loads(raw))
+                    entry = CachedChatrooms(orjson.dumps(rows), rows)
+                    pipe.multi()
+                    pipe.set(key, entry.raw, ex=settings.chatroom_cache_ttl)
+                    await pipe.execute()
+                    break
+                except WatchError:
+                    entry = None  # raced with another writer; re-read
+            else:
+                await async_redis_bytes.delete(key)
+    except (RedisError, orjson.JSONDecodeError):
+        entry = None
+        await adelete_cached_chatrooms(user_id)
+
+    _set_local(user_id, entry)
+    await invalidation.apublish(CHATROOMS_CACHE, str(user_id))
@@ -1,18 +1,42 @@
 from fastapi import Depends, Header
 from fastapi import HTTPException, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from .database import get_db
+from .database import get_db, get_async_db
 from .auth import decode_token
 from . import models
+from .principals import Principal, get_principal, aget_principal
 
-def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)) -> models.User:
+def _load_principal(db: Session, sub: str):
+    user = db.query(models.User).filter(models.User.mobile == sub).first()
+    return Principal.from_user(user) if user else None
+
+async def _aload_principal(db: AsyncSession, sub: str):
+    user = (await db.scalars(select(models.User).where(models.User.mobile == sub))).first()
+    return Principal.from_user(user) if user else None
+
+def _token_subject(authorization: str) -> str:
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Missing bearer token")
     token = authorization.split(" ", 1)[1]
     sub = decode_token(token)
     if not sub:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
-    user = db.query(models.User).filter(models.User.mobile == sub).first()
-    if not user:
+    return sub
+
+def get_current_user(authorization: str = Header(None), db: Session = Depends(get_db)) -> Principal:
+    sub = _token_subject(authorization)
+    principal = get_principal(sub, lambda: _load_principal(db, sub))
+    if not principal:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
+    return principal
+
+async def get_current_user_async(
+    authorization: str = Header(None), db: AsyncSession = Depends(get_async_db)
+) -> Principal:
+    sub = _token_subject(authorization)
+    principal = await aget_principal(sub, lambda: _aload_principal(db, sub))
+    if not principal:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
-    return user
+    return principal
@@ -0,0 +1,152 @@
+"""
+Conditional GETs and compression for the polled chatroom reads.
+
+Each chatroom list (per user) and each chatroom's messages have a version
+token in Redis, replaced with a fresh random value whenever they change: a
+chatroom is created, or a message is stored. The ETag of
+`GET /chatroom` and `GET /chatroom/{id}` is built from that token (plus the
+query), so a matching `If-None-Match` is answered with 304 after one Redis
+read, before anything is loaded or serialized.
+
+Tokens are read before the body is loaded. A response can then only carry a
+token older than its content, which costs the client one extra full
+response, never a stale 304. A missing token is simply recreated, and since
+tokens are random, an old ETag can never match it. Tokens expire with the
+cache entries they stand for (CHATROOM_CACHE_TTL, RECENT_MESSAGES_TTL), so a
+change missed during a Redis outage can't pin a 304 for longer than that.
+Without Redis, responses carry no ETag.
+"""
+import hashlib
+import uuid
+from typing import Optional
+
+from fastapi import Request, Response
+from loguru import logger
+from redis.exceptions import RedisError
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware, GZipResponder
+
+from .config import settings
+from .redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+def _list_key(user_id: int) -> str:
+    return f"chatrooms:{user_id}:etag"
+
+
+def _room_key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:etag"
+
+
+def _new_token() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def queue_room_change(pipe, chatroom_id: int):
+    """A message was stored in the room; queue the token change on `pipe`."""
+    pipe.set(_room_key(chatroom_id), _new_token(), ex=settings.recent_messages_ttl)
+
+
+def drop_room_token(chatroom_id: int):
+    """
+    The pipeline carrying `queue_room_change` failed: delete the token so the
+    old ETag stops matching (the next read issues a fresh one).
+    """
+    try:
+        redis_client.delete(_room_key(chatroom_id))
+    except RedisError as e:
+        logger.warning(f"Chatroom {chatroom_id} ETag not invalidated. err={e}")
+
+
+async def adrop_room_token(chatroom_id: int):
+    try:
+        await async_redis_client.delete(_room_key(chatroom_id))
+    except RedisError as e:
+        logger.warning(f"Chatroom {chatroom_id} ETag not invalidated. err={e}")
+
+
+async def achatrooms_changed(user_id: int):
+    try:
+        await async_redis_client.set(_list_key(user_id), _new_token(), ex=settings.chatroom_cache_ttl)
+    except RedisError as e:
+        # The old token would keep matching; drop it so it can't
+        try:
+            await async_redis_client.delete(_list_key(user_id))
+        except RedisError:
+            logger.warning(f"Chatroom list ETag not invalidated for user {user_id}. err={e}")
+
+
+async def _atoken(key: str, ttl: int) -> Optional[str]:
+    try:
+        token = await async_redis_client.get(key)
+        if token is None:
+            await async_redis_client.set(key, _new_token(), ex=ttl, nx=True)
+            token = await async_redis_client.get(key)
+        return token
+    except RedisError as e:
+        logger.warning(f"ETag token unavailable. err={e}")
+        return None
+
+
+def _etag(token: str, *parts) -> str:
+    digest = hashlib.sha1("|".join(map(str, (token,) + parts)).encode("utf-8")).hexdigest()[:20]
+    # Weak: the same representation may go out gzip-encoded or not
+    return f'W/"{digest}"'
+
+
+async def achatrooms_etag(user_id: int) -> Optional[str]:
+    token = await _atoken(_list_key(user_id), settings.chatroom_cache_ttl)
+    return _etag(token, "chatrooms", user_id) if token else None
+
+
+async def aroom_etag(chatroom_id: int, *query) -> Optional[str]:
+    token = await _atoken(_room_key(chatroom_id), settings.recent_messages_ttl)
+    return _etag(token, "chatroom", chatroom_id, *query) if token else None
+
+
+def headers(etag: Optional[str]) -> Optional[dict]:
+    # Per-user data: browsers may keep it, but must revalidate on every use
+    return {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else None
+
+
+def _opaque(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(request: Request, etag: Optional[str]) -> Optional[Response]:
+    """A 304 when the request's If-None-Match matches `etag` (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return None
+    if header.strip() == "*" or _opaque(etag) in {_opaque(t) for t in header.split(",")}:
+        return Response(status_code=304, headers=headers(etag))
+    return None
+
+
+class _Responder(GZipResponder):
+    async def send_with_gzip(self, message):
+        await super().send_with_gzip(message)
+        if message["type"] == "http.response.start":
+            # Pass SSE through as if already encoded: gzip would hold events back
+            content_type = Headers(raw=message["headers"]).get("content-type", "")
+            self.content_encoding_set |= content_type.startswith("text/event-stream")
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    gzip for response bodies of at least GZIP_MINIMUM_SIZE bytes. Event streams
+    (by content type, whatever the route) are passed through untouched, since
+    compressing them would buffer events.
+    """
+
+    def __init__(self, app):
+        super().__init__(app, minimum_size=settings.gzip_minimum_size, compresslevel=settings.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and "gzip" in Headers(scope=scope).get("Accept-Encoding", ""):
+            responder = _Responder(self.app, self.minimum_size, compresslevel=self.compresslevel)
+            return await responder(scope, receive, send)
+        return await self.app(scope, receive, send)
@@ -0,0 +1,183 @@
+"""
+Idempotency-Key support for message submission.
+
+The first request with a given key claims it in Redis (a hash owned by a
+random token, short TTL). Once its message row is committed the claim
+records that (`committed`, with the message id, for IDEMPOTENCY_TTL), and
+once it has succeeded it stores its response (`done`). A repeat of the same
+request gets that stored response back and does no work. The same key sent
+with a different body is rejected, and so is a repeat that arrives while the
+first request is still running.
+
+A request that fails before its insert releases the claim, so the client's
+retry runs normally. One that fails after it (queue down, client gone)
+leaves the claim `committed` and unowned: the retry then only enqueues the
+stored message's reply. Every write is conditional on the owner token, so a
+request whose claim expired and was taken over can't clobber the new owner.
+
+Keys are scoped per user. If Redis is unavailable, requests run without the
+idempotency check.
+"""
+import hashlib
+import json
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .config import settings
+from .redis_pool import get_async_redis
+
+async_redis_client = get_async_redis()
+
+HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+
+NEW = "new"  # this request owns the key; run it
+REPLAY = "replay"  # already done; answer with `response`
+COMMITTED = "committed"  # message stored by an earlier attempt; enqueue `message_id` only
+IN_PROGRESS = "in_progress"
+MISMATCH = "mismatch"  # key reused for a different request
+UNAVAILABLE = "unavailable"  # Redis down; run without the guarantee
+
+# KEYS: claim. ARGV: fingerprint, owner, now (s), pending ttl (s).
+# A committed claim is taken over once released, or when its owner has been
+# silent for longer than the pending TTL (it died before releasing).
+_CLAIM_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  redis.call('HSET', KEYS[1], 'state', 'pending', 'fp', ARGV[1], 'owner', ARGV[2], 'at', ARGV[3])
+  redis.call('EXPIRE', KEYS[1], ARGV[4])
+  return {'new'}
+end
+local s = redis.call('HMGET', KEYS[1], 'state', 'fp', 'owner', 'at', 'message_id', 'response')
+if s[2] ~= ARGV[1] then
+  return {'mismatch'}
+end
+if s[1] == 'done' then
+  return {'replay', s[6]}
+end
+if s[1] == 'committed' and (not s[3] or tonumber(ARGV[3]) - tonumber(s[4]) > tonumber(ARGV[4])) then
+  redis.call('HSET', KEYS[1], 'owner', ARGV[2], 'at', ARGV[3])
+  return {'committed', s[5]}
+end
+return {'in_progress'}
+"""
+
+# KEYS: claim. ARGV: owner, ttl, then field/value pairs. Replaces the claim
+# unless another request owns it now.
+_STORE_LUA = """
+local owner = redis.call('HGET', KEYS[1], 'owner')
+if owner and owner ~= ARGV[1] then
+  return 0
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: claim. ARGV: owner, stored message id ('' if none), committed ttl,
+# fingerprint. Uncommitted claims are deleted; committed ones lose their owner
+# so the retry can take them over.
+_RELEASE_LUA = """
+local owner = redis.call('HGET', KEYS[1], 'owner')
+if owner and owner ~= ARGV[1] then
+  return 0
+end
+if not owner and ARGV[2] == '' then
+  return 0
+end
+if ARGV[2] ~= '' then
+  redis.call('HSET', KEYS[1], 'state', 'committed', 'fp', ARGV[4], 'message_id', ARGV[2])
+end
+if redis.call('HGET', KEYS[1], 'state') == 'committed' then
+  redis.call('HDEL', KEYS[1], 'owner')
+  redis.call('EXPIRE', KEYS[1], ARGV[3])
+else
+  redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+
+_claim = async_redis_client.register_script(_CLAIM_LUA)
+_store = async_redis_client.register_script(_STORE_LUA)
+_release = async_redis_client.register_script(_RELEASE_LUA)
+
+
+@dataclass(frozen=True)
+class Claim:
+    status: str
+    response: Optional[dict] = None
+    message_id: Optional[int] = None
+    key: Optional[str] = None
+    fp: Optional[str] = None
+    owner: Optional[str] = None
+
+
+def fingerprint(**request) -> str:
+    raw = json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _key(scope: str, user_id: int, idempotency_key: str) -> str:
+    digest = hashlib.sha256(idempotency_key.encode("utf-8")).hexdigest()[:32]
+    return f"idem:{scope}:{user_id}:{digest}"
+
+
+async def aclaim(scope: str, user_id: int, idempotency_key: str, fp: str) -> Claim:
+    key = _key(scope, user_id, idempotency_key)
+    owner = uuid.uuid4().hex
+    try:
+        result = await _claim(keys=[key], args=[fp, owner, int(time.time()), settings.idempotency_pending_ttl])
+    except RedisError as e:
+        logger.warning(f"Idempotency check unavailable. err={e}")
+        return Claim(UNAVAILABLE)
+
+    status = result[0]
+    if status == REPLAY:
+        return Claim(REPLAY, response=json.loads(result[1]))
+    if status == COMMITTED:
+        return Claim(COMMITTED, message_id=int(result[1]), key=key, fp=fp, owner=owner)
+    if status == NEW:
+        return Claim(NEW, key=key, fp=fp, owner=owner)
+    return Claim(status)
+
+
+async def acommitted(claim: Claim, message_id: int):
+    """The message row is in; a retry must not insert it again."""
+    try:
+        await _store(
+            keys=[claim.key],
+            args=[claim.owner, settings.idempotency_ttl, "state", COMMITTED, "fp", claim.fp,
+                  "owner", claim.owner, "at", int(time.time()), "message_id", message_id],
+        )
+    except RedisError as e:
+        logger.warning(f"Idempotency commit not recorded. err={e}")
+
+
+async def acomplete(claim: Claim, response: dict):
+    try:
+        await _store(
+            keys=[claim.key],
+            args=[claim.owner, settings.idempotency_ttl, "state", "done", "fp", claim.fp,
+                  "response", json.dumps(response)],
+        )
+    except RedisError as e:
+        logger.warning(f"Idempotency result not stored. err={e}")
+
+
+async def arelease(claim: Claim, message_id: Optional[int] = None):
+    """
+    Give the claim up after a failure. With `message_id` (the row was
+    committed), or once the claim is committed, the retry re-enqueues instead.
+    """
+    try:
+        await _release(
+            keys=[claim.key],
+            args=[claim.owner, message_id if message_id is not None else "", settings.idempotency_ttl, claim.fp],
+        )
+    except RedisError:
+        pass
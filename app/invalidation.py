@@ -0,0 +1,109 @@
+"""
+Cross-process invalidation for the in-process (L1) caches.
+
+A process that changes cached data publishes `{"cache": name, "key": key}` on
+one Redis channel. A daemon thread in every API process drops that entry from
+its own L1. Pub/sub is at-most-once, so every registered cache is cleared
+whenever the subscription is (re)established, and L1 TTLs stay short.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .redis_pool import get_async_redis, get_redis
+
+CHANNEL = "cache:invalidate"
+RECONNECT_DELAY = 1.0
+
+# cache name -> handler(key); key None means "drop everything"
+_handlers: Dict[str, Callable[[Optional[str]], None]] = {}
+_instance = uuid.uuid4().hex
+_listener_pid = None
+_listener_lock = threading.Lock()
+_subscribed = threading.Event()
+
+
+def _origin() -> str:
+    return f"{_instance}:{os.getpid()}"
+
+
+def register(name: str, handler: Callable[[Optional[str]], None]):
+    _handlers[name] = handler
+
+
+def active() -> bool:
+    """True while this process is subscribed; L1 caches are only safe to read then."""
+    return _listener_pid == os.getpid() and _subscribed.is_set()
+
+
+def _dispatch(name: Optional[str], key: Optional[str]):
+    for cache_name, handler in list(_handlers.items()):
+        if name is None or name == cache_name:
+            try:
+                handler(key)
+            except Exception as e:
+                logger.warning(f"Invalidation handler {cache_name} failed. err={e}")
+
+
+def _listen():
+    client = get_redis()
+    while True:
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        try:
+            pubsub.subscribe(CHANNEL)
+            _dispatch(None, None)  # whatever was published while we were away is lost
+            _subscribed.set()
+            while True:
+                msg = pubsub.get_message(timeout=1.0)
+                if not msg or msg.get("type") != "message":
+                    continue
+                try:
+                    data = json.loads(msg["data"])
+                except (TypeError, ValueError):
+                    continue
+                if data.get("origin") != _origin():
+                    _dispatch(data.get("cache"), data.get("key"))
+        except RedisError as e:
+            _subscribed.clear()
+            logger.warning(f"Invalidation subscription lost; retrying. err={e}")
+            time.sleep(RECONNECT_DELAY)
+        finally:
+            try:
+                pubsub.close()
+            except RedisError:
+                pass
+
+
+def start():
+    """Start the listener thread for this process (idempotent, fork-aware)."""
+    global _listener_pid
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        _subscribed.clear()
+        _listener_pid = os.getpid()
+        threading.Thread(target=_listen, name="cache-invalidation", daemon=True).start()
+
+
+def _message(name: str, key: Optional[str]) -> str:
+    return json.dumps({"cache": name, "key": key, "origin": _origin()})
+
+
+def publish(name: str, key: Optional[str], pipeline=None):
+    try:
+        (pipeline or get_redis()).publish(CHANNEL, _message(name, key))
+    except RedisError as e:
+        logger.warning(f"Invalidation publish failed for {name}:{key}. err={e}")
+
+
+async def apublish(name: str, key: Optional[str]):
+    try:
+        await get_async_redis().publish(CHANNEL, _message(name, key))
+    except RedisError as e:
+        logger.warning(f"Invalidation publish failed for {name}:{key}. err={e}")
@@ -1,11 +1,34 @@
-from fastapi import FastAPI
+import hmac
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import FastAPI, Header
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from .config import settings
-from .database import Base, engine
-from .routers import auth, user, chatroom, subscription
+from . import http_cache, invalidation, metrics, traffic
+from .utils import api_error, api_ok
+from .services import breaker, gemini, queue, response_cache
+from .database import async_engine, engine
+from .redis_pool import aclose_pools
+from .routers import auth, user, chatroom, jobs, subscription, health
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema changes are applied by `alembic upgrade head` (the release step), not
+    # here; pools connect on first use, so startup does no network I/O.
+    # In-process caches are only used once this process hears other processes' writes
+    invalidation.start()
+    yield
+    await async_engine.dispose()
+    engine.dispose()
+    await aclose_pools()
+    await gemini.aclose_clients()
+
 
-app = FastAPI(title=settings.app_name)
+app = FastAPI(title=settings.app_name, default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.mount("/demo", StaticFiles(directory="demo", html=True), name="demo")
 
@@ -17,14 +40,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.gzip_minimum_size > 0:
+    app.add_middleware(http_cache.CompressionMiddleware)
+
+if traffic.enabled():
+    # Outermost, so recorded timings include the other middleware
+    app.add_middleware(traffic.TrafficCapture)
 
-Base.metadata.create_all(bind=engine)
 
 app.include_router(auth.router)
 app.include_router(user.router)
 app.include_router(chatroom.router)
+app.include_router(jobs.router)
 app.include_router(subscription.router)
+app.include_router(health.router)
 
 @app.get("/")
 def root():
     return {"ok": True, "message": "Gemini Backend Clone API"}
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(authorization: Optional[str] = Header(None)):
+    # Internal only: not served without METRICS_TOKEN, then only to its bearer
+    if not settings.metrics_token:
+        return api_error("Not Found", 404)
+    expected = f"Bearer {settings.metrics_token}".encode()
+    if not hmac.compare_digest((authorization or "").encode(), expected):
+        return api_error("Not authorized", 401)
+    models = [m for m in (settings.gemini_model, settings.gemini_fallback_model) if m]
+    return api_ok({
+        **metrics.snapshot(),
+        "gemini_cache": response_cache.stats(),
+        "gemini_breakers": breaker.states(*models),
+        "queues": queue.stats(),
+    })
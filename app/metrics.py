@@ -0,0 +1,62 @@
+import os
+import threading
+from collections import Counter
+
+from redis.exceptions import RedisError
+
+from .redis_pool import get_async_redis, get_redis
+
+# Per-process counters; GET /metrics reports them with the pid so several
+# workers behind a load balancer can be told apart.
+_counters = Counter()
+_lock = threading.Lock()
+
+# Counters bumped by RQ workers, which serve no HTTP, live in one Redis hash
+SHARED_KEY = "metrics:counters"
+
+
+def incr(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def incr_shared(name: str, value: int = 1):
+    try:
+        get_redis().hincrby(SHARED_KEY, name, value)
+    except RedisError:
+        pass
+
+
+def incr_shared_many(values: dict):
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for name, value in values.items():
+                pipe.hincrby(SHARED_KEY, name, value)
+            pipe.execute()
+    except RedisError:
+        pass
+
+
+async def aincr_shared(name: str, value: int = 1):
+    try:
+        await get_async_redis().hincrby(SHARED_KEY, name, value)
+    except RedisError:
+        pass
+
+
+def shared_counters() -> dict:
+    try:
+        return {k: int(v) for k, v in get_redis().hgetall(SHARED_KEY).items()}
+    except RedisError:
+        return {}
+
+
+def ratio(hits: int, misses: int):
+    total = hits + misses
+    return round(hits / total, 4) if total else None
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+    return {"pid": os.getpid(), "counters": counters, "shared": shared_counters()}
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Enum, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Enum, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -39,6 +39,17 @@ class Message(Base):
 
     chatroom = relationship("Chatroom", back_populates="messages")
 
+    # Keyset pagination / recent-history lookups walk this index
+    __table_args__ = (Index("ix_messages_chatroom_id_id", "chatroom_id", "id"),)
+
+class ChatroomSummary(Base):
+    """Rolling summary of a chatroom's messages up to `through_message_id`."""
+    __tablename__ = "chatroom_summaries"
+    chatroom_id = Column(Integer, ForeignKey("chatrooms.id"), primary_key=True)
+    content = Column(Text, nullable=False, default="")
+    through_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class Subscription(Base):
     __tablename__ = "subscriptions"
     id = Column(Integer, primary_key=True, index=True)
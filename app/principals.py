@@ -0,0 +1,137 @@
+import json
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from cachetools import TTLCache
+from redis.exceptions import RedisError
+
+from . import invalidation
+from .config import settings
+from .models import Tier
+from .redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Authenticated user as the routes see it: a cacheable snapshot, not an ORM row."""
+    id: int
+    mobile: str
+    tier: Tier
+    created_at: datetime
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(id=user.id, mobile=user.mobile, tier=user.tier, created_at=user.created_at)
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "id": self.id,
+                "mobile": self.mobile,
+                "tier": self.tier.value,
+                "created_at": self.created_at.isoformat(),
+            }
+        )
+
+    @classmethod
+    def from_json(cls, raw: str) -> "Principal":
+        d = json.loads(raw)
+        return cls(
+            id=d["id"],
+            mobile=d["mobile"],
+            tier=Tier(d["tier"]),
+            created_at=datetime.fromisoformat(d["created_at"]),
+        )
+
+
+# L1: per-process, short TTL so other processes' invalidations are picked up quickly.
+# L2: Redis, shared by every API process.
+_local = TTLCache(maxsize=settings.principal_cache_size, ttl=settings.principal_cache_ttl)
+_local_lock = threading.Lock()
+
+
+PRINCIPALS_CACHE = "principals"
+
+
+def _drop_local(sub: Optional[str]):
+    with _local_lock:
+        if sub is None:
+            _local.clear()
+        else:
+            _local.pop(sub, None)
+
+
+invalidation.register(PRINCIPALS_CACHE, _drop_local)
+
+
+def _key(sub: str) -> str:
+    return f"principal:{sub}"
+
+
+def get_principal(sub: str, load: Callable[[], Optional[Principal]]) -> Optional[Principal]:
+    with _local_lock:
+        principal = _local.get(sub)
+    if principal is not None:
+        return principal
+
+    try:
+        raw = redis_client.get(_key(sub))
+        principal = Principal.from_json(raw) if raw else None
+    except (RedisError, ValueError, KeyError):
+        principal = None
+
+    if principal is None:
+        principal = load()
+        if principal is None:
+            return None
+        try:
+            redis_client.setex(_key(sub), settings.principal_redis_ttl, principal.to_json())
+        except RedisError:
+            pass
+
+    with _local_lock:
+        _local[sub] = principal
+    return principal
+
+
+async def aget_principal(
+    sub: str, load: Callable[[], Awaitable[Optional[Principal]]]
+) -> Optional[Principal]:
+    with _local_lock:
+        principal = _local.get(sub)
+    if principal is not None:
+        return principal
+
+    try:
+        raw = await async_redis_client.get(_key(sub))
+        principal = Principal.from_json(raw) if raw else None
+    except (RedisError, ValueError, KeyError):
+        principal = None
+
+    if principal is None:
+        principal = await load()
+        if principal is None:
+            return None
+        try:
+            await async_redis_client.setex(_key(sub), settings.principal_redis_ttl, principal.to_json())
+        except RedisError:
+            pass
+
+    with _local_lock:
+        _local[sub] = principal
+    return principal
+
+
+def invalidate_principal(sub: str):
+    # Call after the change is committed, so a concurrent miss can't re-cache the old row
+    _drop_local(sub)
+    try:
+        redis_client.delete(_key(sub))
+    except RedisError:
+        pass
+    invalidation.publish(PRINCIPALS_CACHE, sub)
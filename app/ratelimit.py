@@ -1,20 +1,295 @@
-from datetime import datetime, timedelta
-from redis import Redis
+import math
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from cachetools import TTLCache
+from loguru import logger
+from redis.exceptions import RedisError
+
 from .config import settings
+from .models import Tier
+from .redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+SLIDING_WINDOW = "sliding_window"
+TOKEN_BUCKET = "token_bucket"
+
+# Both scripts return {allowed, remaining, retry_after_ms} and do the whole
+# check-and-update (including the expiry) in one round trip.
+
+# Sliding-window counter: the previous fixed window is weighted by how much of
+# it still overlaps the sliding window. O(1) memory per key.
+_SLIDING_WINDOW_LUA = """
+local limit = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local idx = math.floor(now / window)
+local elapsed = now - idx * window
+
+local h = redis.call('HMGET', KEYS[1], 'idx', 'cur', 'prev')
+local cidx = tonumber(h[1])
+local cur = tonumber(h[2]) or 0
+local prev = tonumber(h[3]) or 0
+if cidx == nil then
+  cur, prev = 0, 0
+elseif cidx == idx - 1 then
+  cur, prev = 0, cur
+elseif cidx ~= idx then
+  cur, prev = 0, 0
+end
+
+local weighted = prev * (window - elapsed) / window + cur
+if weighted + cost > limit then
+  local retry
+  if cur + cost <= limit then
+    -- enough of the previous window slides out before this one ends
+    retry = math.ceil((weighted + cost - limit) * window / prev)
+  elseif cur > 0 then
+    -- wait for the roll-over, then for this window's count to decay as "previous"
+    retry = window - elapsed + math.ceil((cur + cost - limit) * window / cur)
+  else
+    retry = window  -- cost larger than the whole limit
+  end
+  redis.call('HSET', KEYS[1], 'idx', idx, 'cur', cur, 'prev', prev)
+  redis.call('PEXPIRE', KEYS[1], window * 2)
+  return {0, math.max(0, math.floor(limit - weighted)), retry}
+end
+
+cur = cur + cost
+redis.call('HSET', KEYS[1], 'idx', idx, 'cur', cur, 'prev', prev)
+redis.call('PEXPIRE', KEYS[1], window * 2)
+return {1, math.max(0, math.floor(limit - weighted - cost)), 0}
+"""
+
+# Token bucket: `limit` tokens of burst, refilled evenly over `window`.
+_TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+local rate = capacity / window
+
+local h = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(h[1])
+local ts = tonumber(h[2])
+if tokens == nil or ts == nil then
+  tokens, ts = capacity, now
+end
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local allowed, retry = 0, 0
+if tokens >= cost then
+  tokens = tokens - cost
+  allowed = 1
+else
+  retry = math.ceil((cost - tokens) / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], window)
+return {allowed, math.floor(tokens), retry}
+"""
+
+# Several token buckets charged all-or-nothing. KEYS: buckets. ARGV: now ms,
+# then (capacity, window ms, cost) per bucket. Returns 0 when every bucket was
+# charged, else the ms until all of them have room (nothing is taken).
+_TOKEN_BUCKETS_LUA = """
+local now = tonumber(ARGV[1])
+local levels, retry = {}, 0
+for i = 1, #KEYS do
+  local capacity, window, cost = tonumber(ARGV[i * 3 - 1]), tonumber(ARGV[i * 3]), tonumber(ARGV[i * 3 + 1])
+  local rate = capacity / window
+  local h = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+  local tokens, ts = tonumber(h[1]), tonumber(h[2])
+  if tokens == nil or ts == nil then
+    tokens, ts = capacity, now
+  end
+  tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+  if tokens < cost then
+    retry = math.max(retry, math.ceil((cost - tokens) / rate))
+  end
+  levels[i] = tokens
+end
+for i = 1, #KEYS do
+  local tokens = levels[i]
+  if retry == 0 then
+    tokens = tokens - tonumber(ARGV[i * 3 + 1])
+  end
+  redis.call('HSET', KEYS[i], 'tokens', tostring(tokens), 'ts', now)
+  redis.call('PEXPIRE', KEYS[i], ARGV[i * 3])
+end
+return retry
+"""
+
+_consume_all = redis_client.register_script(_TOKEN_BUCKETS_LUA)
+_aconsume_all = async_redis_client.register_script(_TOKEN_BUCKETS_LUA)
+
+_async_scripts = {
+    SLIDING_WINDOW: async_redis_client.register_script(_SLIDING_WINDOW_LUA),
+    TOKEN_BUCKET: async_redis_client.register_script(_TOKEN_BUCKET_LUA),
+}
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    limit: int
+    window_seconds: int
+    strategy: str = SLIDING_WINDOW
+
+
+@dataclass(frozen=True)
+class RateLimitResult:
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float  # seconds; 0 when allowed
+
+
+def policy_for(tier: Tier) -> Optional[RateLimitPolicy]:
+    """Prompt policy for a plan, or None when the plan is unlimited (limit <= 0)."""
+    if tier == Tier.PRO:
+        limit, window = settings.rate_limit_pro_limit, settings.rate_limit_pro_window
+    else:
+        limit, window = settings.rate_limit_basic_limit, settings.rate_limit_basic_window
+    if limit <= 0:
+        return None
+    return RateLimitPolicy(limit=limit, window_seconds=window, strategy=settings.rate_limit_strategy)
+
+
+class _LocalLimiter:
+    """
+    Same algorithms kept in process memory, used while Redis is unreachable.
+    Per-process, so the effective cluster limit is looser, but it stays bounded
+    instead of failing open; the key count is capped by an LRU/TTL cache.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._state = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, policy: RateLimitPolicy, cost: int, now_ms: int) -> RateLimitResult:
+        window = policy.window_seconds * 1000
+        with self._lock:
+            if policy.strategy == TOKEN_BUCKET:
+                rate = policy.limit / window
+                tokens, ts = self._state.get(key, (float(policy.limit), now_ms))
+                tokens = min(policy.limit, tokens + max(0, now_ms - ts) * rate)
+                if tokens >= cost:
+                    self._state[key] = (tokens - cost, now_ms)
+                    return RateLimitResult(True, policy.limit, int(tokens - cost), 0)
+                self._state[key] = (tokens, now_ms)
+                return RateLimitResult(False, policy.limit, int(tokens), (cost - tokens) / rate / 1000)
+
+            idx, elapsed = divmod(now_ms, window)
+            cidx, cur, prev = self._state.get(key, (idx, 0, 0))
+            if cidx == idx - 1:
+                cur, prev = 0, cur
+            elif cidx != idx:
+                cur, prev = 0, 0
+            weighted = prev * (window - elapsed) / window + cur
+            if weighted + cost > policy.limit:
+                self._state[key] = (idx, cur, prev)
+                if cur + cost <= policy.limit:
+                    retry_ms = (weighted + cost - policy.limit) * window / prev
+                elif cur > 0:
+                    retry_ms = window - elapsed + (cur + cost - policy.limit) * window / cur
+                else:
+                    retry_ms = window
+                remaining = max(0, int(policy.limit - weighted))
+                return RateLimitResult(False, policy.limit, remaining, retry_ms / 1000)
+            self._state[key] = (idx, cur + cost, prev)
+            return RateLimitResult(True, policy.limit, max(0, int(policy.limit - weighted - cost)), 0)
+
+    def consume_all(self, buckets, now_ms: int) -> float:
+        with self._lock:
+            levels, retry = [], 0.0
+            for key, policy, cost in buckets:
+                rate = policy.limit / (policy.window_seconds * 1000)
+                tokens, ts = self._state.get(key, (float(policy.limit), now_ms))
+                tokens = min(policy.limit, tokens + max(0, now_ms - ts) * rate)
+                if tokens < cost:
+                    retry = max(retry, (cost - tokens) / rate / 1000)
+                levels.append(tokens)
+            for (key, _, cost), tokens in zip(buckets, levels):
+                self._state[key] = (tokens - cost if retry == 0 else tokens, now_ms)
+            return retry
+
+
+_local = _LocalLimiter(
+    maxsize=settings.rate_limit_local_max_keys,
+    ttl=2 * max(settings.rate_limit_basic_window, settings.rate_limit_pro_window),
+)
+
+
+def _key(name: str) -> str:
+    return f"ratelimit:{name}"
+
+
+def _result(policy: RateLimitPolicy, raw) -> RateLimitResult:
+    allowed, remaining, retry_ms = (int(v) for v in raw)
+    return RateLimitResult(bool(allowed), policy.limit, remaining, retry_ms / 1000)
+
+
+async def aconsume(name: str, policy: RateLimitPolicy, cost: int = 1) -> RateLimitResult:
+    now_ms = int(time.time() * 1000)
+    try:
+        raw = await _async_scripts[policy.strategy](
+            keys=[_key(name)], args=[policy.limit, policy.window_seconds * 1000, now_ms, cost]
+        )
+        return _result(policy, raw)
+    except RedisError as e:
+        logger.warning(f"Rate-limit store unavailable; using local limiter. err={e}")
+        return _local.consume(name, policy, cost, now_ms)
+
+
+def _prompt_key(user_id: int) -> str:
+    return f"user:{user_id}:prompts"
+
+
+async def acheck_prompt_limit(user_id: int, tier: Tier) -> Optional[RateLimitResult]:
+    policy = policy_for(tier)
+    return await aconsume(_prompt_key(user_id), policy) if policy else None
+
+
+def retry_after_header(result: RateLimitResult) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(result.retry_after)))}
+
+
+def _bucket_args(buckets, now_ms: int) -> Tuple[list, list]:
+    keys, args = [], [now_ms]
+    for name, policy, cost in buckets:
+        keys.append(_key(name))
+        args += [policy.limit, policy.window_seconds * 1000, cost]
+    return keys, args
+
+
+def consume_all(buckets: List[Tuple[str, RateLimitPolicy, int]]) -> float:
+    """
+    Charge several token buckets (name, policy, cost) together: either all of
+    them or none. Returns 0 when charged, else seconds until all have room.
+    """
+    if not buckets:
+        return 0.0
+    now_ms = int(time.time() * 1000)
+    try:
+        keys, args = _bucket_args(buckets, now_ms)
+        return int(_consume_all(keys=keys, args=args)) / 1000
+    except RedisError as e:
+        logger.warning(f"Rate-limit store unavailable; using local limiter. err={e}")
+        return _local.consume_all(buckets, now_ms)
+
 
-redis_client = Redis.from_url(settings.redis_url, decode_responses=True)
-
-def today_key(user_id: int) -> str:
-    today = datetime.utcnow().strftime("%Y-%m-%d")
-    return f"user:{user_id}:daily_prompts:{today}"
-
-def increment_and_check(user_id: int, limit: int) -> bool:
-    key = today_key(user_id)
-    val = redis_client.incr(key)
-    
-    if val == 1:
-       
-        tomorrow = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
-        ttl = int((tomorrow - datetime.utcnow()).total_seconds())
-        redis_client.expire(key, ttl)
-    return val <= limit
+async def aconsume_all(buckets: List[Tuple[str, RateLimitPolicy, int]]) -> float:
+    if not buckets:
+        return 0.0
+    now_ms = int(time.time() * 1000)
+    try:
+        keys, args = _bucket_args(buckets, now_ms)
+        return int(await _aconsume_all(keys=keys, args=args)) / 1000
+    except RedisError as e:
+        logger.warning(f"Rate-limit store unavailable; using local limiter. err={e}")
+        return _local.consume_all(buckets, now_ms)
@@ -0,0 +1,81 @@
+import threading
+from contextlib import contextmanager
+
+from redis import BlockingConnectionPool, Redis
+from redis.asyncio import BlockingConnectionPool as AsyncBlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+
+from .config import settings
+
+# One pool per (flavour) per process instead of one per module. redis-py pools
+# notice a fork and reset themselves, so RQ work-horses get fresh sockets.
+_pools = {}
+_async_pools = {}
+_lock = threading.Lock()
+
+
+def _pool_options(blocking: bool) -> dict:
+    return {
+        "max_connections": settings.redis_max_connections,
+        "timeout": settings.redis_pool_timeout,
+        # Blocking commands (BLPOP in the worker) must outlive the socket timeout
+        "socket_timeout": None if blocking else settings.redis_socket_timeout,
+        "socket_connect_timeout": settings.redis_socket_connect_timeout,
+        "health_check_interval": settings.redis_health_check_interval,
+        "retry_on_timeout": not blocking,
+    }
+
+
+def get_redis(decode_responses: bool = True, blocking: bool = False) -> Redis:
+    """
+    Shared sync client. RQ needs `decode_responses=False`; the worker's
+    dequeue loop needs `blocking=True` (no socket read timeout).
+    """
+    key = (decode_responses, blocking)
+    pool = _pools.get(key)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = BlockingConnectionPool.from_url(
+                    settings.redis_url, decode_responses=decode_responses, **_pool_options(blocking)
+                )
+                _pools[key] = pool
+    return Redis(connection_pool=pool)
+
+
+def get_async_redis(decode_responses: bool = True, pubsub: bool = False) -> AsyncRedis:
+    """
+    Shared asyncio client. Every pub/sub subscription (SSE, long-poll) pins a
+    connection for its lifetime, so those get their own, larger pool.
+    """
+    key = (decode_responses, pubsub)
+    pool = _async_pools.get(key)
+    if pool is None:
+        options = _pool_options(blocking=False)
+        if pubsub:
+            options["max_connections"] = settings.redis_pubsub_max_connections
+        pool = AsyncBlockingConnectionPool.from_url(
+            settings.redis_url, decode_responses=decode_responses, **options
+        )
+        _async_pools[key] = pool
+    return AsyncRedis(connection_pool=pool)
+
+
+async def aclose_pools():
+    """Close this process's asyncio pools (on shutdown; they reopen on next use)."""
+    pools = list(_async_pools.values())
+    _async_pools.clear()
+    for pool in pools:
+        await pool.disconnect()
+
+
+@contextmanager
+def redis_pipeline(decode_responses: bool = True, transaction: bool = False):
+    """
+    Collect one request's Redis writes from several modules (queue, caches,
+    counters) and send them in a single round trip when the block exits.
+    """
+    with get_redis(decode_responses).pipeline(transaction=transaction) as pipe:
+        yield pipe
+        pipe.execute()
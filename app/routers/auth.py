@@ -6,6 +6,7 @@ from ..schemas import SignupRequest, SendOtpRequest, VerifyOtpRequest, ChangePas
 from ..auth import issue_otp, verify_otp, create_access_token, hash_password, verify_password
 from ..utils import api_ok, api_error
 from ..deps import get_current_user
+from ..principals import invalidate_principal
 from pydantic import BaseModel
 from typing import Optional
 
@@ -19,7 +20,7 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 def signup(body: SignupIn, db: Session = Depends(get_db)):
     user = db.query(models.User).filter_by(mobile=body.mobile).first()
     if not user:
-        user = models.User(mobile=body.mobile, tier="basic")
+        user = models.User(mobile=body.mobile, tier=models.Tier.BASIC)
         db.add(user)
     else:
         if body.name: user.name = body.name
@@ -52,7 +53,10 @@ def forgot_password(body: SendOtpRequest):
 
 @router.post("/change-password")
 def change_password(body: ChangePasswordRequest, current=Depends(get_current_user), db: Session = Depends(get_db)):
-    current.password_hash = hash_password(body.new_password)
-    db.add(current)
+    user = db.get(models.User, current.id)
+    if not user:
+        api_error("User not found", 404)
+    user.password_hash = hash_password(body.new_password)
     db.commit()
+    invalidate_principal(user.mobile)
     return api_ok(message="Password changed")
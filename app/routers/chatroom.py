@@ -1,123 +1,285 @@
+import asyncio
+import json
 from datetime import datetime
-from fastapi import APIRouter, Depends
+from typing import Optional
+import orjson
+from fastapi import APIRouter, Depends, Header, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from redis.exceptions import RedisError
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from loguru import logger
 from ..config import settings
 
-from ..deps import get_current_user
-from .. import models
+from ..deps import get_current_user_async
+from .. import http_cache, idempotency, models
 from ..models import Tier
-from ..database import get_db
+from ..database import get_async_db
 from ..schemas import (
     ChatroomCreate,
     ChatroomOut,
     ChatroomDetail,
     MessageCreate,
+    MessageOut,
+    chatrooms_json,
+    messages_json,
 )
-from ..utils import api_ok, api_error
-from ..services.queue import gemini_queue
-from ..cache import get_cached_chatrooms, set_cached_chatrooms, delete_cached_chatrooms
-from ..ratelimit import increment_and_check  
+from ..utils import api_ok, api_ok_response, api_error
+from ..services.queue import enqueue_gemini_message, priority_class
+from ..services.events import subscribe, next_event
+from ..services.history import afetch_message_page
+from ..services import recent
+from ..cache import aget_chatrooms, aupdate_cached_chatrooms
+from ..ratelimit import acheck_prompt_limit, retry_after_header
+from ..redis_pool import redis_pipeline
 
 router = APIRouter(prefix="/chatroom", tags=["chatroom"])
 
 @router.post("")
-def create_chatroom(
+async def create_chatroom(
     body: ChatroomCreate,
-    current=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
     cr = models.Chatroom(user_id=current.id, title=body.title)
     db.add(cr)
-    db.commit()
-    db.refresh(cr)
+    await db.commit()
+    await db.refresh(cr)
 
-    # Bust per-user cache
-    delete_cached_chatrooms(current.id)
+    out = ChatroomOut.model_validate(cr).model_dump(mode="json")
+    # Newest first, same order as list_chatrooms
+    await aupdate_cached_chatrooms(current.id, lambda rows: [out] + [r for r in rows if r["id"] != cr.id])
+    await http_cache.achatrooms_changed(current.id)
 
-    return api_ok(
-        {"chatroom": ChatroomOut.model_validate(cr).model_dump(mode="json")},
-        "Chatroom created",
-    )
+    return api_ok({"chatroom": out}, "Chatroom created")
+
+def _chatroom_loader(db: AsyncSession, user_id: int):
+    async def load():
+        rows = (
+            await db.scalars(
+                select(models.Chatroom)
+                .where(models.Chatroom.user_id == user_id)
+                .order_by(models.Chatroom.created_at.desc())
+            )
+        ).all()
+        return chatrooms_json(rows)
+
+    return load
 
 @router.get("")
-def list_chatrooms(
-    current=Depends(get_current_user),
-    db: Session = Depends(get_db),
+async def list_chatrooms(
+    request: Request,
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    cached = get_cached_chatrooms(current.id)  
-    if cached is not None:
-        return {"ok": True, "message": "ok (cache)", "data": {"chatrooms": cached}}
-
-    rows = (
-        db.query(models.Chatroom)
-        .filter(models.Chatroom.user_id == current.id)
-        .order_by(models.Chatroom.created_at.desc())
-        .all()
+    """Supports If-None-Match: an unchanged list is a 304 after one Redis read."""
+    etag = await http_cache.achatrooms_etag(current.id)
+    unchanged = http_cache.not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    entry, cached = await aget_chatrooms(current.id, _chatroom_loader(db, current.id))
+    # The cached bytes are embedded as-is, never decoded
+    return api_ok_response(
+        {"chatrooms": orjson.Fragment(entry.raw)},
+        "ok (cache)" if cached else "ok",
+        headers=http_cache.headers(etag),
     )
-    payload = [ChatroomOut.model_validate(r).model_dump(mode="json") for r in rows]
-    set_cached_chatrooms(current.id, payload, ttl_seconds=600)  # no-throw
-    return {"ok": True, "message": "ok", "data": {"chatrooms": payload}}
+
+async def _get_owned_chatroom(db: AsyncSession, chatroom_id: int, user_id: int):
+    return (
+        await db.scalars(
+            select(models.Chatroom).where(
+                models.Chatroom.id == chatroom_id,
+                models.Chatroom.user_id == user_id,
+            )
+        )
+    ).first()
+
+async def _get_owned_chatroom_cached(db: AsyncSession, chatroom_id: int, user_id: int):
+    # The cached chatroom list doubles as the ownership check for hot reads
+    entry, _ = await aget_chatrooms(user_id, _chatroom_loader(db, user_id))
+    for row in entry.rows:
+        if row["id"] == chatroom_id:
+            return ChatroomOut.model_validate(row)
+    return await _get_owned_chatroom(db, chatroom_id, user_id)
 
 @router.get("/{chatroom_id}")
-def get_chatroom(
+async def get_chatroom(
+    request: Request,
     chatroom_id: int,
-    current=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    limit: Optional[int] = Query(None, ge=1, le=settings.message_page_max),
+    before_id: Optional[int] = Query(None, ge=1),
+    after_id: Optional[int] = Query(None, ge=0),
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    cr = (
-        db.query(models.Chatroom)
-        .filter(
-            models.Chatroom.id == chatroom_id,
-            models.Chatroom.user_id == current.id,
-        )
-        .first()
-    )
+    cr = await _get_owned_chatroom_cached(db, chatroom_id, current.id)
     if not cr:
         return api_error("Chatroom not found", 404)
 
+    limit = limit or settings.message_page_size
+    # Before any message is loaded, so an unchanged room costs one Redis read
+    etag = await http_cache.aroom_etag(cr.id, limit, before_id, after_id)
+    unchanged = http_cache.not_modified(request, etag)
+    if unchanged is not None:
+        return unchanged
+    latest = before_id is None and after_id is None
+    cached = await recent.aget_page(cr.id, limit) if latest else None
+    if cached is not None:
+        messages, has_more = cached
+    else:
+        messages, has_more = await afetch_message_page(
+            db, cr.id, limit, before_id=before_id, after_id=after_id
+        )
+        if latest:
+            await recent.arehydrate(cr.id, messages, complete=not has_more)
+
     detail = ChatroomDetail.model_validate(
         {
             "id": cr.id,
             "title": cr.title,
             "created_at": cr.created_at,
-            "messages": cr.messages,
+            "messages": messages,
         }
     )
-    return api_ok({"chatroom": detail.model_dump(mode="json")})
+    page = {
+        "limit": limit,
+        "has_more": has_more,
+        # Pass back as before_id to go further back, or as after_id to fetch newer
+        "next_before_id": messages[0].id if messages else before_id,
+        "next_after_id": messages[-1].id if messages else after_id,
+    }
+    return api_ok_response(
+        {"chatroom": orjson.Fragment(detail.model_dump_json()), "page": page},
+        headers=http_cache.headers(etag),
+    )
 
-@router.post("/{chatroom_id}/message")
-def send_message(
+async def _reply_events(chatroom_id: int):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.stream_timeout_seconds
+    async with subscribe(chatroom_id) as pubsub:
+        yield ": connected\n\n"
+        while loop.time() < deadline:
+            timeout = min(settings.stream_keepalive_seconds, deadline - loop.time())
+            event = await next_event(pubsub, timeout=timeout)
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {event.get('type', 'message')}\ndata: {json.dumps(event)}\n\n"
+            if event.get("type") == "message" and event.get("role") == "assistant":
+                return
+        yield 'event: timeout\ndata: {"type": "timeout"}\n\n'
+
+@router.get("/{chatroom_id}/stream")
+async def stream_chatroom(
     chatroom_id: int,
-    body: MessageCreate,
-    current=Depends(get_current_user),
-    db: Session = Depends(get_db),
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
 ):
-    cr = (
-        db.query(models.Chatroom)
-        .filter(
-            models.Chatroom.id == chatroom_id,
-            models.Chatroom.user_id == current.id,
-        )
-        .first()
+    """
+    Server-Sent Events feed of the next assistant reply in this chatroom.
+
+    Open the stream before POSTing the message: `chunk` events carry text as
+    Gemini produces it, and the stream ends with the stored `message` event.
+    """
+    cr = await _get_owned_chatroom(db, chatroom_id, current.id)
+    # Don't pin a pooled connection for the lifetime of the stream
+    await db.close()
+    if not cr:
+        return api_error("Chatroom not found", 404)
+
+    return StreamingResponse(
+        _reply_events(chatroom_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
+
+async def _wait_for_new_message(pubsub, timeout: float) -> bool:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return False
+        event = await next_event(pubsub, timeout=remaining)
+        if event is None:
+            return False
+        if event.get("type") == "message":
+            return True
+
+@router.get("/{chatroom_id}/messages")
+async def wait_for_messages(
+    chatroom_id: int,
+    since_id: int = Query(0, ge=0),
+    wait: float = Query(0, ge=0, le=settings.long_poll_max_wait_seconds),
+    limit: Optional[int] = Query(None, ge=1, le=settings.message_page_max),
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Messages newer than `since_id`. Returns at once when there are any;
+    otherwise parks for up to `wait` seconds until the worker signals a new
+    message. No DB connection is held while parked.
+    """
+    limit = limit or settings.message_page_size
+    cr = await _get_owned_chatroom(db, chatroom_id, current.id)
     if not cr:
+        await db.close()
         return api_error("Chatroom not found", 404)
 
-    if current.tier == Tier.BASIC:
+    async def _fetch():
         try:
-            dev_limit = 50 if settings.app_env == "dev" else 5
-            allowed = increment_and_check(current.id, limit=dev_limit)
-        except Exception as e: 
-            logger.warning(f"Rate-limit unavailable; allowing request. err={e}")
-            allowed = True
-
-        if not allowed:
-            return api_error(
-                "Daily prompt limit reached for Basic plan. Upgrade to Pro.",
-                429,
-            )
+            return await afetch_message_page(db, chatroom_id, limit, after_id=since_id)
+        finally:
+            await db.close()
+
+    try:
+        # Subscribe before the first read so a reply landing in between isn't missed
+        async with subscribe(chatroom_id) as pubsub:
+            messages, has_more = await _fetch()
+            if not messages and wait > 0 and await _wait_for_new_message(pubsub, wait):
+                messages, has_more = await _fetch()
+    except RedisError as e:
+        logger.warning(f"Long-poll unavailable; answering immediately. err={e}")
+        messages, has_more = await _fetch()
+
+    return api_ok_response(
+        {
+            "messages": orjson.Fragment(messages_json(messages)),
+            "page": {
+                "limit": limit,
+                "has_more": has_more,
+                "next_after_id": messages[-1].id if messages else since_id,
+            },
+        }
+    )
+
+def _queue_reply(chatroom_id: int, user_msg: MessageOut, use_cache: bool, current):
+    # Every Redis write that follows the insert goes out in one round trip
+    with redis_pipeline(decode_responses=False) as pipe:
+        job = enqueue_gemini_message(
+            chatroom_id,
+            user_msg.id,
+            use_cache=use_cache,
+            pipeline=pipe,
+            user_id=current.id,
+            priority=priority_class(current.tier),
+        )
+        recent.append_message(chatroom_id, user_msg, pipeline=pipe)
+        http_cache.queue_room_change(pipe, chatroom_id)
+    return job
+
+
+async def _insert_message(cr, body: MessageCreate, current, db: AsyncSession, on_commit=None) -> MessageOut:
+    limited = await acheck_prompt_limit(current.id, current.tier)
+    if limited is not None and not limited.allowed:
+        message = (
+            "Prompt limit reached for Basic plan. Upgrade to Pro."
+            if current.tier == Tier.BASIC
+            else "Prompt limit reached, please try again later."
+        )
+        return api_error(message, 429, headers=retry_after_header(limited))
 
     user_msg = models.Message(
         chatroom_id=cr.id,
@@ -125,20 +287,92 @@ def send_message(
         content=body.content,
     )
     db.add(user_msg)
-    db.commit()
-    db.refresh(user_msg)
+    await db.commit()
+    if on_commit is not None:
+        await on_commit(user_msg.id)
+    await db.refresh(user_msg)
+    return MessageOut.model_validate(user_msg)
 
 
+async def _enqueue_reply(cr, user_msg: MessageOut, body: MessageCreate, current):
     try:
-        job = gemini_queue.enqueue(
-            "worker_tasks.handle_gemini_message",
-            cr.id,
-            user_msg.id,
-        )
+        # RQ is sync-only; keep its Redis round trip off the event loop
+        job = await run_in_threadpool(_queue_reply, cr.id, user_msg, not body.bypass_cache, current)
         return api_ok(
             {"message_id": user_msg.id, "job_id": job.get_id()},
             "Message queued",
         )
     except RedisError as e:
         logger.exception("Queue enqueue failed")
+        # The message is stored but may be missing from the recent buffer,
+        # and the room's ETag wasn't rotated
+        await recent.adelete(cr.id)
+        await http_cache.adrop_room_token(cr.id)
         return api_error("Queue unavailable, please try again later.", 503)
+
+
+async def _submit_once(cr, body: MessageCreate, current, db: AsyncSession, claim: idempotency.Claim):
+    if claim.status == idempotency.COMMITTED:
+        # An earlier attempt stored the message but never queued its reply
+        stored = await db.get(models.Message, claim.message_id)
+        user_msg = MessageOut.model_validate(stored)
+    else:
+        committed = {}
+
+        async def _committed(message_id: int):
+            committed["id"] = message_id
+            await idempotency.acommitted(claim, message_id)
+
+        try:
+            user_msg = await _insert_message(cr, body, current, db, on_commit=_committed)
+        except BaseException:
+            # Failed before the row was stored (rate limit, DB error): let the
+            # retry run for real; after it, the retry only enqueues
+            await asyncio.shield(idempotency.arelease(claim, committed.get("id")))
+            raise
+    try:
+        result = await _enqueue_reply(cr, user_msg, body, current)
+    except BaseException:
+        # Queue down or client gone: the row is in, so a retry only enqueues
+        await asyncio.shield(idempotency.arelease(claim, user_msg.id))
+        raise
+    await idempotency.acomplete(claim, result)
+    return result
+
+
+@router.post("/{chatroom_id}/message")
+async def send_message(
+    chatroom_id: int,
+    body: MessageCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(
+        None, alias=idempotency.HEADER, max_length=idempotency.MAX_KEY_LENGTH
+    ),
+    current=Depends(get_current_user_async),
+    db: AsyncSession = Depends(get_async_db),
+):
+    """
+    Store the message and queue its Gemini reply. With an `Idempotency-Key`
+    header, a retry of the same request returns the original
+    message_id/job_id without inserting or enqueueing again; if the first
+    attempt stored the message but couldn't queue it, the retry only queues it.
+    """
+    cr = await _get_owned_chatroom(db, chatroom_id, current.id)
+    if not cr:
+        return api_error("Chatroom not found", 404)
+
+    if idempotency_key:
+        fp = idempotency.fingerprint(chatroom_id=cr.id, content=body.content, bypass_cache=body.bypass_cache)
+        claim = await idempotency.aclaim("message", current.id, idempotency_key, fp)
+        if claim.status == idempotency.REPLAY:
+            response.headers["Idempotent-Replayed"] = "true"
+            return claim.response
+        if claim.status == idempotency.IN_PROGRESS:
+            return api_error("A request with this Idempotency-Key is still in progress", 409)
+        if claim.status == idempotency.MISMATCH:
+            return api_error("This Idempotency-Key was already used for a different request", 422)
+        if claim.status != idempotency.UNAVAILABLE:
+            return await _submit_once(cr, body, current, db, claim)
+
+    user_msg = await _insert_message(cr, body, current, db)
+    return await _enqueue_reply(cr, user_msg, body, current)
@@ -0,0 +1,41 @@
+from fastapi import APIRouter
+from fastapi.responses import ORJSONResponse
+from loguru import logger
+from redis.exceptions import RedisError
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from ..database import async_engine
+from ..redis_pool import get_async_redis
+from ..utils import api_ok
+
+router = APIRouter(prefix="/health", tags=["health"])
+
+
+@router.get("/live")
+def live():
+    # Process is up and serving; touches nothing else, so a DB/Redis outage doesn't restart it
+    return api_ok({"status": "live"})
+
+
+@router.get("/ready")
+async def ready():
+    """Take traffic only once Postgres and Redis answer; 503 (with the failing checks) until then."""
+    checks = {}
+    try:
+        async with async_engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+        checks["database"] = "ok"
+    except (SQLAlchemyError, OSError) as e:
+        logger.warning(f"Readiness: database unavailable. err={e}")
+        checks["database"] = "unavailable"
+    try:
+        await get_async_redis().ping()
+        checks["redis"] = "ok"
+    except RedisError as e:
+        logger.warning(f"Readiness: redis unavailable. err={e}")
+        checks["redis"] = "unavailable"
+
+    if all(v == "ok" for v in checks.values()):
+        return api_ok({"status": "ready", "checks": checks})
+    return ORJSONResponse({"ok": False, "message": "Not ready", "data": {"status": "not_ready", "checks": checks}}, status_code=503)
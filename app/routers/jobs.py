@@ -0,0 +1,47 @@
+from fastapi import APIRouter, Depends, Query
+from fastapi.concurrency import run_in_threadpool
+from loguru import logger
+from redis.exceptions import RedisError
+
+from ..deps import get_current_user_async
+from ..services.jobs import get_statuses
+from ..utils import api_ok, api_error
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+MAX_BATCH = 100
+
+
+async def _statuses(job_ids, user_id: int):
+    try:
+        # RQ is sync-only; keep its Redis round trips off the event loop
+        return await run_in_threadpool(get_statuses, job_ids, user_id)
+    except RedisError as e:
+        logger.warning(f"Job status unavailable. err={e}")
+        api_error("Job status unavailable, please try again later.", 503)
+
+
+@router.get("")
+async def get_jobs(
+    ids: str = Query(..., description="Comma-separated job ids from POST /chatroom/{id}/message"),
+    current=Depends(get_current_user_async),
+):
+    """Status of several reply jobs at once; unknown or foreign ids map to null."""
+    job_ids = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if not job_ids:
+        return api_error("No job ids given", 400)
+    if len(job_ids) > MAX_BATCH:
+        return api_error(f"At most {MAX_BATCH} job ids per request", 400)
+    return api_ok({"jobs": await _statuses(job_ids, current.id)})
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, current=Depends(get_current_user_async)):
+    """
+    State (queued/started/finished/failed), queue position, timings and the
+    assistant message id of one reply job.
+    """
+    status = (await _statuses([job_id], current.id))[job_id]
+    if status is None:
+        return api_error("Job not found", 404)
+    return api_ok({"job": status})
@@ -1,9 +1,9 @@
 from fastapi import APIRouter, Depends, Request, Header, HTTPException
 from sqlalchemy.orm import Session
-import stripe
 
 from ..config import settings
 from ..deps import get_current_user
+from ..principals import invalidate_principal
 from ..database import get_db, SessionLocal
 from .. import models
 from ..schemas import SubscriptionStatus
@@ -11,7 +11,13 @@ from ..utils import api_ok, api_error
 
 router = APIRouter(prefix="", tags=["subscription"])
 
-stripe.api_key = settings.stripe_secret_key
+
+def _stripe():
+    # Imported on first use: the SDK is a large share of the app's import time
+    import stripe
+
+    stripe.api_key = settings.stripe_secret_key
+    return stripe
 
 
 @router.post("/subscribe/pro")
@@ -19,6 +25,7 @@ def subscribe_pro(current=Depends(get_current_user)):
     if not settings.stripe_price_id_pro:
         api_error("Stripe price not configured", 400)
 
+    stripe = _stripe()
     session = stripe.checkout.Session.create(
         mode="subscription",
         line_items=[{"price": settings.stripe_price_id_pro, "quantity": 1}],
@@ -35,6 +42,7 @@ def subscribe_pro(current=Depends(get_current_user)):
 async def stripe_webhook(request: Request):
     payload = await request.body()
     sig = request.headers.get("stripe-signature")
+    stripe = _stripe()
 
     try:
         event = stripe.Webhook.construct_event(
@@ -55,6 +63,7 @@ async def stripe_webhook(request: Request):
                 if user:
                     user.tier = models.Tier.PRO
                     db.commit()
+                    invalidate_principal(user.mobile)
             finally:
                 db.close()
 
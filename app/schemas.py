@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
@@ -46,6 +46,8 @@ class ChatroomOut(BaseModel):
 
 class MessageCreate(BaseModel):
     content: str
+    # Ask Gemini again even if an identical prompt has a cached reply
+    bypass_cache: bool = False
 
 class MessageOut(BaseModel):
     id: int
@@ -63,6 +65,17 @@ class ChatroomDetail(BaseModel):
     class Config:
         from_attributes = True
 
+# Lists serialized straight to JSON bytes in one pydantic-core pass, without
+# building a dict per row first
+_chatroom_list = TypeAdapter(List[ChatroomOut])
+_message_list = TypeAdapter(List[MessageOut])
+
+def chatrooms_json(rows) -> bytes:
+    return _chatroom_list.dump_json(_chatroom_list.validate_python(rows, from_attributes=True))
+
+def messages_json(rows) -> bytes:
+    return _message_list.dump_json(_message_list.validate_python(rows, from_attributes=True))
+
 class SubscriptionStatus(BaseModel):
     tier: Tier
     status: str
@@ -0,0 +1,207 @@
+"""
+Per-model circuit breaker for Gemini, shared by every process through Redis.
+
+Each call's outcome is counted in a window of GEMINI_BREAKER_WINDOW seconds.
+An outcome is a failure if the call hit a 429/5xx, a connection error or a
+timeout, or if it took longer than GEMINI_BREAKER_SLOW_SECONDS to answer.
+Once the window holds at least GEMINI_BREAKER_MIN_CALLS calls and the failure
+share reaches GEMINI_BREAKER_FAILURE_RATIO, the model's breaker opens. While
+it is open, calls are refused at once for GEMINI_BREAKER_OPEN_SECONDS. After
+that the breaker is half-open: a single probe call goes through, and its
+outcome closes the breaker or opens it again. `allow` hands each call a
+permit to pass back to `record`; the probe's is a token of its own, and while
+the breaker is tripped only the outcome carrying that token counts. Calls
+that started before the trip can't close it.
+
+If Redis is unreachable the breaker lets every call through.
+"""
+import uuid
+from typing import Dict, Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .. import metrics
+from ..config import settings
+from ..redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+TRIPPED_TTL = 86400  # a breaker nobody probes for a day starts over closed
+
+# KEYS: open, tripped, probe. ARGV: probe lease ms, probe token.
+# 1 = closed, 2 = this call is the half-open probe, 0 = refused.
+_ALLOW_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  return 0
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+  return 1
+end
+if redis.call('SET', KEYS[3], ARGV[2], 'NX', 'PX', ARGV[1]) then
+  return 2
+end
+return 0
+"""
+
+# KEYS: stats, open, tripped, probe. ARGV: ok (1/0), window s, min calls,
+# failure ratio, open ms, tripped ttl s, permit. Returns the transition, if
+# any. Once tripped, only the current probe's outcome is counted.
+_RECORD_LUA = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+  if redis.call('GET', KEYS[4]) ~= ARGV[7] then
+    return ''
+  end
+  if ARGV[1] == '1' then
+    redis.call('DEL', KEYS[1], KEYS[3], KEYS[4])
+    return 'closed'
+  end
+  redis.call('SET', KEYS[2], '1', 'PX', ARGV[5])
+  redis.call('DEL', KEYS[4])
+  return ''
+end
+local total = redis.call('HINCRBY', KEYS[1], 'total', 1)
+local bad = tonumber(redis.call('HGET', KEYS[1], 'bad') or '0')
+if ARGV[1] ~= '1' then
+  bad = redis.call('HINCRBY', KEYS[1], 'bad', 1)
+end
+if total == 1 then
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if total >= tonumber(ARGV[3]) and bad / total >= tonumber(ARGV[4]) then
+  redis.call('SET', KEYS[2], '1', 'PX', ARGV[5])
+  redis.call('SET', KEYS[3], '1', 'EX', ARGV[6])
+  redis.call('DEL', KEYS[1])
+  return 'opened'
+end
+return ''
+"""
+
+_allow = redis_client.register_script(_ALLOW_LUA)
+_aallow = async_redis_client.register_script(_ALLOW_LUA)
+_record = redis_client.register_script(_RECORD_LUA)
+_arecord = async_redis_client.register_script(_RECORD_LUA)
+
+
+class CircuitOpen(Exception):
+    """Every configured Gemini model has an open breaker."""
+
+
+def enabled() -> bool:
+    return settings.gemini_breaker_min_calls > 0
+
+
+def _keys(model: str) -> list:
+    prefix = f"gemini:breaker:{model}"
+    return [f"{prefix}:open", f"{prefix}:tripped", f"{prefix}:probe"]
+
+
+def _probe_ms() -> int:
+    # Long enough for the probe call to finish or time out
+    return int((settings.gemini_connect_timeout + settings.gemini_read_timeout + 5) * 1000)
+
+
+def _record_args(ok: bool, elapsed: float, permit: str) -> list:
+    ok = ok and elapsed <= settings.gemini_breaker_slow_seconds
+    return [
+        1 if ok else 0,
+        settings.gemini_breaker_window,
+        settings.gemini_breaker_min_calls,
+        settings.gemini_breaker_failure_ratio,
+        int(settings.gemini_breaker_open_seconds * 1000),
+        TRIPPED_TTL,
+        permit,
+    ]
+
+
+def _permit(allowed: int, token: str) -> Optional[str]:
+    return CLOSED if allowed == 1 else token if allowed == 2 else None
+
+
+def _transition(model: str, result) -> str:
+    result = result.decode() if isinstance(result, bytes) else (result or "")
+    if result == "opened":
+        logger.warning(f"Gemini circuit opened for {model}")
+    elif result == "closed":
+        logger.info(f"Gemini circuit closed for {model}")
+    return result
+
+
+def allow(model: str) -> Optional[str]:
+    """
+    A permit for one call to `model` (pass it to `record`), or None when the
+    circuit refuses the call.
+    """
+    if not enabled():
+        return CLOSED
+    token = uuid.uuid4().hex
+    try:
+        permit = _permit(_allow(keys=_keys(model), args=[_probe_ms(), token]), token)
+    except RedisError as e:
+        logger.warning(f"Breaker state unavailable; allowing call. err={e}")
+        return CLOSED
+    if permit is None:
+        metrics.incr_shared(f"gemini.breaker_rejected.{model}")
+    return permit
+
+
+async def aallow(model: str) -> Optional[str]:
+    if not enabled():
+        return CLOSED
+    token = uuid.uuid4().hex
+    try:
+        permit = _permit(await _aallow(keys=_keys(model), args=[_probe_ms(), token]), token)
+    except RedisError as e:
+        logger.warning(f"Breaker state unavailable; allowing call. err={e}")
+        return CLOSED
+    if permit is None:
+        await metrics.aincr_shared(f"gemini.breaker_rejected.{model}")
+    return permit
+
+
+def record(model: str, ok: bool, elapsed: float, permit: str = CLOSED):
+    """
+    Count one call's outcome; `elapsed` is seconds until Gemini answered and
+    `permit` what `allow` returned for the call.
+    """
+    if not enabled():
+        return
+    try:
+        result = _record(
+            keys=[f"gemini:breaker:{model}:stats", *_keys(model)], args=_record_args(ok, elapsed, permit)
+        )
+    except RedisError:
+        return
+    if _transition(model, result) == "opened":
+        metrics.incr_shared(f"gemini.breaker_opened.{model}")
+
+
+async def arecord(model: str, ok: bool, elapsed: float, permit: str = CLOSED):
+    if not enabled():
+        return
+    try:
+        result = await _arecord(
+            keys=[f"gemini:breaker:{model}:stats", *_keys(model)], args=_record_args(ok, elapsed, permit)
+        )
+    except RedisError:
+        return
+    if _transition(model, result) == "opened":
+        await metrics.aincr_shared(f"gemini.breaker_opened.{model}")
+
+
+def states(*models: str) -> Dict[str, str]:
+    """Current state per model, for /metrics."""
+    out = {}
+    for model in models:
+        try:
+            is_open, tripped, _ = (redis_client.exists(k) for k in _keys(model))
+        except RedisError:
+            out[model] = "unknown"
+            continue
+        out[model] = OPEN if is_open else HALF_OPEN if tripped else CLOSED
+    return out
@@ -0,0 +1,60 @@
+"""
+Token budget for the history sent to Gemini.
+
+Token counts are estimated at ~4 characters per token, the same rule the
+governor uses to reserve TPM budget, so no tokenizer call is needed.
+"""
+from typing import List, Optional
+
+from ..config import settings
+
+CHARS_PER_TOKEN = 4
+TRUNCATED = " …[truncated]"
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    return len(text or "") // CHARS_PER_TOKEN + 1
+
+
+def clip(text: str, max_tokens: int) -> str:
+    """Cut `text` to about `max_tokens`, keeping the start."""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if max_tokens <= 0 or len(text) <= limit:
+        return text
+    return text[: max(0, limit - len(TRUNCATED))] + TRUNCATED
+
+
+def _role_and_content(m):
+    if isinstance(m, dict):
+        return m.get("role", "") or "", m.get("content", "") or ""
+    return getattr(m, "role", "") or "", getattr(m, "content", "") or ""
+
+
+def clip_prompt(user_text: str) -> str:
+    """The new turn, cut to GEMINI_PROMPT_MAX_TOKENS."""
+    return clip(user_text or "", settings.gemini_prompt_max_tokens)
+
+
+def fit_history(history, summary: Optional[str] = None, user_text: Optional[str] = None) -> List[dict]:
+    """
+    The newest messages of `history` (oldest-first) that fit in
+    GEMINI_CONTEXT_TOKENS after the summary and the new turn (`user_text`),
+    at most GEMINI_HISTORY_MESSAGES of them, each clipped to
+    GEMINI_CONTEXT_MESSAGE_MAX_TOKENS. Returned oldest-first as
+    {"role", "content"} dicts; applying it twice is a no-op.
+    """
+    if not history or settings.gemini_history_messages <= 0:
+        return []
+    budget = settings.gemini_context_tokens - (estimate_tokens(summary) if summary else 0)
+    budget -= estimate_tokens(user_text) if user_text else 0
+    kept = []
+    for m in reversed(list(history)[-settings.gemini_history_messages:]):
+        role, content = _role_and_content(m)
+        content = clip(content, settings.gemini_context_message_max_tokens)
+        cost = estimate_tokens(content)
+        if settings.gemini_context_tokens > 0 and cost > budget:
+            break
+        budget -= cost
+        kept.append({"role": role, "content": content})
+    kept.reverse()
+    return kept
@@ -0,0 +1,62 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from ..redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+pubsub_client = get_async_redis(pubsub=True)
+
+
+def channel(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:events"
+
+
+def publish_event(chatroom_id: int, event: dict) -> None:
+    # Fire-and-forget: nobody listening is fine, Redis being down must not fail the job
+    try:
+        redis_client.publish(channel(chatroom_id), json.dumps(event))
+    except RedisError as e:
+        logger.warning(f"Event publish failed for chatroom {chatroom_id}. err={e}")
+
+
+async def apublish_event(chatroom_id: int, event: dict) -> None:
+    try:
+        await async_redis_client.publish(channel(chatroom_id), json.dumps(event))
+    except RedisError as e:
+        logger.warning(f"Event publish failed for chatroom {chatroom_id}. err={e}")
+
+
+@asynccontextmanager
+async def subscribe(chatroom_id: int):
+    pubsub = pubsub_client.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(channel(chatroom_id))
+    try:
+        yield pubsub
+    finally:
+        try:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+        except RedisError:
+            pass
+
+
+async def next_event(pubsub, timeout: float) -> Optional[dict]:
+    """Wait up to `timeout` seconds for the next event on a subscription."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        msg = await pubsub.get_message(timeout=remaining)
+        if msg and msg.get("type") == "message":
+            try:
+                return json.loads(msg["data"])
+            except (TypeError, json.JSONDecodeError):
+                continue
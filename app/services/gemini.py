@@ -1,13 +1,20 @@
 # app/services/gemini.py
+import hashlib
+import json
 import os
+import threading
+import time
+import asyncio
+import unicodedata
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, Tuple
 import httpx
 from loguru import logger
 from ..config import settings
+from . import breaker, governor, response_cache
+from .context import estimate_tokens, fit_history
 
-GEN_URL = (
-    f"https://generativelanguage.googleapis.com/v1beta/models/"
-    f"{settings.gemini_model}:generateContent"
-)
+API_BASE = settings.gemini_base_url
 
 # (Optional) quick dev toggle to prove pipeline without calling Gemini
 USE_ECHO = os.getenv("USE_ECHO_AI", "").strip() == "1"
@@ -18,33 +25,90 @@ SYSTEM_PROMPT = (
     "Use prior messages in this chat for context."
 )
 
-def _build_contents(history, user_text: str):
+SUMMARY_PREAMBLE = "Summary of the earlier part of this chat:"
+
+NO_TEXT_REPLY = "Sorry, I couldn’t generate a response."
+ERROR_REPLY = "Gemini API error, please try again later."
+UNAVAILABLE_REPLY = "Gemini is temporarily unavailable, please try again shortly."
+
+# Process-wide pooled clients. Keep-alive (and HTTP/2 multiplexing) means a job
+# reuses an open TLS connection instead of paying a handshake per message.
+_client: Optional[httpx.Client] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+_async_client_pid: Optional[int] = None
+
+def _build_contents(history, user_text: str, summary: Optional[str] = None):
     contents = []
-    if history:
-        for m in history[-10:]:
-            if isinstance(m, dict):
-                role_val = m.get("role", "")
-                content_val = m.get("content", "")
-            else:
-                role_val = getattr(m, "role", "") or ""
-                content_val = getattr(m, "content", "") or ""
-            role = "user" if role_val.lower() == "user" else "model"
-            contents.append({"role": role, "parts": [{"text": content_val}]})
+    # Newest history that fits the token budget left after the summary and
+    # the new turn (the worker already clipped it to GEMINI_PROMPT_MAX_TOKENS)
+    for m in fit_history(history, summary, user_text):
+        role = "user" if m["role"].lower() == "user" else "model"
+        contents.append({"role": role, "parts": [{"text": m["content"]}]})
     contents.append({"role": "user", "parts": [{"text": user_text or ""}]})
     return contents
 
-def generate_gemini_response(user_text: str, history=None) -> str:
-    if USE_ECHO:
-        return f"ECHO: {user_text}"
-
-    headers = {
+def _headers():
+    return {
         "x-goog-api-key": settings.gemini_api_key,
         "Content-Type": "application/json",
     }
-    payload = {
-        "contents": _build_contents(history, user_text),
+
+def _client_options() -> dict:
+    return {
+        "headers": _headers(),
+        "http2": settings.gemini_http2,
+        "limits": httpx.Limits(
+            max_connections=settings.gemini_max_connections,
+            max_keepalive_connections=settings.gemini_max_keepalive_connections,
+            keepalive_expiry=settings.gemini_keepalive_expiry,
+        ),
+        "timeout": httpx.Timeout(
+            settings.gemini_read_timeout,
+            connect=settings.gemini_connect_timeout,
+        ),
+    }
+
+def get_client() -> httpx.Client:
+    global _client, _client_pid
+    # A forked child (RQ's default Worker) must not reuse the parent's sockets
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = httpx.Client(**_client_options())
+                _client_pid = os.getpid()
+    return _client
+
+def get_async_client() -> httpx.AsyncClient:
+    global _async_client, _async_client_pid
+    if _async_client is None or _async_client_pid != os.getpid():
+        _async_client = httpx.AsyncClient(**_client_options())
+        _async_client_pid = os.getpid()
+    return _async_client
+
+def close_clients():
+    global _client
+    if _client is not None:
+        _client.close()
+        _client = None
+
+async def aclose_clients():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+def _system_prompt(summary: Optional[str]) -> str:
+    if not summary:
+        return SYSTEM_PROMPT
+    return f"{SYSTEM_PROMPT}\n\n{SUMMARY_PREAMBLE}\n{summary}"
+
+def _payload(user_text: str, history, summary: Optional[str] = None):
+    return {
+        "contents": _build_contents(history, user_text, summary),
         # System instruction helps reduce generic greetings
-        "systemInstruction": {"role": "system", "parts": [{"text": SYSTEM_PROMPT}]},
+        "systemInstruction": {"role": "system", "parts": [{"text": _system_prompt(summary)}]},
         "generationConfig": {
             "temperature": 0.7,
             "topP": 0.9,
@@ -52,21 +116,255 @@ def generate_gemini_response(user_text: str, history=None) -> str:
         },
     }
 
+def _estimate_tokens(payload: dict) -> int:
+    # Estimated prompt tokens plus the reply budget
+    texts = [p.get("text", "") for c in payload["contents"] for p in c["parts"]]
+    texts += [p["text"] for p in payload["systemInstruction"]["parts"]]
+    return sum(estimate_tokens(t) for t in texts) + payload["generationConfig"]["maxOutputTokens"]
+
+def _url(model: str, stream: bool) -> str:
+    if stream:
+        return f"{API_BASE}/{model}:streamGenerateContent?alt=sse"
+    return f"{API_BASE}/{model}:generateContent"
+
+def _models():
+    models = [settings.gemini_model]
+    if settings.gemini_fallback_model and settings.gemini_fallback_model != settings.gemini_model:
+        models.append(settings.gemini_fallback_model)
+    return models
+
+def _pick_model() -> Tuple[str, str]:
+    """
+    The primary model, or the fallback while the primary's circuit is open,
+    with the breaker permit for the call.
+    """
+    for model in _models():
+        permit = breaker.allow(model)
+        if permit:
+            return model, permit
+    raise breaker.CircuitOpen("Gemini circuit open for " + ", ".join(_models()))
+
+async def _apick_model() -> Tuple[str, str]:
+    for model in _models():
+        permit = await breaker.aallow(model)
+        if permit:
+            return model, permit
+    raise breaker.CircuitOpen("Gemini circuit open for " + ", ".join(_models()))
+
+@contextmanager
+def _governed(payload: dict, stream: bool = False):
+    """
+    Open a Gemini request once the breaker and governor allow it, retrying
+    429/5xx and connection errors with backoff. Yields a successful,
+    still-open response and the model that answered. Errors raised after
+    that (mid-stream) are not retried.
+    """
+    tokens = _estimate_tokens(payload)
+    attempt = 0
+    while True:
+        model, permit = _pick_model()
+        t0 = time.monotonic()
+        delay = None
+        started = False
+        try:
+            with governor.slot(tokens):
+                t0 = time.monotonic()
+                with get_client().stream("POST", _url(model, stream), json=payload) as resp:
+                    failed = resp.status_code in governor.RETRYABLE_STATUSES
+                    breaker.record(model, not failed, time.monotonic() - t0, permit)
+                    if failed and attempt < settings.gemini_max_retries:
+                        delay = governor.record_failure(resp.status_code, resp.headers.get("retry-after"), attempt)
+                    else:
+                        resp.raise_for_status()
+                        governor.record_success()
+                        started = True
+                        yield resp, model
+                        return
+        except httpx.TransportError:
+            if started:
+                raise
+            breaker.record(model, False, time.monotonic() - t0, permit)
+            if attempt >= settings.gemini_max_retries:
+                raise
+            delay = governor.record_failure(None, None, attempt)
+        logger.warning(f"Gemini request to {model} failed transiently; retry {attempt + 1} in {delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
+
+@asynccontextmanager
+async def _agoverned(payload: dict, stream: bool = False):
+    tokens = _estimate_tokens(payload)
+    attempt = 0
+    while True:
+        model, permit = await _apick_model()
+        t0 = time.monotonic()
+        delay = None
+        started = False
+        try:
+            async with governor.aslot(tokens):
+                t0 = time.monotonic()
+                async with get_async_client().stream("POST", _url(model, stream), json=payload) as resp:
+                    failed = resp.status_code in governor.RETRYABLE_STATUSES
+                    await breaker.arecord(model, not failed, time.monotonic() - t0, permit)
+                    if failed and attempt < settings.gemini_max_retries:
+                        delay = await governor.arecord_failure(
+                            resp.status_code, resp.headers.get("retry-after"), attempt
+                        )
+                    else:
+                        resp.raise_for_status()
+                        await governor.arecord_success()
+                        started = True
+                        yield resp, model
+                        return
+        except httpx.TransportError:
+            if started:
+                raise
+            await breaker.arecord(model, False, time.monotonic() - t0, permit)
+            if attempt >= settings.gemini_max_retries:
+                raise
+            delay = await governor.arecord_failure(None, None, attempt)
+        logger.warning(f"Gemini request to {model} failed transiently; retry {attempt + 1} in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        attempt += 1
+
+def _normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text or "").split()).casefold()
+
+def cache_key(user_text: str, history=None, summary: Optional[str] = None) -> str:
+    """
+    Hash of the request as Gemini would see it (model, system prompt,
+    generation config, history window, user text), with texts normalized so
+    case/whitespace variants of the same prompt share an entry.
+    """
+    payload = _payload(user_text, history, summary)
+    for content in payload["contents"]:
+        for part in content["parts"]:
+            part["text"] = _normalize(part["text"])
+    raw = json.dumps({"model": settings.gemini_model, "request": payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _candidate_texts(data: dict):
+    for cand in data.get("candidates", []):
+        parts = (cand.get("content") or {}).get("parts") or []
+        for p in parts:
+            t = p.get("text")
+            if isinstance(t, str) and t:
+                yield t
+
+def _reply_text(data: dict) -> str:
+    for t in _candidate_texts(data):
+        if t.strip():
+            return t
+
+    logger.warning("Gemini returned no text candidates: {}", data)
+    return NO_TEXT_REPLY
+
+def _sse_texts(line: str):
+    if not line.startswith("data:"):
+        return
+    try:
+        data = json.loads(line[len("data:"):])
+    except json.JSONDecodeError:
+        return
+    yield from _candidate_texts(data)
+
+# `use_cache=False` skips the cache lookup (the fresh reply still replaces the
+# cached one). Only complete, successful replies from the primary model are
+# stored. With every model's circuit open the call fails fast with
+# UNAVAILABLE_REPLY.
+
+def generate_gemini_response(
+    user_text: str, history=None, use_cache: bool = True, summary: Optional[str] = None
+) -> str:
+    if USE_ECHO:
+        return f"ECHO: {user_text}"
+
+    key = cache_key(user_text, history, summary) if response_cache.enabled() else None
+    if key:
+        cached = response_cache.get(key, use_cache)
+        if cached is not None:
+            return cached
+
     try:
-        with httpx.Client(timeout=30) as client:
-            resp = client.post(GEN_URL, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-
-        for cand in data.get("candidates", []):
-            parts = (cand.get("content") or {}).get("parts") or []
-            for p in parts:
-                t = p.get("text")
-                if isinstance(t, str) and t.strip():
-                    return t
-
-        logger.warning("Gemini returned no text candidates: {}", data)
-        return "Sorry, I couldn’t generate a response."
+        with _governed(_payload(user_text, history, summary)) as (resp, model):
+            resp.read()
+            text = _reply_text(resp.json())
+    except breaker.CircuitOpen as e:
+        logger.warning(f"Gemini call refused. err={e}")
+        return UNAVAILABLE_REPLY
     except Exception as e:
         logger.exception("Gemini API error: {}", e)
-        return "Gemini API error, please try again later."
+        return ERROR_REPLY
+    if key and text != NO_TEXT_REPLY and model == settings.gemini_model:
+        response_cache.put(key, text)
+    return text
+
+def stream_gemini_response(
+    user_text: str, history=None, use_cache: bool = True, summary: Optional[str] = None
+):
+    """Yield reply text chunks as Gemini produces them (SSE `streamGenerateContent`)."""
+    if USE_ECHO:
+        yield f"ECHO: {user_text}"
+        return
+
+    key = cache_key(user_text, history, summary) if response_cache.enabled() else None
+    if key:
+        cached = response_cache.get(key, use_cache)
+        if cached is not None:
+            yield cached
+            return
+
+    chunks = []
+    try:
+        with _governed(_payload(user_text, history, summary), stream=True) as (resp, model):
+            for line in resp.iter_lines():
+                for t in _sse_texts(line):
+                    chunks.append(t)
+                    yield t
+        if not chunks:
+            logger.warning("Gemini stream returned no text candidates")
+            yield NO_TEXT_REPLY
+        elif key and model == settings.gemini_model:
+            response_cache.put(key, "".join(chunks))
+    except breaker.CircuitOpen as e:
+        logger.warning(f"Gemini call refused. err={e}")
+        yield UNAVAILABLE_REPLY
+    except Exception as e:
+        logger.exception("Gemini API stream error: {}", e)
+        # A half-streamed reply is kept as-is; only replace it when nothing arrived
+        if not chunks:
+            yield ERROR_REPLY
+
+async def astream_gemini_response(
+    user_text: str, history=None, use_cache: bool = True, summary: Optional[str] = None
+):
+    if USE_ECHO:
+        yield f"ECHO: {user_text}"
+        return
+
+    key = cache_key(user_text, history, summary) if response_cache.enabled() else None
+    if key:
+        cached = await response_cache.aget(key, use_cache)
+        if cached is not None:
+            yield cached
+            return
+
+    chunks = []
+    try:
+        async with _agoverned(_payload(user_text, history, summary), stream=True) as (resp, model):
+            async for line in resp.aiter_lines():
+                for t in _sse_texts(line):
+                    chunks.append(t)
+                    yield t
+        if not chunks:
+            logger.warning("Gemini stream returned no text candidates")
+            yield NO_TEXT_REPLY
+        elif key and model == settings.gemini_model:
+            await response_cache.aput(key, "".join(chunks))
+    except breaker.CircuitOpen as e:
+        logger.warning(f"Gemini call refused. err={e}")
+        yield UNAVAILABLE_REPLY
+    except Exception as e:
+        logger.exception("Gemini API stream error: {}", e)
+        if not chunks:
+            yield ERROR_REPLY
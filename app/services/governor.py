@@ -0,0 +1,291 @@
+"""
+Cluster-wide governor for Gemini calls.
+
+Before each request a worker takes, via Redis:
+- a concurrency slot (GEMINI_MAX_CONCURRENCY), a lease in a ZSET so a dead
+  worker's slot frees itself;
+- one request from the requests-per-minute bucket (GEMINI_RPM);
+- the request's estimated tokens from the tokens-per-minute bucket
+  (GEMINI_TPM).
+Both buckets are charged in one atomic call, all or nothing, so a job
+waiting on TPM doesn't drain the RPM bucket with every retry.
+
+A 429 starts a shared cooldown (from Retry-After) and shrinks a shared
+budget factor applied to both buckets. Successful calls grow it back.
+Transient failures are retried with full-jitter exponential backoff.
+If Redis is unreachable the governor gets out of the way: the rate limiter
+falls back to per-process buckets and slots are not enforced.
+"""
+import asyncio
+import random
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from .. import metrics
+from ..config import settings
+from ..ratelimit import TOKEN_BUCKET, RateLimitPolicy, aconsume_all, consume_all
+from ..redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+SLOTS_KEY = "gemini:governor:slots"
+STATE_KEY = "gemini:governor:state"
+COOLDOWN_KEY = "gemini:governor:cooldown"
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+SLOT_POLL_SECONDS = 0.2
+SLOT_LEASE_SECONDS = 300  # outlives any single call; frees the slot of a dead worker
+
+# KEYS: slots zset. ARGV: now ms, lease ms, max slots, token. 1 when taken.
+_ACQUIRE_SLOT_LUA = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+  return 0
+end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), ARGV[4])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# KEYS: state hash. ARGV: multiplier, increment, floor. factor' = clamp(f*m + i).
+_ADJUST_LUA = """
+local f = tonumber(redis.call('HGET', KEYS[1], 'factor')) or 1
+f = math.min(1, math.max(tonumber(ARGV[3]), f * tonumber(ARGV[1]) + tonumber(ARGV[2])))
+redis.call('HSET', KEYS[1], 'factor', tostring(f))
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(f)
+"""
+
+_acquire_slot = redis_client.register_script(_ACQUIRE_SLOT_LUA)
+_aacquire_slot = async_redis_client.register_script(_ACQUIRE_SLOT_LUA)
+_adjust = redis_client.register_script(_ADJUST_LUA)
+_aadjust = async_redis_client.register_script(_ADJUST_LUA)
+
+
+class GovernorTimeout(Exception):
+    """No Gemini capacity within GEMINI_GOVERNOR_MAX_WAIT seconds."""
+
+
+def _policies(factor: float, tokens: int):
+    out = []
+    if settings.gemini_rpm > 0:
+        out.append((
+            "gemini:rpm",
+            RateLimitPolicy(max(1, int(settings.gemini_rpm * factor)), 60, TOKEN_BUCKET),
+            1,
+        ))
+    if settings.gemini_tpm > 0:
+        policy = RateLimitPolicy(max(1, int(settings.gemini_tpm * factor)), 60, TOKEN_BUCKET)
+        out.append(("gemini:tpm", policy, min(tokens, policy.limit)))
+    return out
+
+
+def _slot_args(token: str) -> list:
+    return [int(time.time() * 1000), SLOT_LEASE_SECONDS * 1000, settings.gemini_max_concurrency, token]
+
+
+def _state(cooldown_ms, factor) -> tuple:
+    return (max(0, int(cooldown_ms or 0)) / 1000, float(factor) if factor else 1.0)
+
+
+# ---- sync ----
+
+def _read_state():
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.pttl(COOLDOWN_KEY)
+            pipe.hget(STATE_KEY, "factor")
+            return _state(*pipe.execute())
+    except RedisError as e:
+        logger.warning(f"Governor state unavailable. err={e}")
+        return 0.0, 1.0
+
+
+def _take_slot(token: str) -> bool:
+    if settings.gemini_max_concurrency <= 0:
+        return True
+    try:
+        return bool(_acquire_slot(keys=[SLOTS_KEY], args=_slot_args(token)))
+    except RedisError as e:
+        logger.warning(f"Governor slots unavailable; not enforcing concurrency. err={e}")
+        return True
+
+
+def _free_slot(token: str):
+    if settings.gemini_max_concurrency <= 0:
+        return
+    try:
+        redis_client.zrem(SLOTS_KEY, token)
+    except RedisError:
+        pass
+
+
+def _try_acquire(token: str, tokens: int) -> float:
+    """0 when a slot and budget were taken, else seconds to wait before retrying."""
+    cooldown, factor = _read_state()
+    if cooldown > 0:
+        return cooldown
+    if not _take_slot(token):
+        return SLOT_POLL_SECONDS
+    retry_after = consume_all(_policies(factor, tokens))
+    if retry_after > 0:
+        _free_slot(token)
+        return max(retry_after, 0.05)
+    return 0.0
+
+
+@contextmanager
+def slot(tokens: int):
+    """Hold one Gemini request's worth of capacity for the body of the block."""
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.gemini_governor_max_wait
+    while True:
+        wait = _try_acquire(token, tokens)
+        if wait <= 0:
+            break
+        if time.monotonic() + wait > deadline:
+            metrics.incr_shared("gemini.governor_timeouts")
+            raise GovernorTimeout(f"no Gemini capacity within {settings.gemini_governor_max_wait}s")
+        time.sleep(wait + random.uniform(0, SLOT_POLL_SECONDS))
+    try:
+        yield
+    finally:
+        _free_slot(token)
+
+
+def record_success():
+    if settings.gemini_budget_recovery <= 0:
+        return
+    try:
+        _adjust(keys=[STATE_KEY], args=[1, settings.gemini_budget_recovery, settings.gemini_budget_min_factor])
+    except RedisError:
+        pass
+
+
+def record_failure(status: Optional[int], retry_after_header: Optional[str], attempt: int) -> float:
+    """Note a transient failure; returns how long to back off before the next attempt."""
+    metrics.incr_shared("gemini.retries")
+    retry_after = parse_retry_after(retry_after_header)
+    if status == 429:
+        metrics.incr_shared("gemini.throttled")
+        cooldown = retry_after or backoff(attempt)
+        try:
+            redis_client.set(COOLDOWN_KEY, 1, px=max(1, int(cooldown * 1000)))
+            _adjust(keys=[STATE_KEY], args=[0.5, 0, settings.gemini_budget_min_factor])
+        except RedisError:
+            pass
+    return max(retry_after or 0, backoff(attempt))
+
+
+# ---- async ----
+
+async def _aread_state():
+    try:
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            pipe.pttl(COOLDOWN_KEY)
+            pipe.hget(STATE_KEY, "factor")
+            return _state(*(await pipe.execute()))
+    except RedisError as e:
+        logger.warning(f"Governor state unavailable. err={e}")
+        return 0.0, 1.0
+
+
+async def _atake_slot(token: str) -> bool:
+    if settings.gemini_max_concurrency <= 0:
+        return True
+    try:
+        return bool(await _aacquire_slot(keys=[SLOTS_KEY], args=_slot_args(token)))
+    except RedisError as e:
+        logger.warning(f"Governor slots unavailable; not enforcing concurrency. err={e}")
+        return True
+
+
+async def _afree_slot(token: str):
+    if settings.gemini_max_concurrency <= 0:
+        return
+    try:
+        await async_redis_client.zrem(SLOTS_KEY, token)
+    except RedisError:
+        pass
+
+
+async def _atry_acquire(token: str, tokens: int) -> float:
+    cooldown, factor = await _aread_state()
+    if cooldown > 0:
+        return cooldown
+    if not await _atake_slot(token):
+        return SLOT_POLL_SECONDS
+    retry_after = await aconsume_all(_policies(factor, tokens))
+    if retry_after > 0:
+        await _afree_slot(token)
+        return max(retry_after, 0.05)
+    return 0.0
+
+
+@asynccontextmanager
+async def aslot(tokens: int):
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.gemini_governor_max_wait
+    while True:
+        wait = await _atry_acquire(token, tokens)
+        if wait <= 0:
+            break
+        if time.monotonic() + wait > deadline:
+            await metrics.aincr_shared("gemini.governor_timeouts")
+            raise GovernorTimeout(f"no Gemini capacity within {settings.gemini_governor_max_wait}s")
+        await asyncio.sleep(wait + random.uniform(0, SLOT_POLL_SECONDS))
+    try:
+        yield
+    finally:
+        await asyncio.shield(_afree_slot(token))
+
+
+async def arecord_success():
+    if settings.gemini_budget_recovery <= 0:
+        return
+    try:
+        await _aadjust(keys=[STATE_KEY], args=[1, settings.gemini_budget_recovery, settings.gemini_budget_min_factor])
+    except RedisError:
+        pass
+
+
+async def arecord_failure(status: Optional[int], retry_after_header: Optional[str], attempt: int) -> float:
+    await metrics.aincr_shared("gemini.retries")
+    retry_after = parse_retry_after(retry_after_header)
+    if status == 429:
+        await metrics.aincr_shared("gemini.throttled")
+        cooldown = retry_after or backoff(attempt)
+        try:
+            await async_redis_client.set(COOLDOWN_KEY, 1, px=max(1, int(cooldown * 1000)))
+            await _aadjust(keys=[STATE_KEY], args=[0.5, 0, settings.gemini_budget_min_factor])
+        except RedisError:
+            pass
+    return max(retry_after or 0, backoff(attempt))
+
+
+# ---- helpers ----
+
+def backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff for retry number `attempt` (0-based)."""
+    ceiling = min(settings.gemini_backoff_max, settings.gemini_backoff_base * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
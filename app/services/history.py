@@ -0,0 +1,96 @@
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from .. import models
+
+
+def _page_stmt(chatroom_id: int, limit: int, before_id: Optional[int], after_id: Optional[int]):
+    stmt = select(models.Message).where(models.Message.chatroom_id == chatroom_id)
+    if before_id is not None:
+        stmt = stmt.where(models.Message.id < before_id)
+    if after_id is not None:
+        stmt = stmt.where(models.Message.id > after_id)
+        return stmt.order_by(models.Message.id.asc()).limit(limit + 1)
+    return stmt.order_by(models.Message.id.desc()).limit(limit + 1)
+
+
+def _to_page(rows, limit: int, newest_first: bool) -> Tuple[List[models.Message], bool]:
+    has_more = len(rows) > limit
+    rows = list(rows[:limit])
+    return (list(reversed(rows)) if newest_first else rows), has_more
+
+
+def fetch_message_page(
+    db: Session,
+    chatroom_id: int,
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> Tuple[List[models.Message], bool]:
+    """
+    Keyset page of a chatroom's messages, returned oldest-first.
+
+    Walks the (chatroom_id, id) index: newest `limit` messages by default,
+    older ones with `before_id`, newer ones with `after_id`. The flag says
+    whether more rows exist in the direction of travel.
+    """
+    rows = db.scalars(_page_stmt(chatroom_id, limit, before_id, after_id)).all()
+    return _to_page(rows, limit, newest_first=after_id is None)
+
+
+async def afetch_message_page(
+    db: AsyncSession,
+    chatroom_id: int,
+    limit: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+) -> Tuple[List[models.Message], bool]:
+    rows = (await db.scalars(_page_stmt(chatroom_id, limit, before_id, after_id))).all()
+    return _to_page(rows, limit, newest_first=after_id is None)
+
+
+def load_context_window(
+    db: Session,
+    chatroom_id: int,
+    user_message_ids: Sequence[int],
+    size: int,
+) -> Tuple[List[models.Message], List[models.Message]]:
+    """
+    The user messages to answer (one turn, possibly several coalesced
+    messages) plus the `size` messages of context before them, oldest-first.
+
+    Context leaves out the turn itself and user messages newer than it (they
+    wait for the next turn), but keeps assistant replies written after the
+    turn's messages arrived: that is the previous turn's answer. Lookups are
+    `ORDER BY id DESC LIMIT n` on the (chatroom_id, id) index, so cost doesn't
+    grow with the room. Falls back to the room's latest user message when
+    none of the ids is found.
+    """
+    room = db.query(models.Message).filter(models.Message.chatroom_id == chatroom_id)
+
+    user_msgs = room.filter(models.Message.id.in_(list(user_message_ids))).order_by(models.Message.id).all()
+    if not user_msgs:
+        latest = (
+            room.filter(models.Message.role == "user")
+            .order_by(models.Message.id.desc())
+            .first()
+        )
+        user_msgs = [latest] if latest is not None else []
+
+    if size <= 0:
+        return user_msgs, []
+
+    if user_msgs:
+        last_id = user_msgs[-1].id
+        q = room.filter(
+            models.Message.id.notin_([m.id for m in user_msgs]),
+            or_(models.Message.id < last_id, models.Message.role != "user"),
+        ).order_by(models.Message.id.desc())
+    else:
+        # Nothing to answer: mirror the old behaviour of "everything but the newest row"
+        q = room.order_by(models.Message.id.desc()).offset(1)
+    history = q.limit(size).all()
+    return user_msgs, list(reversed(history))
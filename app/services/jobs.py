@@ -0,0 +1,131 @@
+"""
+Status of queued reply jobs, read from Redis only.
+
+RQ keeps each job's status and timestamps. The worker also records, for
+every user message it answers, which assistant message replied and when
+(`gemini:reply:{message_id}`). That covers messages folded into another
+job's turn, whose own job finishes without writing a reply: such a job
+reads as started while its message is still queued for, or part of, the
+room's turn, and as finished (no assistant_message_id) once it isn't.
+"""
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from rq.job import Job, JobStatus
+
+from ..config import settings
+from . import turns
+from .queue import BASIC, gemini_queues, redis_conn, user_list_key
+
+QUEUED = "queued"
+STARTED = "started"
+FINISHED = "finished"
+FAILED = "failed"
+
+_STATES = {
+    JobStatus.QUEUED: QUEUED,
+    JobStatus.DEFERRED: QUEUED,
+    JobStatus.SCHEDULED: QUEUED,
+    JobStatus.STARTED: STARTED,
+    JobStatus.FINISHED: FINISHED,
+    JobStatus.FAILED: FAILED,
+    JobStatus.STOPPED: FAILED,
+    JobStatus.CANCELED: FAILED,
+}
+
+
+def _reply_key(message_id: int) -> str:
+    return f"gemini:reply:{message_id}"
+
+
+def record_reply(pipe, user_message_ids: List[int], assistant_id: int):
+    """Queue the message -> reply mapping on `pipe` (the caller executes it)."""
+    at = f"{time.time():.3f}"
+    for message_id in user_message_ids:
+        key = _reply_key(message_id)
+        pipe.hset(key, mapping={"assistant_message_id": assistant_id, "replied_at": at})
+        pipe.expire(key, settings.job_status_ttl)
+
+
+def _ms(start: Optional[datetime], end: Optional[datetime]) -> Optional[int]:
+    if start is None or end is None:
+        return None
+    return max(0, int((end - start).total_seconds() * 1000))
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() + "Z" if value else None
+
+
+def _describe(job: Job, position, reply: dict, in_turn: bool) -> dict:
+    chatroom_id, message_id = (job.args + (None, None))[:2]
+    status = job.get_status(refresh=False)
+    # RQ's timestamps are naive UTC
+    replied_at = datetime.utcfromtimestamp(float(reply[b"replied_at"])) if reply else None
+    if reply:
+        state = FINISHED
+    elif status == JobStatus.FINISHED and in_turn:
+        state = STARTED  # handed its message to the turn another job is running
+    else:
+        state = _STATES.get(status, QUEUED)
+    return {
+        "job_id": job.id,
+        "state": state,
+        "chatroom_id": chatroom_id,
+        "message_id": message_id or None,
+        "queue": job.kwargs.get("priority", BASIC),
+        # The caller's own jobs ahead of this one; other users' are served
+        # in between, one job each
+        "queue_position": position if state == QUEUED else None,
+        "assistant_message_id": int(reply[b"assistant_message_id"]) if reply else None,
+        "enqueued_at": _iso(job.enqueued_at),
+        "started_at": _iso(job.started_at),
+        "ended_at": _iso(job.ended_at),
+        "enqueue_to_start_ms": _ms(job.enqueued_at, job.started_at),
+        "start_to_finish_ms": _ms(job.started_at, job.ended_at),
+        "enqueue_to_reply_ms": _ms(job.enqueued_at, replied_at),
+    }
+
+
+def get_statuses(job_ids: List[str], user_id: int) -> Dict[str, Optional[dict]]:
+    """Status per id; None for ids that don't exist or belong to another user."""
+    jobs = Job.fetch_many(job_ids, connection=redis_conn)
+    owned = [j for j in jobs if j is not None and j.meta.get("user_id") == user_id]
+
+    with redis_conn.pipeline(transaction=False) as pipe:
+        for job in owned:
+            priority = job.kwargs.get("priority", BASIC)
+            message_id = job.args[1] if len(job.args) > 1 else 0
+            # Two replies per job, so results pair up by index
+            if priority in gemini_queues:
+                pipe.lpos(user_list_key(priority, job.meta.get("user_id")), job.id)
+            else:
+                pipe.echo("")
+            if message_id:
+                pipe.hgetall(_reply_key(message_id))
+            else:
+                pipe.echo("")
+        results = pipe.execute()
+
+    # Finished without a reply: is the message still in its room's turn?
+    folded = [
+        job for i, job in enumerate(owned)
+        if not results[2 * i + 1] and len(job.args) > 1 and job.args[1]
+        and job.get_status(refresh=False) == JobStatus.FINISHED
+    ]
+    in_turn = {}
+    if folded:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for job in folded:
+                turns.queue_waiting_check(pipe, job.args[0], job.args[1])
+            found = pipe.execute()
+        in_turn = {job.id: found[2 * i] is not None or found[2 * i + 1] is not None for i, job in enumerate(folded)}
+
+    out = {job_id: None for job_id in job_ids}
+    for i, job in enumerate(owned):
+        position, reply = results[2 * i], results[2 * i + 1]
+        out[job.id] = _describe(
+            job, position if isinstance(position, int) else None, reply or {}, in_turn.get(job.id, False)
+        )
+    return out
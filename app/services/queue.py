@@ -1,6 +1,350 @@
+"""
+Gemini reply queues: one RQ queue per plan, drained by weight, fair per user.
+
+Jobs are enqueued with RQ as usual, so RQ's job hashes, registries,
+retries and job status all keep working. The order, though, lives in a fair
+index: one FIFO list per user, plus a ring of the users that have work
+waiting, kept separately for each class. FairQueue adds every job it
+enqueues there and takes it back off RQ's queue list in the same pipeline
+(from the end it was just pushed to, so O(1)). That includes RQ's own
+re-enqueues: retries and shutdown requeues go to the front of their user's
+list. Workers dequeue through FairQueue.dequeue_any, which does two things:
+
+- it picks a class by weighted rotation (QUEUE_WEIGHT_PRO out of every
+  QUEUE_WEIGHT_PRO + QUEUE_WEIGHT_BASIC dequeues go to PRO first), so PRO
+  keeps its share under any BASIC backlog and an idle class gives its turns
+  away;
+- within the class it serves users round-robin, one job each, so a user
+  who floods the queue only delays themselves.
+
+Every pick is O(1) whatever the backlog. Ids whose job is gone or no longer
+queued (cancelled) are skipped. Jobs that reach RQ's list by other routes
+(RQ's scheduler, the legacy `gemini` queue) are served once a class's fair
+index is empty; idle workers re-check every WAKE_POLL_SECONDS for them.
+
+FairQueue overrides RQ internals (`Queue._enqueue_job`, `dequeue_any`), so
+`rq` is pinned in requirements.txt to the release it was written against
+(RQ_VERSION; another one logs a warning at import). Since waiting ids are not
+on RQ's list, RQ tools see the plan queues as empty unless they use this
+class: `rq info --queue-class app.services.queue.FairQueue` counts them, and
+GET /jobs/{id} reports a job's place in its user's line.
+"""
+import time
+from typing import Dict, List, Optional
+
+import rq
+from loguru import logger
+from redis.exceptions import RedisError
 from rq import Queue
-from redis import Redis
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.job import JobStatus
+from rq.utils import as_text, backend_class, utcnow
+
+from .. import metrics
 from ..config import settings
+from ..redis_pool import get_redis
+
+RQ_VERSION = "1.16.2"
+if rq.__version__ != RQ_VERSION:
+    logger.warning(f"FairQueue was written against rq {RQ_VERSION} internals; found rq {rq.__version__}")
+
+# RQ pickles job payloads, so its connection must not decode responses
+redis_conn = get_redis(decode_responses=False)
+
+PRO = "pro"
+BASIC = "basic"
+LEGACY_QUEUE = "gemini"  # jobs enqueued before the per-plan queues existed
+
+FAIR_PREFIX = "gemini:fair"
+TICK_KEY = f"{FAIR_PREFIX}:tick"
+WAKE_KEY = f"{FAIR_PREFIX}:wake"  # one token per enqueue; idle workers BLPOP it
+WAKE_MAX = 1000
+WAKE_POLL_SECONDS = 5
+
+# Upper bounds (ms) of the wait-time histogram kept per class in metrics
+WAIT_BUCKETS_MS = (100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# KEYS: user's list, class ring, wake list, class depth, RQ list. ARGV: job
+# id, user key, wake cap, 1 to go first (a retry or requeue).
+_PUSH_LUA = """
+local first = ARGV[4] == '1'
+redis.call('LREM', KEYS[5], first and 1 or -1, ARGV[1])
+local n
+if first then
+  n = redis.call('LPUSH', KEYS[1], ARGV[1])
+else
+  n = redis.call('RPUSH', KEYS[1], ARGV[1])
+end
+if n == 1 then
+  if first then
+    redis.call('LPUSH', KEYS[2], ARGV[2])
+  else
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+  end
+end
+redis.call('INCR', KEYS[4])
+redis.call('RPUSH', KEYS[3], '1')
+redis.call('LTRIM', KEYS[3], -tonumber(ARGV[3]), -1)
+return 1
+"""
+
+# KEYS: tick counter. ARGV: fair prefix, then per class (name, weight, rq
+# list key). Returns {rq list key, job id} or nil.
+_POP_LUA = """
+local n = (#ARGV - 1) / 3
+local total = 0
+for i = 0, n - 1 do total = total + tonumber(ARGV[3 + i * 3]) end
+local first = 0
+if total > 0 then
+  local slot = redis.call('INCR', KEYS[1]) % total
+  local acc = 0
+  for i = 0, n - 1 do
+    acc = acc + tonumber(ARGV[3 + i * 3])
+    if slot < acc then first = i break end
+  end
+end
+for k = 0, n - 1 do
+  local i = (first + k) % n
+  local name, rqkey = ARGV[2 + i * 3], ARGV[4 + i * 3]
+  local prefix = ARGV[1] .. ':' .. name
+  while true do
+    local user = redis.call('LPOP', prefix .. ':users')
+    if not user then break end
+    local ukey = prefix .. ':u:' .. user
+    local jid = redis.call('LPOP', ukey)
+    if redis.call('LLEN', ukey) > 0 then
+      redis.call('RPUSH', prefix .. ':users', user)
+    end
+    if jid then
+      redis.call('DECR', prefix .. ':depth')
+      return {rqkey, jid}
+    end
+  end
+  local jid = redis.call('LPOP', rqkey)
+  if jid then
+    return {rqkey, jid}
+  end
+end
+return nil
+"""
+
+_push = redis_conn.register_script(_PUSH_LUA)
+_pop = redis_conn.register_script(_POP_LUA)
+
+
+def priority_class(tier) -> str:
+    """Queue class for a user's plan (a Tier or its value)."""
+    return PRO if getattr(tier, "value", tier) == PRO else BASIC
+
+
+def queue_name(cls: str) -> str:
+    return f"{LEGACY_QUEUE}:{cls}"
+
+
+def weights() -> Dict[str, int]:
+    return {PRO: settings.queue_weight_pro, BASIC: settings.queue_weight_basic}
+
+
+def listen_queues() -> List[str]:
+    """Queues a Gemini worker serves, PRO first."""
+    return [queue_name(PRO), queue_name(BASIC), LEGACY_QUEUE]
+
+
+def user_list_key(cls: str, user_id: Optional[int]) -> str:
+    """A user's FIFO of waiting job ids in the class's fair index."""
+    return f"{FAIR_PREFIX}:{cls}:u:{user_id if user_id is not None else 'anon'}"
+
+
+def _depth_key(cls: str) -> str:
+    return f"{FAIR_PREFIX}:{cls}:depth"
+
+
+def _depth(connection, cls: str, rq_key: str) -> int:
+    with connection.pipeline(transaction=False) as pipe:
+        pipe.get(_depth_key(cls))
+        pipe.llen(rq_key)
+        fair, unindexed = pipe.execute()
+    return max(0, int(fair or 0)) + unindexed
+
+
+def _class_of(queue_key: str) -> str:
+    name = as_text(queue_key)[len(Queue.redis_queue_namespace_prefix):]
+    return name.rsplit(":", 1)[-1] if name != LEGACY_QUEUE else BASIC
+
+
+def _record_wait(job, queue_key: str):
+    if not job.enqueued_at:
+        return
+    cls = _class_of(queue_key)
+    waited_ms = max(0, int((utcnow() - job.enqueued_at).total_seconds() * 1000))
+    bucket = next((b for b in WAIT_BUCKETS_MS if waited_ms <= b), "inf")
+    metrics.incr_shared_many({
+        f"queue.{cls}.dequeued": 1,
+        f"queue.{cls}.wait_ms_total": waited_ms,
+        f"queue.{cls}.wait_le_{bucket}": 1,
+    })
+
+
+class FairQueue(Queue):
+    """RQ queue whose dequeue follows the class weights and per-user rotation."""
+
+    @property
+    def fair_class(self) -> str:
+        return _class_of(self.key)
+
+    @property
+    def count(self) -> int:
+        """Jobs waiting: the fair index plus any that reached RQ's list directly."""
+        if self.name == LEGACY_QUEUE:
+            return super().count
+        return _depth(self.connection, self.fair_class, self.key)
+
+    def _enqueue_job(self, job, pipeline=None, at_front: bool = False):
+        # RQ pushes the id onto its list; move it into the fair index in the
+        # same pipeline. A job that already ran (retry, shutdown requeue)
+        # goes back to the front of its user's line.
+        pipe = pipeline if pipeline is not None else self.connection.pipeline()
+        first = at_front or job.started_at is not None
+        job = super()._enqueue_job(job, pipeline=pipe, at_front=first)
+        if self._is_async and self.name != LEGACY_QUEUE:
+            cls = self.fair_class
+            user_id = (job.meta or {}).get("user_id")
+            user = str(user_id) if user_id is not None else "anon"
+            _push(
+                keys=[user_list_key(cls, user_id), f"{FAIR_PREFIX}:{cls}:users", WAKE_KEY, _depth_key(cls), self.key],
+                args=[job.id, user, WAKE_MAX, 1 if first else 0],
+                client=pipe,
+            )
+        if pipeline is None:
+            pipe.execute()
+        return job
+
+    @classmethod
+    def _pick(cls, queues: List[Queue], connection):
+        w = weights()
+        args = [FAIR_PREFIX]
+        for q in queues:
+            name = q.name.rsplit(":", 1)[-1] if q.name != LEGACY_QUEUE else LEGACY_QUEUE
+            # The legacy queue only drains, at BASIC's weight
+            args += [name, w.get(name, settings.queue_weight_basic), q.key]
+        return _pop(keys=[TICK_KEY], args=args, client=connection)
+
+    @classmethod
+    def dequeue_any(
+        cls,
+        queues: List[Queue],
+        timeout: Optional[int],
+        connection=None,
+        job_class=None,
+        serializer=None,
+        death_penalty_class=None,
+    ):
+        job_class = backend_class(cls, "job_class", override=job_class)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            picked = cls._pick(queues, connection)
+            if picked is None:
+                if deadline is None:
+                    return None
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DequeueTimeout(timeout, [q.key for q in queues])
+                # Park until something is enqueued (or the timeout passes)
+                connection.blpop([WAKE_KEY], max(1, min(WAKE_POLL_SECONDS, int(remaining))))
+                continue
+
+            queue_key, job_id = (as_text(v) for v in picked)
+            queue = next(q for q in queues if q.key == queue_key)
+            try:
+                job = job_class.fetch(job_id, connection=connection, serializer=serializer)
+            except NoSuchJobError:
+                continue
+            if job.get_status(refresh=False) != JobStatus.QUEUED:
+                continue  # cancelled (or otherwise taken care of) while waiting
+            _record_wait(job, queue_key)
+            return job, queue
+
+
+gemini_queues = {cls: FairQueue(queue_name(cls), connection=redis_conn) for cls in (PRO, BASIC)}
+
+
+def enqueue_gemini_message(
+    chatroom_id: int,
+    user_message_id: int,
+    use_cache: bool = True,
+    pipeline=None,
+    user_id: Optional[int] = None,
+    priority: str = BASIC,
+):
+    """
+    Queue the Gemini reply job on the class's queue, behind the user's own
+    earlier jobs. With `pipeline`, the job is only written when the caller
+    executes it, alongside the rest of the request's Redis writes.
+    RQ switches the pipeline into MULTI, so enqueue before adding other commands.
+    """
+    return _enqueue(
+        "worker_tasks.handle_gemini_message",
+        (chatroom_id, user_message_id),
+        {"use_cache": use_cache},
+        user_id,
+        priority,
+        pipeline,
+    )
+
+
+def enqueue_summary(chatroom_id: int, upto_id: int, user_id: Optional[int] = None, priority: str = BASIC):
+    """Queue a rolling-summary refresh; it waits its turn behind the owner's replies."""
+    return _enqueue("worker_tasks.summarize_chatroom", (chatroom_id, upto_id), {}, user_id, priority)
+
+
+def _enqueue(func: str, args: tuple, kwargs: dict, user_id: Optional[int], priority: str, pipeline=None):
+    priority = priority if priority in gemini_queues else BASIC
+    # FairQueue puts it in the user's line (see _enqueue_job)
+    return gemini_queues[priority].enqueue(
+        func,
+        *args,
+        **kwargs,
+        user_id=user_id,
+        priority=priority,
+        meta={"user_id": user_id},
+        result_ttl=settings.job_status_ttl,
+        pipeline=pipeline,
+    )
+
+
+def _percentile(buckets: Dict[str, int], total: int, q: float):
+    # Upper bound of the histogram bucket holding the q-th quantile
+    if not total:
+        return None
+    seen = 0
+    for bound in WAIT_BUCKETS_MS:
+        seen += buckets.get(str(bound), 0)
+        if seen >= q * total:
+            return bound
+    return None  # beyond the largest bucket
+
 
-redis_conn = Redis.from_url(settings.redis_url)
-gemini_queue = Queue("gemini", connection=redis_conn)
+def stats() -> dict:
+    """Depth, waiting users and dequeue wait times per class, for /metrics."""
+    shared = metrics.shared_counters()
+    out = {}
+    for cls, queue in gemini_queues.items():
+        try:
+            depth = queue.count
+            users = redis_conn.llen(f"{FAIR_PREFIX}:{cls}:users")
+        except RedisError:
+            depth = users = None
+        prefix = f"queue.{cls}."
+        dequeued = shared.get(prefix + "dequeued", 0)
+        buckets = {k[len(prefix + "wait_le_"):]: v for k, v in shared.items() if k.startswith(prefix + "wait_le_")}
+        out[cls] = {
+            "depth": depth,
+            "waiting_users": users,
+            "weight": weights()[cls],
+            "dequeued": dequeued,
+            "wait_avg_ms": round(shared.get(prefix + "wait_ms_total", 0) / dequeued) if dequeued else None,
+            "wait_p50_ms": _percentile(buckets, dequeued, 0.50),
+            "wait_p95_ms": _percentile(buckets, dequeued, 0.95),
+            "wait_p99_ms": _percentile(buckets, dequeued, 0.99),
+        }
+    return out
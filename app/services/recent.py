@@ -0,0 +1,204 @@
+"""
+Per-chatroom buffer of the newest messages in Redis, in front of Postgres.
+
+Stored as a sorted set scored by message id, so concurrent appends land in
+order and re-adding a message is a no-op. Trimming keeps the newest
+RECENT_MESSAGES_SIZE. The buffer is only trusted when it carries a
+marker, and the marker is written only when the buffer is rehydrated from
+the DB:
+
+- FULL: the buffer held the whole room when it was loaded.
+- TAIL: older messages exist only in Postgres.
+
+Appends never create trust on their own. Postgres stays authoritative:
+every read here returns None when it can't answer exactly, and the caller
+then goes to the DB.
+"""
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+from loguru import logger
+from redis.exceptions import RedisError
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..redis_pool import get_async_redis, get_redis
+from ..schemas import MessageOut
+from .history import fetch_message_page
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+FULL = "~full"
+TAIL = "~tail"
+MARKER_SCORE = -1  # markers sort before every message (ids are >= 1)
+
+
+def _key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:recent"
+
+
+def _member(message) -> str:
+    return MessageOut.model_validate(message).model_dump_json()
+
+
+def _queue_append(pipe, chatroom_id: int, message):
+    key = _key(chatroom_id)
+    pipe.zadd(key, {_member(message): message.id})
+    # rank 0 is the marker when there is one; keep it plus the newest N
+    pipe.zremrangebyrank(key, 1, -(settings.recent_messages_size + 1))
+    pipe.expire(key, settings.recent_messages_ttl)
+
+
+def append_message(chatroom_id: int, message, pipeline=None):
+    """Record a committed message. With `pipeline`, the caller executes it."""
+    if settings.recent_messages_size <= 0:
+        return
+    if pipeline is not None:
+        _queue_append(pipeline, chatroom_id, message)
+        return
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            _queue_append(pipe, chatroom_id, message)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Recent-message append failed for chatroom {chatroom_id}. err={e}")
+        drop(chatroom_id)
+
+
+def drop(chatroom_id: int):
+    """
+    Call when a committed message couldn't be appended: the buffer would
+    still look complete with that message missing, so the next read must
+    rehydrate from the DB instead.
+    """
+    try:
+        redis_client.delete(_key(chatroom_id))
+    except RedisError as e:
+        logger.warning(f"Recent-message buffer for chatroom {chatroom_id} may miss a message. err={e}")
+
+
+def _queue_rehydrate(pipe, chatroom_id: int, messages: List, complete: bool):
+    key = _key(chatroom_id)
+    pipe.zremrangebyscore(key, MARKER_SCORE, MARKER_SCORE)
+    if messages and not complete:
+        # anything older than this window may sit next to a gap; drop it
+        pipe.zremrangebyscore(key, 0, f"({messages[0].id}")
+    if messages:
+        pipe.zadd(key, {_member(m): m.id for m in messages})
+    pipe.zadd(key, {FULL if complete else TAIL: MARKER_SCORE})
+    pipe.zremrangebyrank(key, 1, -(settings.recent_messages_size + 1))
+    pipe.expire(key, settings.recent_messages_ttl)
+
+
+def rehydrate(chatroom_id: int, messages: List, complete: bool):
+    """`messages`: the room's newest rows, oldest-first; `complete`: no older rows exist."""
+    if settings.recent_messages_size <= 0:
+        return
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            _queue_rehydrate(pipe, chatroom_id, messages, complete)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Recent-message rehydrate failed for chatroom {chatroom_id}. err={e}")
+
+
+async def arehydrate(chatroom_id: int, messages: List, complete: bool):
+    if settings.recent_messages_size <= 0:
+        return
+    try:
+        async with async_redis_client.pipeline(transaction=True) as pipe:
+            _queue_rehydrate(pipe, chatroom_id, messages, complete)
+            await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Recent-message rehydrate failed for chatroom {chatroom_id}. err={e}")
+
+
+def rehydrate_from_db(db: Session, chatroom_id: int):
+    messages, has_more = fetch_message_page(db, chatroom_id, settings.recent_messages_size)
+    rehydrate(chatroom_id, messages, complete=not has_more)
+
+
+async def adelete(chatroom_id: int):
+    try:
+        await async_redis_client.delete(_key(chatroom_id))
+    except RedisError:
+        pass
+
+
+def _parse(members: Iterable[str]) -> List[MessageOut]:
+    """Newest-first members -> messages, dropping duplicate ids."""
+    out, seen = [], set()
+    for raw in members:
+        msg = MessageOut.model_validate_json(raw)
+        if msg.id not in seen:
+            seen.add(msg.id)
+            out.append(msg)
+    return out
+
+
+def _marker(raw: List[str]) -> Optional[str]:
+    return raw[0] if raw else None
+
+
+def _exact(rows: List[MessageOut], wanted: int, marker: str, count: int) -> bool:
+    # Fewer rows than wanted is only the real answer if nothing was ever trimmed
+    return len(rows) >= wanted or (marker == FULL and count < settings.recent_messages_size)
+
+
+async def aget_page(chatroom_id: int, limit: int) -> Optional[Tuple[List[MessageOut], bool]]:
+    """The newest `limit` messages oldest-first plus has_more, or None on a miss."""
+    if settings.recent_messages_size <= 0:
+        return None
+    key = _key(chatroom_id)
+    try:
+        async with async_redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(key, MARKER_SCORE, MARKER_SCORE)
+            pipe.zrevrangebyscore(key, "+inf", 0, start=0, num=limit + 1)
+            pipe.zcount(key, 0, "+inf")
+            marker, members, count = await pipe.execute()
+        marker = _marker(marker)
+        if marker is None:
+            return None
+        rows = _parse(members)
+    except (RedisError, ValueError) as e:
+        logger.warning(f"Recent-message read failed for chatroom {chatroom_id}. err={e}")
+        return None
+
+    if len(rows) > limit:
+        return list(reversed(rows[:limit])), True
+    if not _exact(rows, limit + 1, marker, count):
+        return None
+    return list(reversed(rows)), False
+
+
+def get_context_window(
+    chatroom_id: int, user_message_ids: Sequence[int], size: int
+) -> Optional[Tuple[List[MessageOut], List[MessageOut]]]:
+    """Buffer twin of history.load_context_window; None when the buffer can't answer."""
+    if settings.recent_messages_size <= 0:
+        return None
+    key = _key(chatroom_id)
+    try:
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(key, MARKER_SCORE, MARKER_SCORE)
+            pipe.zrevrangebyscore(key, "+inf", 0)
+            marker, members = pipe.execute()
+        marker = _marker(marker)
+        if marker is None:
+            return None
+        rows = _parse(members)  # newest first
+    except (RedisError, ValueError) as e:
+        logger.warning(f"Recent-message read failed for chatroom {chatroom_id}. err={e}")
+        return None
+
+    wanted = set(user_message_ids)
+    user_msgs = [m for m in reversed(rows) if m.id in wanted]
+    if not wanted or len(user_msgs) != len(wanted):
+        return None
+    if size <= 0:
+        return user_msgs, []
+    last_id = user_msgs[-1].id
+    history = [m for m in rows if m.id not in wanted and (m.id < last_id or m.role != "user")]
+    if not _exact(history, size, marker, len(rows)):
+        return None
+    return user_msgs, list(reversed(history[:size]))
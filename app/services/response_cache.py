@@ -0,0 +1,149 @@
+"""
+Cache of successful Gemini replies, keyed by a hash of everything that shapes
+the answer (see gemini.cache_key).
+
+L1 is a small per-process TTL/LRU. L2 is Redis with the same TTL and a
+cluster-wide entry cap: an index ZSET ordered by last use, trimmed on
+every store. Failures are never cached; Redis errors degrade to a miss.
+"""
+import threading
+import time
+from typing import Optional
+
+from cachetools import TTLCache
+from redis.exceptions import RedisError
+
+from .. import metrics
+from ..config import settings
+from ..redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+INDEX_KEY = "gemini:cache:index"
+
+# Store and evict in one step. Evicted entry keys come from the index, so this
+# assumes a single Redis node (as the rest of the app does).
+_STORE_LUA = """
+local ttl = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+redis.call('SET', KEYS[1], ARGV[1], 'PX', ttl)
+redis.call('ZADD', KEYS[2], now, KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - ttl)
+local extra = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if extra > 0 then
+  local old = redis.call('ZPOPMIN', KEYS[2], extra)
+  for i = 1, #old, 2 do
+    redis.call('DEL', old[i])
+  end
+end
+redis.call('PEXPIRE', KEYS[2], ttl)
+return 1
+"""
+
+_store = redis_client.register_script(_STORE_LUA)
+_astore = async_redis_client.register_script(_STORE_LUA)
+
+_local = TTLCache(maxsize=max(1, settings.gemini_cache_local_size), ttl=max(1, settings.gemini_cache_ttl))
+_local_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return settings.gemini_cache_ttl > 0 and settings.gemini_cache_max_entries > 0
+
+
+def _key(digest: str) -> str:
+    return f"gemini:cache:{digest}"
+
+
+def _local_get(digest: str) -> Optional[str]:
+    if settings.gemini_cache_local_size <= 0:
+        return None
+    with _local_lock:
+        return _local.get(digest)
+
+
+def _local_set(digest: str, text: str):
+    if settings.gemini_cache_local_size > 0:
+        with _local_lock:
+            _local[digest] = text
+
+
+def _record(outcome: str):
+    metrics.incr(f"gemini_cache.{outcome}")
+    metrics.incr_shared(f"gemini_cache.{outcome}")
+
+
+async def _arecord(outcome: str):
+    metrics.incr(f"gemini_cache.{outcome}")
+    await metrics.aincr_shared(f"gemini_cache.{outcome}")
+
+
+def get(digest: str, use_cache: bool = True) -> Optional[str]:
+    """Cached reply, or None. `use_cache=False` is the per-request bypass."""
+    if not use_cache:
+        _record("bypass")
+        return None
+    text = _local_get(digest)
+    if text is None:
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(_key(digest))
+                pipe.zadd(INDEX_KEY, {_key(digest): int(time.time() * 1000)}, xx=True)
+                text, _ = pipe.execute()
+        except RedisError:
+            text = None
+        if text is not None:
+            _local_set(digest, text)
+    _record("hit" if text is not None else "miss")
+    return text
+
+
+async def aget(digest: str, use_cache: bool = True) -> Optional[str]:
+    if not use_cache:
+        await _arecord("bypass")
+        return None
+    text = _local_get(digest)
+    if text is None:
+        try:
+            async with async_redis_client.pipeline(transaction=False) as pipe:
+                pipe.get(_key(digest))
+                pipe.zadd(INDEX_KEY, {_key(digest): int(time.time() * 1000)}, xx=True)
+                text, _ = await pipe.execute()
+        except RedisError:
+            text = None
+        if text is not None:
+            _local_set(digest, text)
+    await _arecord("hit" if text is not None else "miss")
+    return text
+
+
+def _args(text: str) -> list:
+    return [text, settings.gemini_cache_ttl * 1000, int(time.time() * 1000), settings.gemini_cache_max_entries]
+
+
+def put(digest: str, text: str):
+    _local_set(digest, text)
+    try:
+        _store(keys=[_key(digest), INDEX_KEY], args=_args(text))
+    except RedisError:
+        pass
+
+
+async def aput(digest: str, text: str):
+    _local_set(digest, text)
+    try:
+        await _astore(keys=[_key(digest), INDEX_KEY], args=_args(text))
+    except RedisError:
+        pass
+
+
+def stats() -> dict:
+    shared = metrics.shared_counters()
+    hits, misses = shared.get("gemini_cache.hit", 0), shared.get("gemini_cache.miss", 0)
+    return {
+        "hits": hits,
+        "misses": misses,
+        "bypassed": shared.get("gemini_cache.bypass", 0),
+        "hit_rate": metrics.ratio(hits, misses),
+    }
@@ -0,0 +1,131 @@
+"""
+Rolling per-chatroom summaries of messages that no longer fit the context.
+
+The summary lives in `chatroom_summaries` (Postgres) and is cached in a Redis
+hash next to the recent-message buffer, so the worker reads it without a DB
+hit. Once older messages fall out of the context, a counter of turns starts
+on the hash. After GEMINI_SUMMARY_INTERVAL such turns, a summarize job is
+queued, at most one per room at a time. The job folds the next messages
+(oldest-first, GEMINI_SUMMARY_BATCH per Gemini call) into the summary, up to
+the oldest message still sent verbatim.
+"""
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from redis.exceptions import RedisError
+from sqlalchemy.orm import Session
+
+from .. import models
+from ..config import settings
+from ..database import SessionLocal
+from ..redis_pool import get_redis
+from .context import clip
+from .queue import enqueue_summary
+
+redis_client = get_redis()
+
+SUMMARY_LOCK_TTL = 600  # longer than a summarize job may take
+
+SUMMARY_INSTRUCTIONS = (
+    "Update the running summary of this chat with the new messages below. "
+    "Keep facts, names, numbers, decisions, open questions and the user's "
+    "stated preferences; drop small talk. Write at most 150 words and reply "
+    "with the updated summary only."
+)
+
+
+def enabled() -> bool:
+    return settings.gemini_summary_interval > 0
+
+
+def _key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:summary"
+
+
+def _lock_key(chatroom_id: int) -> str:
+    return f"chatroom:{chatroom_id}:summarizing"
+
+
+def _cache(chatroom_id: int, content: str, through: int):
+    with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(_key(chatroom_id), mapping={"content": content, "through": through})
+        pipe.expire(_key(chatroom_id), settings.recent_messages_ttl)
+        pipe.execute()
+
+
+def load_from_db(db: Session, chatroom_id: int) -> Tuple[str, int]:
+    row = db.get(models.ChatroomSummary, chatroom_id)
+    return (row.content, row.through_message_id) if row else ("", 0)
+
+
+def load(chatroom_id: int) -> Tuple[str, int]:
+    """(summary, id of the last message it covers); ("", 0) when there is none."""
+    try:
+        cached = redis_client.hgetall(_key(chatroom_id))
+        if "through" in cached:
+            return cached.get("content", ""), int(cached["through"])
+    except RedisError as e:
+        logger.warning(f"Summary cache read failed for chatroom {chatroom_id}. err={e}")
+
+    db: Session = SessionLocal()
+    try:
+        content, through = load_from_db(db, chatroom_id)
+    finally:
+        db.close()
+    try:
+        _cache(chatroom_id, content, through)
+    except RedisError:
+        pass
+    return content, through
+
+
+def save(db: Session, chatroom_id: int, content: str, through: int):
+    # At most half the context budget, so verbatim history always has room
+    content = clip(content, settings.gemini_context_tokens // 2)
+    row = db.get(models.ChatroomSummary, chatroom_id)
+    if row is None:
+        row = models.ChatroomSummary(chatroom_id=chatroom_id)
+        db.add(row)
+    elif row.through_message_id >= through:
+        return
+    row.content = content
+    row.through_message_id = through
+    db.commit()
+    try:
+        _cache(chatroom_id, content, through)
+    except RedisError as e:
+        logger.warning(f"Summary cache write failed for chatroom {chatroom_id}. err={e}")
+
+
+def note_turn(chatroom_id: int, upto_id: Optional[int], user_id: Optional[int], priority: str):
+    """
+    Count a turn whose context left older, unsummarized messages out, and
+    queue a summarize job up to `upto_id` once enough have piled up.
+    """
+    if not enabled() or not upto_id:
+        return
+    try:
+        turns = redis_client.hincrby(_key(chatroom_id), "turns", 1)
+        if turns < settings.gemini_summary_interval:
+            return
+        if not redis_client.set(_lock_key(chatroom_id), 1, nx=True, ex=SUMMARY_LOCK_TTL):
+            return
+        redis_client.hset(_key(chatroom_id), "turns", 0)
+        enqueue_summary(chatroom_id, upto_id, user_id=user_id, priority=priority)
+    except RedisError as e:
+        logger.warning(f"Could not queue summary for chatroom {chatroom_id}. err={e}")
+
+
+def unlock(chatroom_id: int):
+    try:
+        redis_client.delete(_lock_key(chatroom_id))
+    except RedisError:
+        pass
+
+
+def build_prompt(summary: str, messages: List) -> str:
+    lines = [SUMMARY_INSTRUCTIONS, "", "Current summary:", summary or "(none yet)", "", "New messages:"]
+    for m in messages:
+        speaker = "User" if m.role == "user" else "Assistant"
+        lines.append(f"{speaker}: {clip(m.content or '', settings.gemini_context_message_max_tokens)}")
+    return "\n".join(lines)
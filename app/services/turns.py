@@ -0,0 +1,264 @@
+"""
+One generation at a time per chatroom.
+
+Every reply job first pushes its message id onto the room's pending list and
+tries to take the room's turn lock. The job that gets the lock answers
+everything pending as one turn. When it finishes it takes whatever arrived
+in the meantime as the next turn, and it releases the lock only when
+nothing is left. Jobs that find the lock taken return straight away because
+their message is already queued for the holder. So a burst of messages
+costs one Gemini call per turn rather than one per message, and replies
+come out in order.
+
+The ids a turn is answering move from the pending list to the room's
+in-flight list, and leave it only once the reply is committed (the next
+`next_turn`). A turn that fails, or is cancelled, puts them back on the
+pending list for a hand-over job (`release`). The lock is a lease
+(CHATROOM_TURN_LEASE seconds) that the holder renews every third of a lease
+while it works (`kept`), since one turn can outlast it: governor waits,
+retries and a slow stream add up. If a worker dies while it holds the lease, the lease expires, and the next job to take the room
+(its next message, or the collector a restarted worker queues through
+`orphaned`) answers the in-flight ids along with everything pending.
+"""
+import asyncio
+import threading
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from typing import List
+
+from loguru import logger
+from redis.exceptions import RedisError
+
+from ..config import settings
+from ..redis_pool import get_async_redis, get_redis
+
+redis_client = get_redis()
+async_redis_client = get_async_redis()
+
+
+def _take_pending(ttl_arg: int) -> str:
+    # Lua: move the pending ids onto the in-flight list (KEYS[1] -> KEYS[3])
+    return f"""
+local taken = redis.call('LRANGE', KEYS[1], 0, -1)
+for _, id in ipairs(taken) do
+  redis.call('RPUSH', KEYS[3], id)
+end
+redis.call('DEL', KEYS[1])
+redis.call('PEXPIRE', KEYS[3], ARGV[{ttl_arg}])
+"""
+
+
+# KEYS: pending list, lock, in-flight list. ARGV: message id (0: none, just
+# pick up what's pending), token, lease ms, list ttl ms.
+# Returns the ids for this job's first turn, or {} when another job holds the
+# room. Taking a free room also takes over what a dead holder left in flight.
+_CLAIM_LUA = """
+if ARGV[1] ~= '0' then
+  redis.call('RPUSH', KEYS[1], ARGV[1])
+  redis.call('PEXPIRE', KEYS[1], ARGV[4])
+end
+if redis.call('SET', KEYS[2], ARGV[2], 'NX', 'PX', ARGV[3]) then
+""" + _take_pending(4) + """
+  local ids = redis.call('LRANGE', KEYS[3], 0, -1)
+  if #ids == 0 then
+    redis.call('DEL', KEYS[2])
+  end
+  return ids
+end
+return {}
+"""
+
+# KEYS: pending list, lock, in-flight list. ARGV: token, lease ms, list ttl ms.
+# Called once the last turn's reply is saved: drops its in-flight ids and
+# returns the next turn's, {} when done (lock released), or nil when the
+# lease went to another job in the meantime (that job owns the room's ids).
+_NEXT_LUA = """
+local owner = redis.call('GET', KEYS[2])
+if owner and owner ~= ARGV[1] then
+  return nil
+end
+redis.call('DEL', KEYS[3])
+if redis.call('LLEN', KEYS[1]) == 0 then
+  if owner then
+    redis.call('DEL', KEYS[2])
+  end
+  return {}
+end
+""" + _take_pending(3) + """
+redis.call('SET', KEYS[2], ARGV[1], 'PX', ARGV[2])
+return redis.call('LRANGE', KEYS[3], 0, -1)
+"""
+
+# KEYS: pending list, lock, in-flight list. ARGV: token, list ttl ms. Drop the
+# lock after a failed turn, putting its unanswered ids back in front of the
+# pending ones; returns how many messages are now waiting for a turn.
+_RELEASE_LUA = """
+local owner = redis.call('GET', KEYS[2])
+if not owner or owner == ARGV[1] then
+  local ids = redis.call('LRANGE', KEYS[3], 0, -1)
+  for i = #ids, 1, -1 do
+    redis.call('LPUSH', KEYS[1], ids[i])
+  end
+  redis.call('DEL', KEYS[3])
+  if #ids > 0 then
+    redis.call('PEXPIRE', KEYS[1], ARGV[2])
+  end
+  if owner then
+    redis.call('DEL', KEYS[2])
+  end
+end
+return redis.call('LLEN', KEYS[1])
+"""
+
+# KEYS: pending list, lock, in-flight list. ARGV: token, lease ms, list ttl
+# ms. Extend the holder's lease and its in-flight ids; 0 once it lost them.
+_RENEW_LUA = """
+if redis.call('GET', KEYS[2]) ~= ARGV[1] then
+  return 0
+end
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+redis.call('PEXPIRE', KEYS[3], ARGV[3])
+return 1
+"""
+
+_LUA = (("claim", _CLAIM_LUA), ("next", _NEXT_LUA), ("release", _RELEASE_LUA), ("renew", _RENEW_LUA))
+_scripts = {name: redis_client.register_script(lua) for name, lua in _LUA}
+_async_scripts = {name: async_redis_client.register_script(lua) for name, lua in _LUA}
+
+
+def _keys(chatroom_id: int) -> list:
+    return [f"chatroom:{chatroom_id}:pending", f"chatroom:{chatroom_id}:turn", f"chatroom:{chatroom_id}:inflight"]
+
+
+def _lease_ms() -> int:
+    return settings.chatroom_turn_lease * 1000
+
+
+def _ttl_ms() -> int:
+    return _lease_ms() * 4
+
+
+def _ids(raw) -> List[int]:
+    # The same message can be pushed twice (a re-enqueue after a failure)
+    return sorted({int(v) for v in raw or []})
+
+
+def new_token() -> str:
+    return uuid.uuid4().hex
+
+
+def claim(chatroom_id: int, user_message_id: int, token: str) -> List[int]:
+    """Message ids of this job's first turn; empty when another job will answer them."""
+    raw = _scripts["claim"](
+        keys=_keys(chatroom_id), args=[user_message_id, token, _lease_ms(), _ttl_ms()]
+    )
+    return _ids(raw)
+
+
+async def aclaim(chatroom_id: int, user_message_id: int, token: str) -> List[int]:
+    raw = await _async_scripts["claim"](
+        keys=_keys(chatroom_id), args=[user_message_id, token, _lease_ms(), _ttl_ms()]
+    )
+    return _ids(raw)
+
+
+def next_turn(chatroom_id: int, token: str) -> List[int]:
+    """
+    Call once the last turn's reply is committed. Ids that arrived during
+    that turn; empty once the room is released.
+    """
+    return _ids(_scripts["next"](keys=_keys(chatroom_id), args=[token, _lease_ms(), _ttl_ms()]))
+
+
+async def anext_turn(chatroom_id: int, token: str) -> List[int]:
+    return _ids(await _async_scripts["next"](keys=_keys(chatroom_id), args=[token, _lease_ms(), _ttl_ms()]))
+
+
+def release(chatroom_id: int, token: str) -> int:
+    """Give the room up after a failed turn; returns how many messages still wait."""
+    return int(_scripts["release"](keys=_keys(chatroom_id), args=[token, _ttl_ms()]))
+
+
+def renew(chatroom_id: int, token: str) -> bool:
+    """Extend this job's lease; False when another job has taken the room."""
+    return bool(_scripts["renew"](keys=_keys(chatroom_id), args=[token, _lease_ms(), _ttl_ms()]))
+
+
+async def arenew(chatroom_id: int, token: str) -> bool:
+    return bool(await _async_scripts["renew"](keys=_keys(chatroom_id), args=[token, _lease_ms(), _ttl_ms()]))
+
+
+def _renew_every() -> float:
+    return settings.chatroom_turn_lease / 3
+
+
+def _renewed(chatroom_id: int, token: str, renewed: bool) -> bool:
+    if not renewed:
+        logger.warning(f"Lost the turn lease in chatroom {chatroom_id}; another job has taken the room")
+    return renewed
+
+
+@contextmanager
+def kept(chatroom_id: int, token: str):
+    """Keep renewing this job's lease from a background thread while the block runs."""
+    stop = threading.Event()
+
+    def _run():
+        while not stop.wait(_renew_every()):
+            try:
+                if not _renewed(chatroom_id, token, renew(chatroom_id, token)):
+                    return
+            except RedisError as e:
+                logger.warning(f"Turn lease renewal failed in chatroom {chatroom_id}. err={e}")
+
+    threading.Thread(target=_run, name=f"turn-lease-{chatroom_id}", daemon=True).start()
+    try:
+        yield
+    finally:
+        stop.set()
+
+
+@asynccontextmanager
+async def akept(chatroom_id: int, token: str):
+    async def _run():
+        while True:
+            await asyncio.sleep(_renew_every())
+            try:
+                if not _renewed(chatroom_id, token, await arenew(chatroom_id, token)):
+                    return
+            except RedisError as e:
+                logger.warning(f"Turn lease renewal failed in chatroom {chatroom_id}. err={e}")
+
+    task = asyncio.create_task(_run())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+def orphaned() -> List[int]:
+    """
+    Rooms with ids in flight but no lease: their holder died. A collector job
+    (message id 0) for each answers them without waiting for a new message.
+    """
+    rooms = []
+    for key in redis_client.scan_iter(match="chatroom:*:inflight", count=500):
+        chatroom_id = int(key.split(":")[1])
+        if not redis_client.exists(_keys(chatroom_id)[1]):
+            rooms.append(chatroom_id)
+    return rooms
+
+
+def queue_waiting_check(pipe, chatroom_id: int, message_id: int):
+    """
+    Queue two lookups on `pipe`; either result is non-None while the message
+    still waits for, or is part of, a turn that hasn't saved its reply.
+    """
+    pending, _, inflight = _keys(chatroom_id)
+    pipe.lpos(pending, message_id)
+    pipe.lpos(inflight, message_id)
+
+
+def discard(chatroom_id: int):
+    """Forget a deleted room's queued and in-flight ids."""
+    redis_client.delete(*_keys(chatroom_id))
@@ -0,0 +1,170 @@
+"""
+Opt-in capture of anonymized request traces, for replay with bench/replay.py.
+
+With TRAFFIC_CAPTURE_PATH set, every HTTP request (or a share of users, see
+TRAFFIC_CAPTURE_SAMPLE) is appended to that file as one JSON line: start
+time, method, route template, status, duration, request/response body sizes,
+the caller and the path ids. No bodies, tokens or phone numbers are kept:
+the caller (JWT subject) and path ids are HMAC-hashed, and query values are
+kept only for the knobs that shape load (`wait`, `limit`).
+
+Lines are written by a background thread in batches; when the writer falls
+behind, records are dropped and counted (`traffic_capture_dropped`) rather
+than slowing requests down.
+"""
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qsl
+
+from jose import JWTError, jwt
+from loguru import logger
+
+from . import metrics
+from .config import settings
+
+KEEP_QUERY = {"wait", "limit"}
+MAX_PENDING = 10000
+FLUSH_SECONDS = 1.0
+
+_pending: "queue.Queue[str]" = queue.Queue(maxsize=MAX_PENDING)
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return bool(settings.traffic_capture_path)
+
+
+def _secret() -> bytes:
+    return (settings.traffic_capture_salt or f"traffic:{settings.jwt_secret}").encode("utf-8")
+
+
+def anonymize(value) -> str:
+    """Stable, non-reversible stand-in for an id (same input, same output, across processes)."""
+    return hmac.new(_secret(), str(value).encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+def _subject(headers) -> Optional[str]:
+    for name, value in headers:
+        if name == b"authorization":
+            token = value.decode("latin-1").partition(" ")[2]
+            try:
+                # Only used as an identity for hashing; auth itself happens in deps
+                return jwt.get_unverified_claims(token).get("sub")
+            except JWTError:
+                return None
+    return None
+
+
+def _sampled(user: Optional[str]) -> bool:
+    rate = settings.traffic_capture_sample
+    if rate >= 1:
+        return True
+    if user is None:
+        return random.random() < rate
+    # Per user, so a sampled user's whole session is kept
+    return int(user[:8], 16) / 0xFFFFFFFF < rate
+
+
+def _query(raw: bytes) -> dict:
+    out = {}
+    for key, value in parse_qsl(raw.decode("latin-1"), keep_blank_values=True):
+        out[key] = value if key in KEEP_QUERY else "*"
+    return out
+
+
+def _write_loop(path: str):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    while True:
+        lines = [_pending.get()]
+        deadline = time.monotonic() + FLUSH_SECONDS
+        while len(lines) < 500 and time.monotonic() < deadline:
+            try:
+                lines.append(_pending.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            # Whole lines per O_APPEND write, so several processes can share the file
+            os.write(fd, ("\n".join(lines) + "\n").encode("utf-8"))
+        except OSError as e:
+            logger.warning(f"Traffic capture write failed; {len(lines)} records lost. err={e}")
+
+
+def _ensure_writer():
+    global _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        threading.Thread(
+            target=_write_loop, args=(settings.traffic_capture_path,), name="traffic-capture", daemon=True
+        ).start()
+        _writer_pid = os.getpid()
+
+
+def record(entry: dict):
+    _ensure_writer()
+    try:
+        _pending.put_nowait(json.dumps(entry, separators=(",", ":")))
+    except queue.Full:
+        metrics.incr("traffic_capture_dropped")
+
+
+class TrafficCapture:
+    """ASGI middleware; add it only when `enabled()`."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        subject = _subject(scope.get("headers", []))
+        user = anonymize(subject) if subject else None
+        if not _sampled(user):
+            return await self.app(scope, receive, send)
+
+        started_at = time.time()
+        t0 = time.perf_counter()
+        sizes = {"req": 0, "resp": 0}
+        status = {"code": 500}
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["req"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes["resp"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = scope.get("route")
+            record({
+                "t": round(started_at, 3),
+                "method": scope["method"],
+                # Unmatched paths (404s, static files) may hold raw ids; leave them out
+                "route": getattr(route, "path", None),
+                "status": status["code"],
+                "ms": round((time.perf_counter() - t0) * 1000, 2),
+                "req_bytes": sizes["req"],
+                "resp_bytes": sizes["resp"],
+                "user": user,
+                "params": {k: anonymize(v) for k, v in (scope.get("path_params") or {}).items()},
+                "query": _query(scope.get("query_string", b"")),
+            })
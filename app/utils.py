@@ -1,7 +1,16 @@
 from fastapi import HTTPException, status
+from fastapi.responses import ORJSONResponse
 
 def api_ok(data=None, message: str = "ok"):
     return {"ok": True, "message": message, "data": data}
 
-def api_error(message: str, code: int = status.HTTP_400_BAD_REQUEST):
-    raise HTTPException(status_code=code, detail={"ok": False, "message": message})
+def api_ok_response(data=None, message: str = "ok", headers: dict | None = None) -> ORJSONResponse:
+    """
+    `api_ok`, serialized by orjson straight to the response body. Returning a
+    Response skips FastAPI's jsonable_encoder pass, and `data` may embed
+    already-serialized JSON as `orjson.Fragment(...)`.
+    """
+    return ORJSONResponse(api_ok(data, message), headers=headers)
+
+def api_error(message: str, code: int = status.HTTP_400_BAD_REQUEST, headers: dict | None = None):
+    raise HTTPException(status_code=code, detail={"ok": False, "message": message}, headers=headers)
@@ -0,0 +1,251 @@
+"""
+Concurrent asyncio worker for the Gemini queue.
+
+Pulls jobs from the same RQ queues, in the same fair order, as the classic worker, but runs up to
+ASYNC_WORKER_CONCURRENCY of them at once in one process. The process is
+registered as an RQ worker (birth, heartbeat, state, death), so `rq info` and
+the dashboard list it, and it runs RQ's registry cleanup like any other
+worker. Jobs go through the usual RQ bookkeeping (StartedJobRegistry +
+heartbeats, results, FailedJobRegistry, retries) via that worker's own
+success/failure handlers, so a worker that dies mid-job is recovered the same
+way RQ recovers its own work-horses. The worker record shows no single
+current job, since several run at once.
+
+Besides FairQueue, this relies on one RQ internal: the result of a coroutine
+job is handed over through `job._result`, as `Job.perform` does. `rq` is
+pinned in requirements.txt for that reason.
+
+Start it with `WORKER_MODE=async python worker.py`.
+"""
+import asyncio
+import os
+import signal
+import socket
+import sys
+import traceback
+import uuid
+
+from loguru import logger
+from redis import Redis
+from rq import Queue, Worker
+from rq.defaults import DEFAULT_JOB_MONITORING_INTERVAL
+from rq.exceptions import DequeueTimeout
+from rq.job import Job
+from rq.utils import utcnow
+from rq.worker import WorkerStatus
+
+import worker_tasks
+from app.config import settings
+from app.redis_pool import get_redis
+from app.services import gemini
+from app.services.queue import FairQueue
+
+# RQ func_name -> coroutine implementation. Anything else runs in a thread.
+ASYNC_HANDLERS = {
+    "worker_tasks.handle_gemini_message": worker_tasks.ahandle_gemini_message,
+}
+
+DEQUEUE_TIMEOUT = 1  # seconds; bounds how long a SIGTERM waits for BLPOP to return
+
+
+class AsyncWorker:
+    def __init__(self, queue_names, connection: Redis, concurrency: int, drain_timeout: float):
+        self.connection = connection
+        self.queues = [FairQueue(name, connection=connection) for name in queue_names]
+        self.concurrency = concurrency
+        self.drain_timeout = drain_timeout
+        self.name = f"async.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:6]}"
+        # Never started; it only holds this process's RQ worker record
+        self.record = Worker(self.queues, connection=connection, name=self.name, queue_class=FairQueue)
+        self._running = {}  # asyncio.Task -> (job, queue)
+        self._stop = None
+        self._force_stop = None
+
+    # ---- RQ bookkeeping (blocking Redis calls, run off the loop) ----
+
+    def _dequeue(self):
+        # Same weighted, per-user fair order as the classic worker
+        try:
+            return FairQueue.dequeue_any(self.queues, DEQUEUE_TIMEOUT, connection=self.connection)
+        except DequeueTimeout:
+            return None
+
+    def _heartbeat_ttl(self, job: Job) -> int:
+        return (job.timeout or Queue.DEFAULT_TIMEOUT) + 60
+
+    def _mark_started(self, job: Job):
+        with self.connection.pipeline() as pipe:
+            job.prepare_for_execution(self.name, pipe)
+            job.heartbeat(utcnow(), self._heartbeat_ttl(job), pipeline=pipe)
+            pipe.execute()
+
+    def _heartbeat_all(self, jobs):
+        with self.connection.pipeline() as pipe:
+            self.record.heartbeat(pipeline=pipe)
+            self.record.set_state(WorkerStatus.BUSY if jobs else WorkerStatus.IDLE, pipeline=pipe)
+            for job in jobs:
+                job.heartbeat(utcnow(), self._heartbeat_ttl(job), pipeline=pipe, xx=True)
+            pipe.execute()
+        if self.record.should_run_maintenance_tasks:
+            self.record.clean_registries()
+
+    def _register_birth(self):
+        self.record.register_birth()
+        self.record.set_state(WorkerStatus.STARTED)
+        self.record.clean_registries()
+
+    def _mark_finished(self, job: Job, queue: Queue, rv):
+        job.ended_at = utcnow()
+        job._result = rv  # what Job.perform sets for the jobs RQ runs itself
+        if job.success_callback:
+            job.success_callback(job, self.connection, rv)
+        self.record.handle_job_success(job, queue, queue.started_job_registry)
+
+    def _mark_failed(self, job: Job, queue: Queue, exc_info):
+        job.ended_at = utcnow()
+        exc_string = "".join(traceback.format_exception(*exc_info))
+        if job.failure_callback:
+            try:
+                job.failure_callback(job, self.connection, *exc_info)
+            except Exception:
+                exc_string = traceback.format_exc()
+        # Retries the job if it has retries left, else moves it to FailedJobRegistry
+        self.record.handle_job_failure(job, queue, queue.started_job_registry, exc_string)
+
+    def _requeue(self, job: Job, queue: Queue):
+        # Interrupted by shutdown: hand it back untouched so another worker runs it
+        with self.connection.pipeline() as pipe:
+            queue.started_job_registry.remove(job, pipeline=pipe)
+            queue.enqueue_job(job, pipeline=pipe, at_front=True)
+            pipe.execute()
+
+    # ---- execution ----
+
+    async def _perform(self, job: Job, queue: Queue):
+        handler = ASYNC_HANDLERS.get(job.func_name)
+        timeout = job.timeout if job.timeout and job.timeout > 0 else None
+        try:
+            await asyncio.to_thread(self._mark_started, job)
+            if handler is not None:
+                coro = handler(*job.args, **job.kwargs)
+            else:
+                coro = asyncio.to_thread(job.perform)
+            rv = await asyncio.wait_for(coro, timeout=timeout)
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self._requeue, job, queue)
+            logger.warning(f"Job {job.id} interrupted by shutdown; requeued")
+            raise
+        except Exception:
+            exc_info = sys.exc_info()
+            logger.exception(f"Job {job.id} ({job.func_name}) failed")
+            await asyncio.to_thread(self._mark_failed, job, queue, exc_info)
+            return
+        await asyncio.to_thread(self._mark_finished, job, queue, rv)
+        logger.info(f"{job.origin}: Job OK ({job.id})")
+
+    async def _heartbeats(self):
+        while True:
+            await asyncio.sleep(DEFAULT_JOB_MONITORING_INTERVAL)
+            jobs = [job for job, _ in self._running.values()]
+            try:
+                await asyncio.to_thread(self._heartbeat_all, jobs)
+            except Exception as e:
+                logger.warning(f"Heartbeat failed. err={e}")
+
+    def _on_signal(self):
+        if self._stop.is_set():
+            logger.warning("Second shutdown signal; cancelling in-flight jobs")
+            self._force_stop.set()
+        else:
+            logger.info(f"Shutdown requested; draining {len(self._running)} in-flight job(s)")
+            self._stop.set()
+
+    async def work(self):
+        self._stop = asyncio.Event()
+        self._force_stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self._on_signal)
+
+        await asyncio.to_thread(self._register_birth)
+        slots = asyncio.Semaphore(self.concurrency)
+        heartbeats = asyncio.create_task(self._heartbeats())
+        logger.info(
+            f"Async worker {self.name} listening on {[q.name for q in self.queues]} "
+            f"(concurrency={self.concurrency})"
+        )
+
+        try:
+            while not self._stop.is_set():
+                # Only take a job off the queue once there is room to run it,
+                # but stop waiting for one as soon as shutdown is requested
+                acquire = asyncio.ensure_future(slots.acquire())
+                stop = asyncio.ensure_future(self._stop.wait())
+                await asyncio.wait({acquire, stop}, return_when=asyncio.FIRST_COMPLETED)
+                stop.cancel()
+                if not acquire.done():
+                    acquire.cancel()
+                    break
+                if self._stop.is_set():
+                    slots.release()
+                    break
+                try:
+                    dequeued = await asyncio.to_thread(self._dequeue)
+                except Exception as e:
+                    slots.release()
+                    logger.warning(f"Dequeue failed. err={e}")
+                    await asyncio.sleep(DEQUEUE_TIMEOUT)
+                    continue
+                if dequeued is None:
+                    slots.release()
+                    continue
+
+                job, queue = dequeued
+                task = asyncio.create_task(self._perform(job, queue))
+                self._running[task] = (job, queue)
+
+                def _done(t):
+                    self._running.pop(t, None)
+                    slots.release()
+
+                task.add_done_callback(_done)
+        finally:
+            await self._drain()
+            heartbeats.cancel()
+            try:
+                await asyncio.to_thread(self.record.register_death)
+            except Exception as e:
+                logger.warning(f"Could not unregister worker {self.name}. err={e}")
+            await gemini.aclose_clients()
+
+    async def _drain(self):
+        tasks = list(self._running)
+        if not tasks:
+            return
+        drained = asyncio.gather(*tasks, return_exceptions=True)
+        forced = asyncio.create_task(self._force_stop.wait())
+        await asyncio.wait({drained, forced}, timeout=self.drain_timeout, return_when=asyncio.FIRST_COMPLETED)
+        forced.cancel()
+
+        leftovers = [t for t in tasks if not t.done()]
+        if leftovers:
+            logger.warning(f"Drain incomplete; requeueing {len(leftovers)} job(s)")
+            for t in leftovers:
+                t.cancel()
+        await drained
+        logger.info("Async worker drained")
+
+
+def run(queue_names):
+    connection = get_redis(decode_responses=False, blocking=True)
+    worker = AsyncWorker(
+        queue_names,
+        connection=connection,
+        concurrency=settings.async_worker_concurrency,
+        drain_timeout=settings.async_worker_drain_timeout,
+    )
+    try:
+        asyncio.run(worker.work())
+    finally:
+        # Jobs run in threads (summaries) use the sync client
+        gemini.close_clients()
@@ -0,0 +1,75 @@
+"""
+Compare two bench/run.py result files, e.g. the last release against a branch.
+
+    python bench/compare.py bench/results/main.json bench/results/branch.json --threshold 10
+
+Prints p50/p95/p99 and throughput per endpoint with the relative change, and
+exits 1 when any p95 got worse (or throughput dropped) by more than
+--threshold percent, so it can gate CI.
+"""
+import argparse
+import json
+import sys
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def _load(path: str) -> dict:
+    with open(path) as f:
+        result = json.load(f)
+    rows = dict(result["endpoints"])
+    for kind, summary in result["enqueue_to_reply"].items():
+        if isinstance(summary, dict):
+            rows[f"enqueue->reply ({kind})"] = summary
+    return {"meta": result["meta"], "rows": rows}
+
+
+def _change(old, new):
+    if old in (None, 0) or new is None:
+        return None
+    return (new - old) / old * 100
+
+
+def _fmt(value, change):
+    if value is None:
+        return f"{'-':>17}"
+    delta = f"{change:+.1f}%" if change is not None else ""
+    return f"{value:9.1f} {delta:>7}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff two benchmark result files.")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10, help="regression tolerance in percent")
+    args = parser.parse_args()
+
+    base, cand = _load(args.baseline), _load(args.candidate)
+    print(f"baseline:  {base['meta'].get('label') or args.baseline} @ {base['meta'].get('git_revision')}")
+    print(f"candidate: {cand['meta'].get('label') or args.candidate} @ {cand['meta'].get('git_revision')}")
+    print(f"{'endpoint':34} " + " ".join(f"{m:>17}" for m in METRICS))
+
+    regressions = []
+    for name in sorted(set(base["rows"]) | set(cand["rows"])):
+        old, new = base["rows"].get(name, {}), cand["rows"].get(name, {})
+        cells = []
+        for metric in METRICS:
+            change = _change(old.get(metric), new.get(metric))
+            cells.append(_fmt(new.get(metric), change))
+            if change is None:
+                continue
+            if metric == "p95_ms" and change > args.threshold:
+                regressions.append(f"{name} p95 {change:+.1f}%")
+            if metric == "throughput_rps" and not name.startswith("enqueue->") and change < -args.threshold:
+                regressions.append(f"{name} throughput {change:+.1f}%")
+        print(f"{name:34} " + " ".join(cells))
+
+    if regressions:
+        print("\nregressions beyond {:.0f}%:".format(args.threshold))
+        for r in regressions:
+            print(f"  {r}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+"""
+Replay a captured traffic trace (TRAFFIC_CAPTURE_PATH) against a local instance.
+
+Every captured user becomes a fresh account and every chatroom it touched a
+fresh room, created before the clock starts. Requests are then sent at their
+recorded offsets, divided by --speed, with the same routes, long-poll waits,
+page sizes and body sizes. The report puts each route's replayed latency next
+to the recorded one (p50/p95/p99 and the per-request drift), plus how late the
+replayer itself was, and can be written as JSON.
+
+    python bench/replay.py traffic.jsonl --base-url http://localhost:8010 --speed 2 --out bench/results/replay.json
+
+Run it against the bench stack (bench/docker-compose.yml) so Gemini is the
+stub. Recorded times are measured inside the app; replayed ones by this
+client, so expect a small constant offset (loopback and HTTP parsing).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+from run import PERCENTILES, _git_revision, percentile, summarize
+
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+HELD_ROUTES = {"/chatroom/{chatroom_id}/stream"}  # replayed for load, not timed
+
+
+def _filler(size: int) -> str:
+    return (FILLER * (size // len(FILLER) + 1))[:max(1, size)]
+
+
+def load_trace(path: str, routes=None):
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            if rec.get("route") and (not routes or rec["route"] in routes):
+                records.append(rec)
+    records.sort(key=lambda r: r["t"])
+    return records
+
+
+class Session:
+    """A replayed user: its token, its rooms, and ids it has been handed back."""
+
+    def __init__(self, mobile: str):
+        self.mobile = mobile
+        self.headers = {}
+        self.jobs = []
+
+
+class Replayer:
+    def __init__(self, client: httpx.AsyncClient, args):
+        self.client = client
+        self.args = args
+        self.sessions = {}
+        self.rooms = {}  # hashed chatroom id -> (session, real id)
+        self.last_message = defaultdict(int)  # real chatroom id -> newest message id seen
+        self.latencies = defaultdict(list)
+        self.recorded = defaultdict(list)
+        self.drift = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.status_mismatches = Counter()
+        self.skipped = Counter()
+        self.lag = []
+        self.n = 0
+
+    def _mobile(self) -> str:
+        self.n += 1
+        return f"{self.args.mobile_prefix}{self.n:05d}"
+
+    async def _login(self, mobile: str) -> dict:
+        resp = await self.client.post("/auth/send-otp", json={"mobile": mobile})
+        otp = resp.json()["data"]["otp"]
+        resp = await self.client.post("/auth/verify-otp", json={"mobile": mobile, "otp": otp})
+        resp.raise_for_status()
+        return {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+    async def _create_room(self, session: Session, title: str) -> int:
+        resp = await self.client.post("/chatroom", json={"title": title}, headers=session.headers)
+        resp.raise_for_status()
+        return resp.json()["data"]["chatroom"]["id"]
+
+    async def setup(self, records):
+        """Accounts for every captured user and rooms for every captured chatroom."""
+        owners = {}
+        for rec in records:
+            if rec.get("user"):
+                self.sessions.setdefault(rec["user"], Session(self._mobile()))
+                room = (rec.get("params") or {}).get("chatroom_id")
+                if room:
+                    owners.setdefault(room, rec["user"])
+        sem = asyncio.Semaphore(self.args.setup_concurrency)
+
+        async def login(session):
+            async with sem:
+                session.headers = await self._login(session.mobile)
+
+        async def room(hashed, user):
+            async with sem:
+                session = self.sessions[user]
+                self.rooms[hashed] = (session, await self._create_room(session, f"replay {hashed[:6]}"))
+
+        await asyncio.gather(*(login(s) for s in self.sessions.values()))
+        await asyncio.gather(*(room(h, u) for h, u in owners.items()))
+
+    def _build(self, rec):
+        """(method, url, kwargs, session) for a captured request; None if it can't be replayed."""
+        method, route = rec["method"], rec["route"]
+        query = dict(rec.get("query") or {})
+        session = self.sessions.get(rec.get("user"))
+        headers = session.headers if session else {}
+        params = {k: v for k, v in query.items() if v != "*"}
+
+        chatroom_id = None
+        if "{chatroom_id}" in route:
+            room = self.rooms.get((rec.get("params") or {}).get("chatroom_id"))
+            if room is None:
+                return None
+            chatroom_id = room[1]
+            # Message ids are per run; point the cursor at the newest message seen
+            for cursor in ("since_id", "after_id", "before_id"):
+                if cursor in query:
+                    params[cursor] = self.last_message[chatroom_id] if cursor != "before_id" else self.last_message[chatroom_id] + 1
+        url = route.replace("{chatroom_id}", str(chatroom_id))
+
+        if route in ("/auth/signup", "/auth/send-otp", "/auth/forgot-password"):
+            return method, url, {"json": {"mobile": self._mobile()}}, None
+        if route == "/auth/verify-otp":
+            return method, url, {"verify_otp": True}, None
+        if route == "/chatroom" and method == "POST":
+            return method, url, {"json": {"title": _filler(max(1, rec["req_bytes"] - 12))[:255]}, "headers": headers}, session
+        if route == "/chatroom/{chatroom_id}/message":
+            content = _filler(max(1, rec["req_bytes"] - 40))
+            return method, url, {"json": {"content": content}, "headers": headers}, session
+        if route == "/jobs/{job_id}":
+            if not session or not session.jobs:
+                return None
+            return method, f"/jobs/{session.jobs[-1]}", {"headers": headers}, session
+        if route == "/jobs":
+            if not session or not session.jobs:
+                return None
+            params["ids"] = ",".join(session.jobs[-5:])
+            return method, url, {"params": params, "headers": headers}, session
+        if "{" in url or method not in ("GET", "DELETE"):
+            return None
+        return method, url, {"params": params, "headers": headers}, session
+
+    async def _send(self, method, url, kwargs, rec):
+        if kwargs.pop("verify_otp", False):
+            mobile = self._mobile()
+            otp = (await self.client.post("/auth/send-otp", json={"mobile": mobile})).json()["data"]["otp"]
+            kwargs = {"json": {"mobile": mobile, "otp": otp}}
+        if rec["route"] in HELD_ROUTES:
+            # Hold the stream open for as long as the recorded one was
+            async with self.client.stream(method, url, timeout=None, **kwargs) as resp:
+                deadline = time.perf_counter() + rec["ms"] / 1000 / self.args.speed
+                try:
+                    async for _ in resp.aiter_raw():
+                        if time.perf_counter() >= deadline:
+                            break
+                except httpx.HTTPError:
+                    pass
+                return resp
+        timeout = float(kwargs.get("params", {}).get("wait", 0) or 0) + self.args.timeout
+        return await self.client.request(method, url, timeout=timeout, **kwargs)
+
+    async def play(self, rec, due: float, after=None):
+        if after is not None:
+            # This request started after the user's previous one finished (it may
+            # need that reply's ids); keep that order, the wait counts as lag
+            await asyncio.gather(after, return_exceptions=True)
+        built = self._build(rec)
+        if built is None:
+            self.skipped[rec["route"]] += 1
+            return
+        method, url, kwargs, session = built
+        name = f"{rec['method']} {rec['route']}"
+        self.lag.append(max(0.0, time.perf_counter() - due) * 1000)
+        t0 = time.perf_counter()
+        try:
+            resp = await self._send(method, url, kwargs, rec)
+            status = resp.status_code
+        except httpx.HTTPError as e:
+            resp, status = None, type(e).__name__
+        ms = (time.perf_counter() - t0) * 1000
+
+        self.statuses[name][str(status)] += 1
+        if status != rec["status"]:
+            self.status_mismatches[name] += 1
+        if rec["route"] not in HELD_ROUTES:
+            self.latencies[name].append(ms)
+            self.recorded[name].append(rec["ms"])
+            self.drift[name].append(ms - rec["ms"])
+        if resp is not None and status == 200 and rec["route"] not in HELD_ROUTES:
+            self._remember(rec["route"], resp, session, url)
+
+    def _remember(self, route, resp, session, url):
+        try:
+            data = resp.json().get("data") or {}
+        except ValueError:
+            return
+        if route == "/chatroom/{chatroom_id}/message":
+            chatroom_id = int(url.split("/")[2])
+            self.last_message[chatroom_id] = max(self.last_message[chatroom_id], data.get("message_id") or 0)
+            if session and data.get("job_id"):
+                session.jobs.append(data["job_id"])
+        elif route == "/chatroom/{chatroom_id}/messages":
+            chatroom_id = int(url.split("/")[2])
+            for m in data.get("messages") or []:
+                self.last_message[chatroom_id] = max(self.last_message[chatroom_id], m["id"])
+
+    async def replay(self, records):
+        t_first = records[0]["t"]
+        started = time.perf_counter()
+        tasks = []
+        previous = {}  # user -> (task, recorded end) of its latest request
+        for rec in records:
+            due = started + (rec["t"] - t_first) / self.args.speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            after = None
+            if rec.get("user") in previous:
+                task, ended = previous[rec["user"]]
+                if rec["t"] >= ended:
+                    after = task
+            task = asyncio.create_task(self.play(rec, due, after))
+            if rec.get("user"):
+                ended = rec["t"] + rec["ms"] / 1000
+                if rec["user"] not in previous or ended >= previous[rec["user"]][1]:
+                    previous[rec["user"]] = (task, ended)
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - started
+
+
+def _drift_summary(replayed, recorded, drift) -> dict:
+    out = {}
+    for p in PERCENTILES:
+        r, c = percentile(sorted(replayed), p), percentile(sorted(recorded), p)
+        out[f"recorded_p{p}_ms"] = round(c, 2) if c is not None else None
+        out[f"drift_p{p}_ms"] = round(r - c, 2) if r is not None and c is not None else None
+        out[f"drift_p{p}_pct"] = round((r - c) / c * 100, 1) if r is not None and c else None
+    d = percentile(sorted(drift), 50)
+    out["per_request_drift_p50_ms"] = round(d, 2) if d is not None else None
+    return out
+
+
+def report(rp: Replayer, records, started_at: str, elapsed: float, args) -> dict:
+    trace_seconds = records[-1]["t"] - records[0]["t"] if records else 0
+    routes = {}
+    for name in sorted(rp.statuses):
+        entry = summarize(rp.latencies[name], elapsed)
+        entry.update(_drift_summary(rp.latencies[name], rp.recorded[name], rp.drift[name]))
+        entry["statuses"] = dict(rp.statuses[name])
+        entry["status_mismatches"] = rp.status_mismatches[name]
+        routes[name] = entry
+    return {
+        "meta": {
+            "label": args.label,
+            "git_revision": _git_revision(),
+            "started_at": started_at,
+            "trace": os.path.abspath(args.trace),
+            "trace_requests": len(records),
+            "trace_seconds": round(trace_seconds, 3),
+            "speed": args.speed,
+            "elapsed_seconds": round(elapsed, 3),
+            "users": len(rp.sessions),
+            "chatrooms": len(rp.rooms),
+        },
+        "endpoints": routes,
+        "schedule_lag": summarize(rp.lag, elapsed),
+        "skipped": dict(rp.skipped),
+    }
+
+
+def _print(result: dict):
+    meta = result["meta"]
+    print(f"{meta['trace_requests']} requests over {meta['trace_seconds']:.0f}s replayed at x{meta['speed']} "
+          f"in {meta['elapsed_seconds']:.0f}s ({meta['users']} users, {meta['chatrooms']} rooms)")
+    print(f"{'route':40} {'count':>6} {'p50':>8} {'rec p50':>8} {'p95':>8} {'rec p95':>8} {'drift95':>8} {'mismatch':>8}")
+    for name, s in result["endpoints"].items():
+        cells = [s["p50_ms"], s["recorded_p50_ms"], s["p95_ms"], s["recorded_p95_ms"], s["drift_p95_ms"]]
+        text = " ".join(f"{c:8.1f}" if c is not None else f"{'-':>8}" for c in cells)
+        print(f"{name:40} {s['count']:6d} {text} {s['status_mismatches']:8d}")
+    lag = result["schedule_lag"]
+    print(f"replayer lag p95: {lag['p95_ms']} ms; skipped: {result['skipped'] or 'none'}")
+
+
+async def main_async(args) -> dict:
+    records = load_trace(args.trace, set(args.route) if args.route else None)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("no replayable records in the trace")
+    started_at = datetime.now(timezone.utc).isoformat()
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        rp = Replayer(client, args)
+        await rp.setup(records)
+        elapsed = await rp.replay(records)
+    return report(rp, records, started_at, elapsed, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a captured traffic trace and report latency drift.")
+    parser.add_argument("trace", help="JSON-lines file written with TRAFFIC_CAPTURE_PATH")
+    parser.add_argument("--base-url", default=os.getenv("BENCH_BASE_URL", "http://localhost:8000"))
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression; 2 plays the trace twice as fast")
+    parser.add_argument("--route", action="append", help="only replay this route template (repeatable)")
+    parser.add_argument("--limit", type=int, default=0, help="only the first N requests")
+    parser.add_argument("--timeout", type=float, default=30, help="HTTP timeout on top of any long-poll wait")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--setup-concurrency", type=int, default=20)
+    parser.add_argument("--mobile-prefix", default=f"8{random.randint(0, 9999):04d}")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--out", default="")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    result = asyncio.run(main_async(args))
+    _print(result)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
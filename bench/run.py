@@ -0,0 +1,261 @@
+"""
+Scenario runner for the running API and workers.
+
+Each virtual user signs up, verifies an OTP and creates a chatroom. It then
+loops until the run ends: list chatrooms, send a message, long-poll until the
+assistant reply lands, then read the reply job's status. The run reports
+throughput and p50/p95/p99 per endpoint plus enqueue-to-reply latency (as
+seen by the client and as recorded by the worker), and writes everything to
+a JSON file that bench/compare.py can diff against an earlier run.
+
+    python bench/run.py --base-url http://localhost:8000 --users 50 --duration 120 --out bench/results/main.json
+
+Prompts are unique per message unless --repeat-prompts is given, so the
+reply cache doesn't hide the model path. Rate limits apply as configured;
+set RATE_LIMIT_BASIC_LIMIT=0 on the API for long runs.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+PERCENTILES = (50, 95, 99)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(Counter)
+        self.errors = Counter()
+
+    def add(self, name: str, seconds: float, status):
+        self.latencies[name].append(seconds * 1000)
+        self.statuses[name][str(status)] += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[name] += 1
+
+
+def percentile(sorted_values, p: float):
+    """Nearest-rank percentile of an already sorted list (None when empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def summarize(values, elapsed: float) -> dict:
+    values = sorted(values)
+    out = {
+        "count": len(values),
+        "throughput_rps": round(len(values) / elapsed, 3) if elapsed > 0 else None,
+        "mean_ms": round(sum(values) / len(values), 2) if values else None,
+        "max_ms": round(values[-1], 2) if values else None,
+    }
+    for p in PERCENTILES:
+        v = percentile(values, p)
+        out[f"p{p}_ms"] = round(v, 2) if v is not None else None
+    return out
+
+
+class VirtualUser:
+    def __init__(self, n: int, client: httpx.AsyncClient, rec: Recorder, args):
+        self.n = n
+        self.client = client
+        self.rec = rec
+        self.args = args
+        self.headers = {}
+        self.chatroom_id = None
+        self.sent = 0
+
+    async def call(self, name: str, method: str, url: str, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            resp = await self.client.request(method, url, headers=self.headers, **kwargs)
+        except httpx.HTTPError as e:
+            self.rec.add(name, time.perf_counter() - t0, type(e).__name__)
+            return None
+        self.rec.add(name, time.perf_counter() - t0, resp.status_code)
+        return resp
+
+    async def setup(self) -> bool:
+        mobile = f"{self.args.mobile_prefix}{self.n:05d}"
+        await self.call("POST /auth/signup", "POST", "/auth/signup", json={"mobile": mobile})
+        resp = await self.call("POST /auth/send-otp", "POST", "/auth/send-otp", json={"mobile": mobile})
+        if resp is None or resp.status_code != 200:
+            return False
+        otp = resp.json()["data"]["otp"]
+        resp = await self.call("POST /auth/verify-otp", "POST", "/auth/verify-otp", json={"mobile": mobile, "otp": otp})
+        if resp is None or resp.status_code != 200:
+            return False
+        self.headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+        resp = await self.call("POST /chatroom", "POST", "/chatroom", json={"title": f"bench {self.n}"})
+        if resp is None or resp.status_code != 200:
+            return False
+        self.chatroom_id = resp.json()["data"]["chatroom"]["id"]
+        return True
+
+    def _prompt(self) -> str:
+        if self.args.repeat_prompts:
+            return f"Benchmark question {self.sent % 5}: summarize the history of the fox."
+        return f"Benchmark question {self.n}-{self.sent}-{random.getrandbits(32):08x}: summarize the history of the fox."
+
+    async def turn(self):
+        await self.call("GET /chatroom", "GET", "/chatroom")
+
+        self.sent += 1
+        t_send = time.perf_counter()
+        resp = await self.call(
+            "POST /chatroom/{id}/message", "POST", f"/chatroom/{self.chatroom_id}/message",
+            json={"content": self._prompt()},
+        )
+        if resp is None or resp.status_code != 200:
+            return
+        data = resp.json()["data"]
+        message_id, job_id = data["message_id"], data["job_id"]
+
+        # Long-poll until the reply arrives (or the reply timeout passes)
+        give_up = t_send + self.args.reply_timeout
+        replied = False
+        while not replied and time.perf_counter() < give_up:
+            wait = min(self.args.poll_wait, max(0.0, give_up - time.perf_counter()))
+            resp = await self.call(
+                "GET /chatroom/{id}/messages", "GET", f"/chatroom/{self.chatroom_id}/messages",
+                params={"since_id": message_id, "wait": round(wait, 1)},
+                timeout=wait + self.args.timeout,
+            )
+            if resp is None or resp.status_code != 200:
+                await asyncio.sleep(0.5)
+                continue
+            replied = any(m["role"] == "assistant" for m in resp.json()["data"]["messages"])
+        if not replied:
+            self.rec.errors["reply_timeout"] += 1
+            return
+        self.rec.latencies["enqueue_to_reply_client"].append((time.perf_counter() - t_send) * 1000)
+
+        resp = await self.call("GET /jobs/{id}", "GET", f"/jobs/{job_id}")
+        if resp is not None and resp.status_code == 200:
+            server_ms = resp.json()["data"]["job"].get("enqueue_to_reply_ms")
+            if server_ms is not None:
+                self.rec.latencies["enqueue_to_reply_server"].append(float(server_ms))
+
+    async def run(self, deadline: float):
+        if not await self.setup():
+            self.rec.errors["setup_failed"] += 1
+            return
+        while time.perf_counter() < deadline:
+            if self.args.iterations and self.sent >= self.args.iterations:
+                return
+            await self.turn()
+            if self.args.think_ms:
+                await asyncio.sleep(random.uniform(0, 2 * self.args.think_ms) / 1000)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _fetch_metrics(client: httpx.AsyncClient, token: str):
+    try:
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        resp = await client.get("/metrics", headers=headers)
+        return resp.json() if resp.status_code == 200 else None
+    except (httpx.HTTPError, ValueError):
+        return None
+
+
+async def run(args) -> dict:
+    rec = Recorder()
+    started_at = datetime.now(timezone.utc).isoformat()
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + args.duration
+        users = []
+        for n in range(args.users):
+            users.append(asyncio.create_task(VirtualUser(n, client, rec, args).run(deadline)))
+            if args.ramp_up:
+                await asyncio.sleep(args.ramp_up / args.users)
+        await asyncio.gather(*users)
+        elapsed = time.perf_counter() - started
+        metrics = await _fetch_metrics(client, args.metrics_token)
+
+    endpoints = {}
+    for name in sorted(rec.statuses):
+        endpoints[name] = summarize(rec.latencies[name], elapsed)
+        endpoints[name]["errors"] = rec.errors[name]
+        endpoints[name]["statuses"] = dict(rec.statuses[name])
+    replies = {
+        "client": summarize(rec.latencies["enqueue_to_reply_client"], elapsed),
+        "server": summarize(rec.latencies["enqueue_to_reply_server"], elapsed),
+        "timeouts": rec.errors["reply_timeout"],
+    }
+    return {
+        "meta": {
+            "label": args.label,
+            "git_revision": _git_revision(),
+            "started_at": started_at,
+            "elapsed_seconds": round(elapsed, 3),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("out",)},
+        },
+        "endpoints": endpoints,
+        "enqueue_to_reply": replies,
+        "requests_total": sum(len(rec.latencies[n]) for n in rec.statuses),
+        "setup_failures": rec.errors["setup_failed"],
+        "server_metrics": metrics,
+    }
+
+
+def _print(result: dict):
+    print(f"{'endpoint':34} {'count':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'errors':>6}")
+    rows = list(result["endpoints"].items())
+    rows += [(f"enqueue->reply ({k})", v) for k, v in result["enqueue_to_reply"].items() if isinstance(v, dict)]
+    for name, s in rows:
+        cells = [f"{s[k]:8.1f}" if s[k] is not None else f"{'-':>8}" for k in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")]
+        print(f"{name:34} {s['count']:7d} {' '.join(cells)} {s.get('errors', ''):>6}")
+    print(f"reply timeouts: {result['enqueue_to_reply']['timeouts']}, setup failures: {result['setup_failures']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the API with scripted chat sessions and record latencies.")
+    parser.add_argument("--base-url", default=os.getenv("BENCH_BASE_URL", "http://localhost:8000"))
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to keep starting new turns")
+    parser.add_argument("--iterations", type=int, default=0, help="stop each user after this many messages (0: no limit)")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which users start")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause between turns")
+    parser.add_argument("--poll-wait", type=float, default=25, help="long-poll wait per request (seconds)")
+    parser.add_argument("--reply-timeout", type=float, default=120, help="give up on a reply after this long")
+    parser.add_argument("--timeout", type=float, default=30, help="HTTP timeout per request")
+    parser.add_argument("--repeat-prompts", action="store_true", help="reuse a few prompts to exercise the reply cache")
+    parser.add_argument("--mobile-prefix", default=f"9{random.randint(0, 9999):04d}", help="mobile numbers are prefix + user number")
+    parser.add_argument("--metrics-token", default=os.getenv("METRICS_TOKEN", ""), help="bearer token for GET /metrics")
+    parser.add_argument("--label", default="", help="free-form name stored with the results")
+    parser.add_argument("--out", default="", help="write the JSON results here")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    _print(result)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Local stand-in for the Gemini models endpoint, for load tests.
+
+Answers `POST /{model}:generateContent` and `POST /{model}:streamGenerateContent`
+(SSE) after a configurable delay, failing a configurable share of calls, so a
+benchmark measures this app rather than Google. Point the app at it with
+GEMINI_BASE_URL=http://<host>:<port>/v1beta/models.
+
+    python bench/stub_gemini.py --port 8081 --latency-ms 800 --jitter-ms 200 --error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+config = argparse.Namespace(
+    latency_ms=500.0,
+    jitter_ms=100.0,
+    error_rate=0.0,
+    error_status=503,
+    chunks=4,
+    chunk_delay_ms=50.0,
+    reply_words=40,
+)
+
+app = FastAPI(title="Gemini stub")
+
+WORDS = "the quick brown fox jumps over a lazy dog while benchmarks count every millisecond".split()
+
+
+def _latency() -> float:
+    return max(0.0, random.gauss(config.latency_ms, config.jitter_ms)) / 1000
+
+
+def _reply(prompt: str) -> str:
+    words = [random.choice(WORDS) for _ in range(config.reply_words)]
+    return f"STUB ({len(prompt)} chars): " + " ".join(words)
+
+
+def _candidate(text: str, finished: bool) -> dict:
+    cand = {"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}
+    if finished:
+        cand["finishReason"] = "STOP"
+    return {"candidates": [cand]}
+
+
+def _prompt(body: dict) -> str:
+    contents = body.get("contents") or [{}]
+    return "".join(p.get("text", "") for p in contents[-1].get("parts", []))
+
+
+def _failure():
+    if random.random() >= config.error_rate:
+        return None
+    headers = {"Retry-After": "1"} if config.error_status == 429 else None
+    return JSONResponse(
+        {"error": {"code": config.error_status, "message": "stub failure", "status": "UNAVAILABLE"}},
+        status_code=config.error_status,
+        headers=headers,
+    )
+
+
+@app.post("/v1beta/models/{target}")
+async def models(target: str, request: Request):
+    model, _, method = target.partition(":")
+    if method not in ("generateContent", "streamGenerateContent"):
+        return JSONResponse({"error": {"code": 404, "message": f"unknown method {method!r}"}}, status_code=404)
+    body = await request.json()
+    await asyncio.sleep(_latency())
+    failure = _failure()
+    if failure is not None:
+        return failure
+
+    text = _reply(_prompt(body))
+    if method == "generateContent":
+        return _candidate(text, finished=True)
+
+    async def events():
+        n = max(1, config.chunks)
+        words = text.split(" ")
+        step = -(-len(words) // n)
+        for i in range(0, len(words), step):
+            if i:
+                await asyncio.sleep(config.chunk_delay_ms / 1000)
+            piece = " ".join(words[i:i + step]) + ("" if i + step >= len(words) else " ")
+            yield f"data: {json.dumps(_candidate(piece, i + step >= len(words)))}\r\n\r\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=config.latency_ms, help="mean time to first byte")
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms, help="std deviation of the latency")
+    parser.add_argument("--error-rate", type=float, default=config.error_rate, help="share of calls that fail (0-1)")
+    parser.add_argument("--error-status", type=int, default=config.error_status, help="status of failed calls")
+    parser.add_argument("--chunks", type=int, default=config.chunks, help="SSE chunks per streamed reply")
+    parser.add_argument("--chunk-delay-ms", type=float, default=config.chunk_delay_ms)
+    parser.add_argument("--reply-words", type=int, default=config.reply_words)
+    args = parser.parse_args()
+    for name in vars(config):
+        setattr(config, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,9 @@ st.set_page_config(page_title="Gemini Backend Frontend", page_icon="✨", layout
 
 
 POLL_INTERVAL_SEC = 0.5     
-POLL_ATTEMPTS_SEND = 80     
-POLL_ATTEMPTS_REFRESH = 60   
+LONG_POLL_WAIT_SEC = 20      # server parks each request until a reply or this timeout
+POLL_ATTEMPTS_SEND = 2      
+POLL_ATTEMPTS_REFRESH = 2    
 
 
 if "base_url" not in st.session_state:
@@ -44,6 +45,10 @@ if "msg_input" not in st.session_state:
 if "clear_input_next_run" not in st.session_state:
     st.session_state.clear_input_next_run = False
 
+# GET url -> (ETag, body); unchanged chatroom reads come back as 304
+if "etag_cache" not in st.session_state:
+    st.session_state.etag_cache = {}
+
 
 def _headers(require_auth: bool = False):
     h = {"Content-Type": "application/json"}
@@ -54,14 +59,23 @@ def _headers(require_auth: bool = False):
 
 def api(method: str, path: str, json=None, params=None, require_auth=False, timeout=25):
     url = st.session_state.base_url.rstrip("/") + path
+    headers = _headers(require_auth)
+    cache_key = (url, tuple(sorted((params or {}).items())), st.session_state.token)
+    cached = st.session_state.etag_cache.get(cache_key) if method == "GET" else None
+    if cached:
+        headers["If-None-Match"] = cached[0]
     try:
         resp = requests.request(
-            method, url, headers=_headers(require_auth), json=json, params=params, timeout=timeout
+            method, url, headers=headers, json=json, params=params, timeout=timeout
         )
+        if resp.status_code == 304 and cached:
+            return cached[1], None
         ct = resp.headers.get("content-type", "")
         data = resp.json() if ct.startswith("application/json") else {"raw": resp.text}
         if not resp.ok:
             return None, f"{resp.status_code} {data}"
+        if method == "GET" and resp.headers.get("etag"):
+            st.session_state.etag_cache[cache_key] = (resp.headers["etag"], data)
         return data, None
     except Exception as e:
         return None, str(e)
@@ -76,21 +90,26 @@ def refresh_chatrooms():
 
 
 def poll_for_reply(chatroom_id: int, after_msg_id: int, attempts: int, status_ph=None) -> bool:
-    """Poll chatroom detail until an assistant message with id > after_msg_id appears."""
-    for i in range(attempts):
-        if status_ph and i % 4 == 0:  # update UI every ~2s
+    """Long-poll for messages newer than after_msg_id until an assistant reply appears."""
+    since_id = int(after_msg_id or 0)
+    for _ in range(attempts):
+        if status_ph:
             status_ph.info("Waiting for assistant reply…")
-        time.sleep(POLL_INTERVAL_SEC)
-        d2, e2 = api("GET", f"/chatroom/{chatroom_id}", require_auth=True)
+        d2, e2 = api(
+            "GET",
+            f"/chatroom/{chatroom_id}/messages",
+            params={"since_id": since_id, "wait": LONG_POLL_WAIT_SEC},
+            require_auth=True,
+            timeout=LONG_POLL_WAIT_SEC + 10,
+        )
         if e2:
+            time.sleep(POLL_INTERVAL_SEC)
             continue
-        msgs2 = ((d2.get("data") or {}).get("chatroom") or {}).get("messages", [])
-        newer_assist = [
-            m for m in msgs2
-            if (m.get("role") or "").lower() != "user" and int(m.get("id") or 0) > int(after_msg_id or 0)
-        ]
-        if newer_assist:
+        msgs2 = (d2.get("data") or {}).get("messages", [])
+        if any((m.get("role") or "").lower() != "user" for m in msgs2):
             return True
+        if msgs2:
+            since_id = max(int(m.get("id") or 0) for m in msgs2)
     return False
 
 
@@ -0,0 +1,44 @@
+"""messages (chatroom_id, id) index and chatroom_summaries
+
+Both were previously added by `create_all`, which creates missing tables but
+never adds indexes to existing ones. Both use IF NOT EXISTS, so stamped
+databases converge whichever way they got here.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 12:31:02.410518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # IF NOT EXISTS rather than an inspector, so `upgrade --sql` works too
+    op.create_index('ix_messages_chatroom_id_id', 'messages', ['chatroom_id', 'id'], unique=False, if_not_exists=True)
+    metadata = sa.MetaData()
+    # Only for the foreign key below to resolve; not created
+    sa.Table('chatrooms', metadata, sa.Column('id', sa.Integer(), primary_key=True))
+    summaries = sa.Table('chatroom_summaries', metadata,
+    sa.Column('chatroom_id', sa.Integer(), nullable=False),
+    sa.Column('content', sa.Text(), nullable=False),
+    sa.Column('through_message_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['chatroom_id'], ['chatrooms.id'], ),
+    sa.PrimaryKeyConstraint('chatroom_id')
+    )
+    op.execute(sa.schema.CreateTable(summaries, if_not_exists=True))
+
+
+def downgrade() -> None:
+    op.drop_table('chatroom_summaries')
+    op.drop_index('ix_messages_chatroom_id_id', table_name='messages')
@@ -0,0 +1,46 @@
+import asyncio
+
+from rq import Worker
+from rq.job import JobStatus
+
+import async_worker
+from app.services import queue
+from app.services.queue import BASIC, enqueue_gemini_message, redis_conn
+
+
+def _run_until(worker, done, seen):
+    async def main():
+        task = asyncio.create_task(worker.work())
+        for _ in range(200):
+            await asyncio.sleep(0.05)
+            seen.update(w.name for w in Worker.all(connection=redis_conn))
+            if done():
+                break
+        worker._on_signal()
+        await task
+
+    asyncio.run(main())
+
+
+def test_jobs_are_run_and_recorded_by_a_registered_worker(monkeypatch):
+    async def handle(chatroom_id, user_message_id, **_):
+        if user_message_id == 2:
+            raise RuntimeError("boom")
+        return user_message_id * 10
+
+    monkeypatch.setitem(async_worker.ASYNC_HANDLERS, "worker_tasks.handle_gemini_message", handle)
+    ok = enqueue_gemini_message(1, 1, user_id=1)
+    failed = enqueue_gemini_message(1, 2, user_id=2)
+    worker = async_worker.AsyncWorker(
+        [queue.queue_name(BASIC)], connection=redis_conn, concurrency=2, drain_timeout=1
+    )
+
+    seen = set()
+    finished = {JobStatus.FINISHED, JobStatus.FAILED}
+    _run_until(worker, lambda: {ok.get_status(), failed.get_status()} <= finished, seen)
+
+    assert ok.get_status() == JobStatus.FINISHED and ok.return_value() == 10
+    assert failed.get_status() == JobStatus.FAILED
+    assert failed.id in queue.gemini_queues[BASIC].failed_job_registry
+    assert worker.name in seen
+    assert Worker.all(connection=redis_conn) == []  # unregistered on exit
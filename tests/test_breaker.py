@@ -0,0 +1,74 @@
+import time
+
+import pytest
+
+from app.services import breaker
+from app.services.breaker import CLOSED, HALF_OPEN, OPEN
+
+MODEL = "m"
+
+
+@pytest.fixture(autouse=True)
+def fast_breaker(monkeypatch):
+    monkeypatch.setattr(breaker.settings, "gemini_breaker_min_calls", 4)
+    monkeypatch.setattr(breaker.settings, "gemini_breaker_failure_ratio", 0.5)
+    monkeypatch.setattr(breaker.settings, "gemini_breaker_open_seconds", 0.1)
+    monkeypatch.setattr(breaker.settings, "gemini_breaker_slow_seconds", 1)
+
+
+def _trip():
+    for ok in (True, False, True, False):
+        breaker.record(MODEL, ok, 0.01)
+
+
+def test_opens_once_enough_calls_fail():
+    breaker.record(MODEL, False, 0.01)
+    breaker.record(MODEL, False, 0.01)
+    assert breaker.allow(MODEL)  # too few calls to judge
+    _trip()
+    assert breaker.states(MODEL) == {MODEL: OPEN}
+    assert not breaker.allow(MODEL)
+
+
+def test_slow_calls_count_as_failures():
+    for _ in range(4):
+        breaker.record(MODEL, True, 2)
+    assert not breaker.allow(MODEL)
+
+
+def test_single_probe_after_the_open_period_decides():
+    _trip()
+    time.sleep(0.15)
+    assert breaker.states(MODEL) == {MODEL: HALF_OPEN}
+    probe = breaker.allow(MODEL)
+    assert probe and probe != CLOSED
+    assert breaker.allow(MODEL) is None  # everyone else waits for it
+
+    breaker.record(MODEL, False, 0.01, probe)
+    assert breaker.states(MODEL) == {MODEL: OPEN}
+    time.sleep(0.15)
+    probe = breaker.allow(MODEL)
+    breaker.record(MODEL, True, 0.01, probe)
+    assert breaker.states(MODEL) == {MODEL: CLOSED}
+    assert breaker.allow(MODEL) == breaker.allow(MODEL) == CLOSED
+
+
+def test_calls_from_before_the_trip_do_not_decide():
+    early = breaker.allow(MODEL)  # starts while the breaker is still closed
+    _trip()
+    breaker.record(MODEL, True, 0.01, early)
+    assert breaker.states(MODEL) == {MODEL: OPEN}
+
+    time.sleep(0.15)
+    probe = breaker.allow(MODEL)
+    breaker.record(MODEL, True, 0.01, early)
+    breaker.record(MODEL, False, 0.01, early)
+    assert breaker.states(MODEL) == {MODEL: HALF_OPEN}
+    assert breaker.allow(MODEL) is None  # the probe is still out
+
+    breaker.record(MODEL, True, 0.01, probe)
+    assert breaker.states(MODEL) == {MODEL: CLOSED}
+
+
+def test_calls_go_through_while_redis_is_down(redis_down):
+    assert breaker.allow(MODEL) == CLOSED
@@ -0,0 +1,61 @@
+import asyncio
+
+import orjson
+
+from app import cache
+
+
+def _list(*ids) -> bytes:
+    return orjson.dumps([{"id": i} for i in ids])
+
+
+def test_concurrent_misses_share_one_load():
+    loads = []
+
+    async def load():
+        loads.append(1)
+        await asyncio.sleep(0.05)
+        return _list(1)
+
+    async def main():
+        return await asyncio.gather(*(cache.aget_chatrooms(7, load) for _ in range(5)))
+
+    results = asyncio.run(main())
+    assert len(loads) == 1
+    assert {entry.raw for entry, _ in results} == {_list(1)}
+
+    entry, cached = asyncio.run(cache.aget_chatrooms(7, load))
+    assert cached and entry.rows == [{"id": 1}]
+    assert len(loads) == 1
+
+
+def test_create_edits_the_cached_list_in_place():
+    async def load():
+        return _list(1)
+
+    async def main():
+        await cache.aget_chatrooms(7, load)
+        await cache.aupdate_cached_chatrooms(7, lambda rows: [{"id": 2}] + rows)
+        return await cache.aget_chatrooms(7, load)
+
+    entry, cached = asyncio.run(main())
+    assert cached and entry.rows == [{"id": 2}, {"id": 1}]
+
+
+def test_load_that_predates_a_create_does_not_fill_the_cache():
+    async def stale_load():
+        # A chatroom is created while this (older) list is being read
+        await cache.aupdate_cached_chatrooms(7, lambda rows: [{"id": 2}] + rows)
+        return _list(1)
+
+    async def fresh_load():
+        return _list(2, 1)
+
+    async def main():
+        first, _ = await cache.aget_chatrooms(7, stale_load)
+        second, cached = await cache.aget_chatrooms(7, fresh_load)
+        return first, second, cached
+
+    first, second, cached = asyncio.run(main())
+    assert first.rows == [{"id": 1}]  # this request still answers with what it read
+    assert not cached and second.rows == [{"id": 2}, {"id": 1}]
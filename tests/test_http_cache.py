@@ -0,0 +1,83 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+from app import http_cache, models
+from app.auth import create_access_token
+from app.database import SessionLocal
+from app.main import app
+
+
+@pytest.fixture
+def client():
+    db = SessionLocal()
+    try:
+        db.add(models.User(mobile="9000000002", tier=models.Tier.PRO))
+        db.commit()
+    finally:
+        db.close()
+    # No `with`: the lifespan (invalidation listener, pool teardown) isn't needed
+    c = TestClient(app)
+    c.headers["Authorization"] = f"Bearer {create_access_token('9000000002')}"
+    return c
+
+
+def _revalidate(client, url, etag):
+    return client.get(url, headers={"If-None-Match": etag})
+
+
+def test_unchanged_chatroom_list_is_a_304_until_a_chatroom_is_created(client):
+    first = client.get("/chatroom")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    again = _revalidate(client, "/chatroom", etag)
+    assert again.status_code == 304
+    assert again.content == b""
+
+    client.post("/chatroom", json={"title": "new"})
+    changed = _revalidate(client, "/chatroom", etag)
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert [c["title"] for c in changed.json()["data"]["chatrooms"]] == ["new"]
+
+
+def test_room_etag_changes_when_a_message_is_stored(client):
+    room = client.post("/chatroom", json={"title": "t"}).json()["data"]["chatroom"]["id"]
+    url = f"/chatroom/{room}"
+    etag = client.get(url).headers["ETag"]
+    assert _revalidate(client, url, etag).status_code == 304
+    # Weak comparison, and any tag in a list may match
+    assert _revalidate(client, url, f'"other", {etag[2:]}').status_code == 304
+    # Each page of the room has its own tag
+    assert client.get(url, params={"limit": 5}).headers["ETag"] != etag
+
+    assert client.post(f"{url}/message", json={"content": "hello"}).status_code == 200
+    changed = _revalidate(client, url, etag)
+    assert changed.status_code == 200
+    assert [m["content"] for m in changed.json()["data"]["chatroom"]["messages"]] == ["hello"]
+
+
+def test_without_redis_reads_carry_no_etag(client, redis_down):
+    resp = client.get("/chatroom")
+    assert resp.status_code == 200
+    assert "ETag" not in resp.headers
+
+
+def test_event_streams_are_never_gzipped_whatever_their_path():
+    inner = FastAPI()
+
+    @inner.get("/events")
+    async def events():
+        return StreamingResponse(iter([b"data: x\n\n"] * 500), media_type="text/event-stream")
+
+    @inner.get("/stream")
+    async def not_an_event_stream():
+        return JSONResponse({"data": "x" * 5000})
+
+    c = TestClient(http_cache.CompressionMiddleware(inner))
+    headers = {"Accept-Encoding": "gzip"}
+    assert "Content-Encoding" not in c.get("/events", headers=headers).headers
+    assert c.get("/stream", headers=headers).headers["Content-Encoding"] == "gzip"
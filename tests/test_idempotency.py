@@ -0,0 +1,63 @@
+import asyncio
+
+from app import idempotency
+from app.idempotency import COMMITTED, IN_PROGRESS, MISMATCH, NEW, REPLAY, UNAVAILABLE
+
+FP = idempotency.fingerprint(chatroom_id=1, content="hi", bypass_cache=False)
+
+
+def _claim(key="k", fp=FP):
+    return asyncio.run(idempotency.aclaim("message", 1, key, fp))
+
+
+def test_completed_request_is_replayed():
+    claim = _claim()
+    assert claim.status == NEW
+    assert _claim().status == IN_PROGRESS
+
+    asyncio.run(idempotency.acomplete(claim, {"ok": True, "data": {"message_id": 7}}))
+    replay = _claim()
+    assert replay.status == REPLAY
+    assert replay.response == {"ok": True, "data": {"message_id": 7}}
+
+
+def test_same_key_for_another_request_is_a_mismatch():
+    _claim()
+    assert _claim(fp=idempotency.fingerprint(chatroom_id=1, content="other")).status == MISMATCH
+    assert _claim(key="other-key").status == NEW  # keys are independent
+
+
+def test_release_before_insert_lets_the_retry_run():
+    claim = _claim()
+    asyncio.run(idempotency.arelease(claim))
+    assert _claim().status == NEW
+
+
+def test_release_after_insert_makes_the_retry_only_enqueue():
+    claim = _claim()
+    asyncio.run(idempotency.acommitted(claim, 42))
+    assert _claim().status == IN_PROGRESS  # the first attempt may still finish
+
+    asyncio.run(idempotency.arelease(claim, 42))
+    retry = _claim()
+    assert (retry.status, retry.message_id) == (COMMITTED, 42)
+    assert _claim().status == IN_PROGRESS  # the retry owns it now
+
+
+def test_expired_owner_cannot_overwrite_the_new_claim():
+    stale = _claim()
+    # The claim expires while `stale` is still running
+    asyncio.run(idempotency.async_redis_client.delete(stale.key))
+    fresh = _claim()
+    assert fresh.status == NEW
+
+    asyncio.run(idempotency.acomplete(stale, {"from": "stale"}))
+    asyncio.run(idempotency.arelease(stale, 1))
+    assert _claim().status == IN_PROGRESS
+
+    asyncio.run(idempotency.acomplete(fresh, {"from": "fresh"}))
+    assert _claim().response == {"from": "fresh"}
+
+
+def test_requests_run_unguarded_while_redis_is_down(redis_down):
+    assert _claim().status == UNAVAILABLE
@@ -0,0 +1,77 @@
+from app.services import queue
+from app.services.queue import BASIC, PRO, FairQueue, enqueue_gemini_message, redis_conn
+
+QUEUES = [queue.gemini_queues[PRO], queue.gemini_queues[BASIC]]
+
+
+def _send(user_id: int, message_id: int, priority: str = BASIC):
+    return enqueue_gemini_message(1, message_id, user_id=user_id, priority=priority)
+
+
+def _drain(n: int):
+    picked = []
+    for _ in range(n):
+        job, q = FairQueue.dequeue_any(QUEUES, None, connection=redis_conn)
+        picked.append((q.fair_class, job.meta["user_id"], job.args[1]))
+    return picked
+
+
+def test_users_within_a_plan_take_turns():
+    for message_id in (1, 2, 3):
+        _send(user_id=1, message_id=message_id)
+    _send(user_id=2, message_id=4)
+
+    assert [m for _, _, m in _drain(4)] == [1, 4, 2, 3]
+    assert FairQueue.dequeue_any(QUEUES, None, connection=redis_conn) is None
+
+
+def test_plans_share_dequeues_by_weight(monkeypatch):
+    monkeypatch.setattr(queue.settings, "queue_weight_pro", 3)
+    monkeypatch.setattr(queue.settings, "queue_weight_basic", 1)
+    for n in range(8):
+        _send(user_id=n, message_id=n, priority=PRO)
+        _send(user_id=100 + n, message_id=100 + n, priority=BASIC)
+
+    classes = [cls for cls, _, _ in _drain(8)]
+    assert classes.count(PRO) == 6 and classes.count(BASIC) == 2
+    # An idle class gives its turns away
+    assert [cls for cls, _, _ in _drain(8)] == [PRO, PRO] + [BASIC] * 6
+
+
+def test_requeued_job_goes_back_to_the_front_of_its_users_line():
+    first = _send(user_id=1, message_id=1)
+    _send(user_id=1, message_id=2)
+    job, q = FairQueue.dequeue_any(QUEUES, None, connection=redis_conn)
+    assert job.id == first.id
+
+    job.started_at = queue.utcnow()  # it ran, then RQ put it back (retry / shutdown)
+    q.enqueue_job(job)
+    assert [m for _, _, m in _drain(2)] == [1, 2]
+
+
+def test_cancelled_jobs_are_skipped():
+    cancelled = _send(user_id=1, message_id=1)
+    _send(user_id=1, message_id=2)
+    cancelled.cancel()
+
+    assert [m for _, _, m in _drain(1)] == [2]
+    assert FairQueue.dequeue_any(QUEUES, None, connection=redis_conn) is None
+
+
+def test_stats_report_depth_and_waiting_users():
+    _send(user_id=1, message_id=1)
+    _send(user_id=1, message_id=2)
+    _send(user_id=2, message_id=3, priority=PRO)
+    stats = queue.stats()
+
+    assert (stats[BASIC]["depth"], stats[BASIC]["waiting_users"]) == (2, 1)
+    assert (stats[PRO]["depth"], stats[PRO]["waiting_users"]) == (1, 1)
+    _drain(3)
+    assert queue.stats()[BASIC]["depth"] == 0
+
+
+def test_count_includes_the_fair_index():
+    _send(user_id=1, message_id=1)
+    _send(user_id=2, message_id=2)
+    assert queue.gemini_queues[BASIC].count == 2
+    assert queue.gemini_queues[PRO].count == 0
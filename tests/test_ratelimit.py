@@ -0,0 +1,56 @@
+import asyncio
+
+from app import ratelimit
+from app.models import Tier
+from app.ratelimit import SLIDING_WINDOW, TOKEN_BUCKET, RateLimitPolicy
+
+
+def _consume(name, policy, cost=1):
+    return asyncio.run(ratelimit.aconsume(name, policy, cost))
+
+
+def test_sliding_window_refuses_past_the_limit_with_a_retry_after():
+    policy = RateLimitPolicy(limit=3, window_seconds=60, strategy=SLIDING_WINDOW)
+    results = [_consume("sw", policy) for _ in range(4)]
+
+    assert [r.allowed for r in results] == [True, True, True, False]
+    assert [r.remaining for r in results[:3]] == [2, 1, 0]
+    assert 0 < results[-1].retry_after <= 120
+    assert ratelimit.retry_after_header(results[-1])["Retry-After"].isdigit()
+
+
+def test_token_bucket_allows_a_burst_then_waits_for_refill():
+    policy = RateLimitPolicy(limit=2, window_seconds=10, strategy=TOKEN_BUCKET)
+    results = [_consume("tb", policy) for _ in range(3)]
+
+    assert [r.allowed for r in results] == [True, True, False]
+    # One token refills every window / limit seconds
+    assert 0 < results[-1].retry_after <= 5
+
+
+def test_prompt_limit_follows_the_plan(monkeypatch):
+    monkeypatch.setattr(ratelimit.settings, "rate_limit_basic_limit", 1)
+    monkeypatch.setattr(ratelimit.settings, "rate_limit_pro_limit", 0)
+
+    assert asyncio.run(ratelimit.acheck_prompt_limit(1, Tier.BASIC)).allowed
+    assert not asyncio.run(ratelimit.acheck_prompt_limit(1, Tier.BASIC)).allowed
+    assert asyncio.run(ratelimit.acheck_prompt_limit(1, Tier.PRO)) is None  # unlimited
+
+
+def test_consume_all_charges_every_bucket_or_none():
+    rpm = RateLimitPolicy(limit=10, window_seconds=60, strategy=TOKEN_BUCKET)
+    tpm = RateLimitPolicy(limit=100, window_seconds=60, strategy=TOKEN_BUCKET)
+
+    assert asyncio.run(ratelimit.aconsume_all([("rpm", rpm, 1), ("tpm", tpm, 80)])) == 0
+    # TPM is short: the request is refused and RPM keeps its tokens
+    retry = asyncio.run(ratelimit.aconsume_all([("rpm", rpm, 1), ("tpm", tpm, 80)]))
+    assert retry > 0
+    assert ratelimit.consume_all([("rpm", rpm, 9)]) == 0
+
+
+def test_local_limiter_takes_over_while_redis_is_down(redis_down):
+    policy = RateLimitPolicy(limit=1, window_seconds=60, strategy=SLIDING_WINDOW)
+
+    assert _consume("local", policy).allowed
+    assert not _consume("local", policy).allowed
+    assert "local" in ratelimit._local._state
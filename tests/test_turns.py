@@ -0,0 +1,110 @@
+import time
+
+import pytest
+
+import worker_tasks
+from app import models
+from app.config import settings
+from app.database import SessionLocal
+from app.services import jobs, turns
+
+
+@pytest.fixture
+def room():
+    db = SessionLocal()
+    try:
+        user = models.User(mobile="9000000001", tier=models.Tier.BASIC)
+        db.add(user)
+        db.flush()
+        chatroom = models.Chatroom(user_id=user.id, title="t")
+        db.add(chatroom)
+        db.commit()
+        return chatroom.id
+    finally:
+        db.close()
+
+
+def _add_message(chatroom_id: int, text: str) -> int:
+    db = SessionLocal()
+    try:
+        msg = models.Message(chatroom_id=chatroom_id, role="user", content=text)
+        db.add(msg)
+        db.commit()
+        return msg.id
+    finally:
+        db.close()
+
+
+def _replied(message_id: int) -> bool:
+    return bool(jobs.redis_conn.hgetall(jobs._reply_key(message_id)))
+
+
+@pytest.fixture
+def enqueued(monkeypatch):
+    calls = []
+    monkeypatch.setattr(worker_tasks, "enqueue_gemini_message", lambda *a, **kw: calls.append(a))
+    return calls
+
+
+def _run(calls):
+    while calls:
+        worker_tasks.handle_gemini_message(*calls.pop(0))
+
+
+def test_failed_coalesced_turn_is_answered_by_hand_over(room, enqueued, monkeypatch):
+    first = _add_message(room, "one")
+    later = []
+
+    def gemini(user_text, **_):
+        if not later:
+            # Two more messages arrive while the first reply is generating
+            for text in ("two", "three"):
+                later.append(_add_message(room, text))
+                assert worker_tasks.handle_gemini_message(room, later[-1]) is None
+            yield "reply one"
+        else:
+            raise RuntimeError("Gemini went away")
+
+    monkeypatch.setattr(worker_tasks, "stream_gemini_response", gemini)
+    with pytest.raises(RuntimeError):
+        worker_tasks.handle_gemini_message(room, first)
+    assert _replied(first)
+    assert not any(_replied(m) for m in later)
+    assert enqueued == [(room, 0)]
+
+    monkeypatch.setattr(worker_tasks, "stream_gemini_response", lambda user_text, **_: iter(["reply"]))
+    _run(enqueued)
+    assert all(_replied(m) for m in later)
+    assert turns.release(room, "anyone") == 0
+
+
+def test_turn_of_dead_worker_is_recovered_on_start(room, enqueued, monkeypatch):
+    message = _add_message(room, "hello")
+    # A worker took the turn, then died; its lease runs out
+    assert turns.claim(room, message, turns.new_token()) == [message]
+    turns.redis_client.delete(turns._keys(room)[1])
+
+    assert worker_tasks.recover_orphaned_turns() == 1
+    monkeypatch.setattr(worker_tasks, "stream_gemini_response", lambda user_text, **_: iter(["reply"]))
+    _run(enqueued)
+    assert _replied(message)
+    assert turns.orphaned() == []
+
+
+def test_lease_is_renewed_while_a_slow_turn_generates(room, enqueued, monkeypatch):
+    monkeypatch.setattr(settings, "chatroom_turn_lease", 1)
+    first = _add_message(room, "one")
+    later = []
+
+    def gemini(user_text, **_):
+        if not later:
+            time.sleep(1.5)  # outlives one lease
+            later.append(_add_message(room, "two"))
+            # Still held, so the new message waits for this job's next turn
+            assert worker_tasks.handle_gemini_message(room, later[-1]) is None
+        yield f"reply to {user_text}"
+
+    monkeypatch.setattr(worker_tasks, "stream_gemini_response", gemini)
+    worker_tasks.handle_gemini_message(room, first)
+    assert _replied(first) and _replied(later[0])
+    assert enqueued == []
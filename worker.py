@@ -1,12 +1,13 @@
 import os
 import platform
 from rq import Worker, SimpleWorker
-from redis import Redis
-from app.config import settings
+from app.redis_pool import get_redis
+from app.services.queue import FairQueue, listen_queues
 
-redis_conn = Redis.from_url(settings.redis_url)
+# Raw bytes for RQ, and no socket read timeout: the worker parks in BLPOP
+redis_conn = get_redis(decode_responses=False, blocking=True)
 
-listen = ["gemini"]
+listen = listen_queues()
 
 
 def build_worker():
@@ -19,11 +20,27 @@ def build_worker():
     is_macos = platform.system() == "Darwin"
 
     if force_simple or is_macos:
-        return SimpleWorker(listen, connection=redis_conn)
+        return SimpleWorker(listen, connection=redis_conn, queue_class=FairQueue)
 
-    return Worker(listen, connection=redis_conn)
+    return Worker(listen, connection=redis_conn, queue_class=FairQueue)
 
 
 if __name__ == "__main__":
-    worker = build_worker()
-    worker.work()
+    from worker_tasks import recover_orphaned_turns
+
+    # Turns a dead worker left half-answered
+    recover_orphaned_turns()
+
+    # WORKER_MODE=async runs many jobs concurrently in one asyncio process
+    if os.getenv("WORKER_MODE", "").strip().lower() == "async":
+        from async_worker import run
+
+        run(listen)
+    else:
+        from app.services.gemini import close_clients
+
+        worker = build_worker()
+        try:
+            worker.work()
+        finally:
+            close_clients()
@@ -1,37 +1,63 @@
+import asyncio
+from typing import List, Optional
+
+from loguru import logger
+from redis.exceptions import RedisError
 from sqlalchemy.orm import Session
+from app.config import settings
 from app.database import SessionLocal
-from app import models
-from app.services.gemini import generate_gemini_response
-
+from app import http_cache, models
+from app.services.history import fetch_message_page, load_context_window
+from app.services import jobs, recent, summaries, turns
+from app.services.context import clip_prompt, fit_history
+from app.services.gemini import (
+    ERROR_REPLY,
+    NO_TEXT_REPLY,
+    UNAVAILABLE_REPLY,
+    astream_gemini_response,
+    generate_gemini_response,
+    stream_gemini_response,
+)
+from app.services.events import publish_event, apublish_event
+from app.services.queue import BASIC, enqueue_gemini_message, priority_class
+from app.redis_pool import get_redis
 
-def handle_gemini_message(chatroom_id: int, user_message_id: int):
-    db: Session = SessionLocal()
-    try:
-        msgs = (
-            db.query(models.Message)
-            .filter(models.Message.chatroom_id == chatroom_id)
-            .order_by(models.Message.created_at.asc())
-            .all()
-        )
+redis_client = get_redis()
 
 
-        user_msg = next((m for m in msgs if m.id == user_message_id), None)
-        if not user_msg:
+def _load_prompt(chatroom_id: int, user_message_ids: List[int]):
+    size = settings.gemini_history_messages
+    window = recent.get_context_window(chatroom_id, user_message_ids, size)
+    if window is None:
+        db: Session = SessionLocal()
+        try:
+            window = load_context_window(db, chatroom_id, user_message_ids, size)
+            if settings.recent_messages_size > size:
+                # warm the buffer so the room's next jobs skip the DB
+                recent.rehydrate_from_db(db, chatroom_id)
+        finally:
+            db.close()
 
-            user_msg = next(
-                (m for m in reversed(msgs) if (m.role or "").lower() == "user"),
-                None,
-            )
-        user_text = (user_msg.content if user_msg else "") or ""
+    user_msgs, context = window
+    # Messages sent while the previous reply was generating are answered together
+    user_text = clip_prompt("\n\n".join(m.content for m in user_msgs if m.content))
 
-        if user_msg:
-            cutoff = [m for m in msgs if m.created_at < user_msg.created_at]
-        else:
-            cutoff = msgs[:-1]
-        history = [{"role": m.role, "content": m.content} for m in cutoff][-20:]
+    summary, through = summaries.load(chatroom_id) if summaries.enabled() else ("", 0)
+    candidates = [m for m in context if m.id > through]
+    history = fit_history(candidates, summary, user_text)
+    # Messages older than what fits and not yet in the summary: summarize up
+    # to the oldest one still sent verbatim
+    left_out = len(history) < len(candidates) or (len(context) >= size and len(candidates) == len(context))
+    if history:
+        keep_from = candidates[-len(history)].id
+    else:
+        keep_from = user_msgs[0].id if user_msgs else None
+    return user_text, history, summary, keep_from if left_out else None
 
-        text = generate_gemini_response(user_text=user_text, history=history)
 
+def _save_reply(chatroom_id: int, text: str, user_message_ids: List[int]) -> dict:
+    db: Session = SessionLocal()
+    try:
         assistant = models.Message(
             chatroom_id=chatroom_id,
             role="assistant",
@@ -40,5 +66,180 @@ def handle_gemini_message(chatroom_id: int, user_message_id: int):
         )
         db.add(assistant)
         db.commit()
+        db.refresh(assistant)
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                recent.append_message(chatroom_id, assistant, pipeline=pipe)
+                http_cache.queue_room_change(pipe, chatroom_id)
+                jobs.record_reply(pipe, user_message_ids, assistant.id)
+                pipe.execute()
+        except RedisError as e:
+            logger.warning(f"Reply bookkeeping failed for chatroom {chatroom_id}. err={e}")
+            recent.drop(chatroom_id)
+            http_cache.drop_room_token(chatroom_id)
+        return {
+            "type": "message",
+            "message_id": assistant.id,
+            "role": assistant.role,
+            "content": assistant.content,
+        }
+    finally:
+        db.close()
+
+
+def _answer_turn(
+    chatroom_id: int, user_message_ids: List[int], use_cache: bool, user_id: Optional[int], priority: str
+) -> int:
+    user_text, history, summary, summarize_upto = _load_prompt(chatroom_id, user_message_ids)
+
+    chunks = []
+    for chunk in stream_gemini_response(user_text=user_text, history=history, use_cache=use_cache, summary=summary):
+        chunks.append(chunk)
+        publish_event(chatroom_id, {"type": "chunk", "text": chunk})
+    text = "".join(chunks) or NO_TEXT_REPLY
+
+    event = _save_reply(chatroom_id, text, user_message_ids)
+    publish_event(chatroom_id, event)
+    summaries.note_turn(chatroom_id, summarize_upto, user_id, priority)
+    return event["message_id"]
+
+
+def _hand_over(chatroom_id: int, token: str, user_id: Optional[int], priority: str):
+    # This job is failing: free the room, and make sure what queued up behind
+    # it still gets a job (message id 0 only collects the pending ones)
+    try:
+        if turns.release(chatroom_id, token):
+            enqueue_gemini_message(chatroom_id, 0, user_id=user_id, priority=priority)
+            logger.warning(f"Turn failed in chatroom {chatroom_id}; pending messages handed to a new job")
+    except RedisError as e:
+        logger.warning(f"Could not hand over chatroom {chatroom_id}; lease will expire. err={e}")
+
+
+def handle_gemini_message(
+    chatroom_id: int,
+    user_message_id: int,
+    use_cache: bool = True,
+    user_id: Optional[int] = None,
+    priority: str = BASIC,
+):
+    """
+    Reply job for one user message. Returns the id of the last reply it wrote,
+    or None when the message was folded into a turn another job is running.
+    `user_id`/`priority` only route a hand-over job to the owner's queue.
+    """
+    token = turns.new_token()
+    turn = turns.claim(chatroom_id, user_message_id, token)
+    reply_id = None
+    if not turn:
+        return None
+    try:
+        with turns.kept(chatroom_id, token):
+            while turn:
+                reply_id = _answer_turn(chatroom_id, turn, use_cache, user_id, priority)
+                turn = turns.next_turn(chatroom_id, token)
+    except BaseException:
+        _hand_over(chatroom_id, token, user_id, priority)
+        raise
+    return reply_id
+
+
+async def _aanswer_turn(
+    chatroom_id: int, user_message_ids: List[int], use_cache: bool, user_id: Optional[int], priority: str
+) -> int:
+    # DB work stays on the sync engine, off the event loop
+    user_text, history, summary, summarize_upto = await asyncio.to_thread(
+        _load_prompt, chatroom_id, user_message_ids
+    )
+
+    chunks = []
+    async for chunk in astream_gemini_response(
+        user_text=user_text, history=history, use_cache=use_cache, summary=summary
+    ):
+        chunks.append(chunk)
+        await apublish_event(chatroom_id, {"type": "chunk", "text": chunk})
+    text = "".join(chunks) or NO_TEXT_REPLY
+
+    event = await asyncio.to_thread(_save_reply, chatroom_id, text, user_message_ids)
+    await apublish_event(chatroom_id, event)
+    await asyncio.to_thread(summaries.note_turn, chatroom_id, summarize_upto, user_id, priority)
+    return event["message_id"]
+
+
+async def ahandle_gemini_message(
+    chatroom_id: int,
+    user_message_id: int,
+    use_cache: bool = True,
+    user_id: Optional[int] = None,
+    priority: str = BASIC,
+):
+    """Coroutine twin of handle_gemini_message, used by the async worker."""
+    token = turns.new_token()
+    turn = await turns.aclaim(chatroom_id, user_message_id, token)
+    reply_id = None
+    if not turn:
+        return None
+    try:
+        async with turns.akept(chatroom_id, token):
+            while turn:
+                reply_id = await _aanswer_turn(chatroom_id, turn, use_cache, user_id, priority)
+                turn = await turns.anext_turn(chatroom_id, token)
+    except BaseException:
+        # shielded: runs even when the worker is cancelling this job on shutdown
+        await asyncio.shield(asyncio.to_thread(_hand_over, chatroom_id, token, user_id, priority))
+        raise
+    return reply_id
+
+
+def recover_orphaned_turns() -> int:
+    """
+    At worker start: queue a collector job for every room whose turn holder
+    died mid-turn, so those messages are answered without a new one arriving.
+    """
+    try:
+        rooms = turns.orphaned()
+    except RedisError as e:
+        logger.warning(f"Orphaned turn scan failed. err={e}")
+        return 0
+    if not rooms:
+        return 0
+    db: Session = SessionLocal()
+    try:
+        for chatroom_id in rooms:
+            room = db.get(models.Chatroom, chatroom_id)
+            owner = db.get(models.User, room.user_id) if room else None
+            if owner is None:
+                turns.discard(chatroom_id)
+                continue
+            enqueue_gemini_message(chatroom_id, 0, user_id=owner.id, priority=priority_class(owner.tier))
+        logger.warning(f"Re-queued interrupted turns for {len(rooms)} chatroom(s)")
+    finally:
+        db.close()
+    return len(rooms)
+
+
+SUMMARY_MAX_ROUNDS = 5  # batches folded in per job; the rest waits for the next one
+
+
+def summarize_chatroom(chatroom_id: int, upto_id: int, user_id: Optional[int] = None, priority: str = BASIC):
+    """
+    Fold the room's messages after the current summary and before `upto_id`
+    into the rolling summary. Returns the id of the last message it covers.
+    """
+    db: Session = SessionLocal()
+    try:
+        summary, through = summaries.load_from_db(db, chatroom_id)
+        for _ in range(SUMMARY_MAX_ROUNDS):
+            batch, _ = fetch_message_page(db, chatroom_id, settings.gemini_summary_batch, after_id=through)
+            batch = [m for m in batch if m.id < upto_id]
+            if not batch:
+                break
+            text = generate_gemini_response(summaries.build_prompt(summary, batch), use_cache=False)
+            if text in (ERROR_REPLY, UNAVAILABLE_REPLY, NO_TEXT_REPLY):
+                logger.warning(f"Summary of chatroom {chatroom_id} not updated: {text}")
+                break
+            summary, through = text.strip(), batch[-1].id
+            summaries.save(db, chatroom_id, summary, through)
+        return through
     finally:
         db.close()
+        summaries.unlock(chatroom_id)